@@ -0,0 +1,29 @@
+"""Add content hash to elements
+
+Revision ID: 5b7f3c9d2a41
+Revises: dc541868ecb0
+Create Date: 2026-10-18 12:10:43.518204
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "5b7f3c9d2a41"
+down_revision: Union[str, None] = "dc541868ecb0"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("elements", sa.Column("content_hash", sa.VARCHAR(length=64), nullable=True))
+    op.create_index("ix_elements_content_hash", "elements", ["content_hash"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_elements_content_hash", table_name="elements")
+    op.drop_column("elements", "content_hash")
@@ -0,0 +1,39 @@
+"""Add conversion status to elements
+
+Revision ID: a3d81e6f0c27
+Revises: 5b7f3c9d2a41
+Create Date: 2026-10-18 15:42:07.906311
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "a3d81e6f0c27"
+down_revision: Union[str, None] = "5b7f3c9d2a41"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+image_status = sa.Enum("PROCESSING", "READY", "FAILED", name="imagestatus")
+
+
+def upgrade() -> None:
+    image_status.create(op.get_bind())
+    # Existing elements were converted before statuses were recorded, so they are assumed to be ready.
+    op.add_column("elements", sa.Column("status", image_status, server_default="READY", nullable=False))
+    op.alter_column("elements", "status", server_default="PROCESSING", existing_server_default="READY")
+    op.add_column("elements", sa.Column("width", sa.Integer(), nullable=True))
+    op.add_column("elements", sa.Column("height", sa.Integer(), nullable=True))
+    op.add_column("elements", sa.Column("content_bytes", sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column("elements", "content_bytes")
+    op.drop_column("elements", "height")
+    op.drop_column("elements", "width")
+    op.drop_column("elements", "status")
+    image_status.drop(op.get_bind())
@@ -2,7 +2,7 @@ import asyncio
 import os
 
 import nats
-from nats.js.api import ObjectStoreConfig, RetentionPolicy, StorageType, StreamConfig
+from nats.js.api import KeyValueConfig, ObjectStoreConfig, RetentionPolicy, StorageType, StreamConfig
 
 
 async def upgrade(servers: str):
@@ -24,6 +24,13 @@ async def upgrade(servers: str):
             storage=StorageType.MEMORY,
         ),
     )
+    await js.create_key_value(
+        KeyValueConfig(
+            bucket="renderer-stats",
+            description="Access counters used by renderer to warm up caches",
+            history=1,
+        )
+    )
     await js.add_stream(
         StreamConfig(
             name="Assets-queue",
@@ -51,6 +58,7 @@ async def downgrade(servers: str):
     js = nc.jetstream()
 
     await js.delete_object_store("assets")
+    await js.delete_key_value("renderer-stats")
     # `rendered` object store does not persist anyway.
     await js.delete_stream("Assets-queue")
     await js.delete_stream("Schedules-queue")
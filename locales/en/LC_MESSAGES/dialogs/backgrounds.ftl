@@ -12,6 +12,8 @@ dialog-backgrounds-main = Unused
 
 dialog-backgrounds-selected = <b>{ $escaped_name }</b>
     .not_ready = <i>Image can't be displayed as it's being processed</i>
+    .failed = <i>Image could not be processed. Delete it and upload another one</i>
+    .details = { NUMBER($width, useGrouping: 0) }×{ NUMBER($height, useGrouping: 0) }
     .create = { dialog-main.create }
     .rename = Rename
     .full = 📄 Send uncompressed
@@ -1,6 +1,7 @@
 dialog-upload-main =
     Upload an image to use as background.
     I recommend sending it as file to avoid quality loss!
+    You can also send several images as an album or a zip archive.
 
 
 dialog-upload-nodoc =
@@ -12,6 +13,7 @@ dialog-upload-dim =
     differ from expected ({ $expected_width }x{ $expected_height })
     You can upload another image or use this one anyway.
 
+    .smart = Crop around the most detailed part
     .resize = Stretch to required size
     .crop = Crop image
 
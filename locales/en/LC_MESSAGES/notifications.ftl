@@ -23,6 +23,8 @@ notify-reorder = Unused
 notify-templates = Unused
     .error_json = Failed to read the uploaded file
     .error_validation = The uploaded file doesn't look like a template
+    .error_cost = The template is too complex: estimated rendering time is { $cost } ms, while the limit is { $limit } ms. Try reducing the number of elements, font sizes or stroke widths
+    .warning_cost = Warning: estimated rendering time of the template is { $cost } ms, which exceeds the limit of { $limit } ms. The template is saved since you are an administrator
     .old_filename = Previous template.json
     .old_description = Just in case, here's the previous template!
     .local_filename = Template.json
@@ -51,3 +53,14 @@ notify-admin = Unused
 notify-wizard-print =
     Here's what the entered schedule looks like as text:
     <i>{ $schedule }</i>
+
+
+notify-bulk_upload = Backgrounds accepted: { $accepted }. I'll let you know when they are ready!
+    .skipped = Files skipped since they are not images or are too big: { $skipped }
+    .resized = Images that will be cropped around their most detailed part to the template size ({ NUMBER($width, useGrouping: 0) }x{ NUMBER($height, useGrouping: 0) }): { $resized }
+    .limit = Too many images: { $count } were sent, but only { $available } more can be saved. Nothing is saved.
+    .empty = No images found in the sent files.
+    .retry = Some of the names have just been taken. Please send the images again.
+
+
+notify-bulk_done = Backgrounds are ready: { $stored }. Failed to convert: { $failed }
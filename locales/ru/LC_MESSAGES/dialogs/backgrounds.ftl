@@ -13,6 +13,8 @@ dialog-backgrounds-main = Unused
 
 dialog-backgrounds-selected = <b>{ $escaped_name }</b>
     .not_ready = <i>Изображение не может быть показано, т.к. находится в процессе обработки</i>
+    .failed = <i>Изображение не удалось обработать. Удалите его и загрузите другое</i>
+    .details = { NUMBER($width, useGrouping: 0) }×{ NUMBER($height, useGrouping: 0) }
     .create = { dialog-main.create }
     .rename = Переименовать
     .full = 📄️ Прислать без сжатия
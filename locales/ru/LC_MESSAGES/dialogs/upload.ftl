@@ -1,6 +1,7 @@
 dialog-upload-main =
     Загрузите изображение для использования в качестве фона.
     Советую отправить картинку как файл, чтобы избежать потери качества!
+    Можно также отправить несколько картинок альбомом или zip-архивом.
 
 
 dialog-upload-nodoc =
@@ -12,6 +13,7 @@ dialog-upload-dim =
     отличается от ожидаемого ({ $expected_width }x{ $expected_height })
     Вы можете загрузить другую картинку или все равно использовать эту.
 
+    .smart = Обрезать вокруг самой детальной части
     .resize = Растянуть до нужного размера
     .crop = Обрезать картинку
 
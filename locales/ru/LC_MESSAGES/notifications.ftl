@@ -23,6 +23,8 @@ notify-reorder = Unused
 notify-templates = Unused
     .error_json = Не удалось прочитать присланный файл
     .error_validation = Присланный файл не выглядит как шаблон
+    .error_cost = Шаблон слишком сложный: ожидаемое время генерации { $cost } мс, а допустимое - { $limit } мс. Попробуйте уменьшить число элементов, размер шрифта или ширину обводки
+    .warning_cost = Внимание: ожидаемое время генерации по шаблону { $cost } мс, что превышает допустимые { $limit } мс. Шаблон сохранен, поскольку вы администратор
     .old_filename = Предыдущий шаблон.json
     .old_description = На всякий случай отправляю предыдущий шаблон!
     .local_filename = Шаблон.json
@@ -51,3 +53,14 @@ notify-admin = Unused
 notify-wizard-print =
     Вот так выглядит введенное расписание в виде текста:
     <i>{ $schedule }</i>
+
+
+notify-bulk_upload = Принято фонов: { $accepted }. Я сообщу, когда они будут готовы!
+    .skipped = Пропущено файлов, которые не являются изображениями или слишком велики: { $skipped }
+    .resized = Изображений, которые будут обрезаны вокруг самой детальной части до размера шаблона ({ NUMBER($width, useGrouping: 0) }x{ NUMBER($height, useGrouping: 0) }): { $resized }
+    .limit = Слишком много изображений: прислано { $count }, а сохранить можно еще только { $available }. Ничего не сохранено.
+    .empty = В присланных файлах не найдено изображений.
+    .retry = Некоторые имена только что были заняты. Пожалуйста, пришлите изображения еще раз.
+
+
+notify-bulk_done = Фоны готовы: { $stored }. Не удалось обработать: { $failed }
@@ -0,0 +1,104 @@
+"""
+Handles events published by the converter microservice, see `services.converter`.
+"""
+
+import json
+import logging
+from functools import partial
+from typing import cast
+
+from aiogram import Bot
+from fluentogram import TranslatorHub
+from nats.aio.msg import Msg
+from nats.js import JetStreamContext
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from bot_registry.image_elements import DbElementRegistry
+from bot_registry.users import DbUserRegistry
+from services.converter import (
+    ASSET_FAILED_SUBJECT_NAME,
+    ASSET_STORED_SUBJECT_NAME,
+    BATCH_DONE_SUBJECT_NAME,
+    CHAT_ID_HEADER,
+    CONTENT_BYTES_HEADER,
+    CONTENT_HASH_HEADER,
+    IMAGE_SIZE_HEADER,
+    SAVE_NAME_HEADER,
+)
+
+logger = logging.getLogger(__name__)
+
+
+async def handle_asset_stored(msg: Msg, session_pool: async_sessionmaker, js: JetStreamContext) -> None:
+    if msg.headers is None:
+        logger.error("Got message without headers")
+        raise ValueError("Headers are required for message processing")
+
+    save_name = msg.headers[SAVE_NAME_HEADER]
+    content_hash = msg.headers[CONTENT_HASH_HEADER]
+    width, height = cast(list[int], json.loads(msg.headers[IMAGE_SIZE_HEADER]))
+    content_bytes = int(msg.headers[CONTENT_BYTES_HEADER])
+    user_id, element_id = DbElementRegistry.parse_nats_object_name(save_name)
+    async with session_pool() as session:
+        registry = DbElementRegistry(session=session, js=js)
+        if not await registry.mark_element_ready(user_id, element_id, content_hash, (width, height), content_bytes):
+            logger.info("Element %s was deleted before its image was stored", save_name)
+            await registry.delete_element_content(user_id, element_id, content_hash)
+    await msg.ack()
+
+
+async def handle_asset_failed(msg: Msg, session_pool: async_sessionmaker, js: JetStreamContext) -> None:
+    if msg.headers is None:
+        logger.error("Got message without headers")
+        raise ValueError("Headers are required for message processing")
+
+    save_name = msg.headers[SAVE_NAME_HEADER]
+    logger.warning("Image %s cannot be converted: %s", save_name, msg.data.decode())
+    user_id, element_id = DbElementRegistry.parse_nats_object_name(save_name)
+    async with session_pool() as session:
+        registry = DbElementRegistry(session=session, js=js)
+        await registry.mark_element_failed(user_id, element_id)
+    await msg.ack()
+
+
+async def handle_batch_done(
+    msg: Msg, session_pool: async_sessionmaker, bot: Bot, hub: TranslatorHub, root_locale: str
+) -> None:
+    if msg.headers is None:
+        logger.error("Got message without headers")
+        raise ValueError("Headers are required for message processing")
+
+    chat_id = int(msg.headers[CHAT_ID_HEADER])
+    summary = cast(dict[str, list[str]], json.loads(msg.data))
+    # Statuses of elements are recorded by their own events, the summary is only reported.
+    async with session_pool() as session:
+        user = await DbUserRegistry(session).get_user(chat_id)
+    locale = (user and user.preferred_language) or root_locale
+    i18n = hub.get_translator_by_locale(locale)
+    await bot.send_message(
+        chat_id, i18n.get("notify-bulk_done", stored=len(summary["stored"]), failed=len(summary["failed"]))
+    )
+    await msg.ack()
+
+
+async def setup_asset_events(
+    js: JetStreamContext, session_pool: async_sessionmaker, bot: Bot, hub: TranslatorHub, root_locale: str
+) -> None:
+    await js.subscribe(
+        ASSET_STORED_SUBJECT_NAME,
+        cb=partial(handle_asset_stored, session_pool=session_pool, js=js),
+        durable="bot_asset_stored",
+        manual_ack=True,
+    )
+    await js.subscribe(
+        ASSET_FAILED_SUBJECT_NAME,
+        cb=partial(handle_asset_failed, session_pool=session_pool, js=js),
+        durable="bot_asset_failed",
+        manual_ack=True,
+    )
+    await js.subscribe(
+        BATCH_DONE_SUBJECT_NAME,
+        cb=partial(handle_batch_done, session_pool=session_pool, bot=bot, hub=hub, root_locale=root_locale),
+        durable="bot_batch_done",
+        manual_ack=True,
+    )
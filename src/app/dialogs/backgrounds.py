@@ -15,6 +15,7 @@ from magic_filter import F, MagicFilter
 from app.middlewares.i18n import I18N_KEY
 from app.middlewares.registry import ELEMENT_REGISTRY_KEY
 from bot_registry import ElementsRegistryAbstract
+from core.entities import ImageStatus
 
 from .custom_widgets import FluentFormat, StartWithData
 from .states import BackgroundsStates, ScheduleStates, UploadBackgroundStates
@@ -29,6 +30,9 @@ DIALOG_LIMIT_KEY = "limit"
 DIALOG_BACKGROUND_KEY = "background"
 DIALOG_ESCAPED_NAME_KEY = "escaped_name"
 DIALOG_IS_ELEMENT_READY_KEY = "ready"
+DIALOG_IS_ELEMENT_FAILED_KEY = "failed"
+DIALOG_WIDTH_KEY = "width"
+DIALOG_HEIGHT_KEY = "height"
 DIALOG_ELEMENT_NAME_KEY = "element_name"
 START_DATA_SELECT_ONLY_KEY = "select_only"
 START_DATA_GLOBAL_SCOPE_KEY = "global_scope"
@@ -69,7 +73,10 @@ async def selected_image_getter(
     return {
         DIALOG_BACKGROUND_KEY: MediaAttachment(ContentType.PHOTO, file_id=MediaId(file_id)),
         DIALOG_ESCAPED_NAME_KEY: html.escape(element.name),
-        DIALOG_IS_ELEMENT_READY_KEY: await element_registry.is_element_content_ready(user_id, element_id),
+        DIALOG_IS_ELEMENT_READY_KEY: element.status == ImageStatus.READY,
+        DIALOG_IS_ELEMENT_FAILED_KEY: element.status == ImageStatus.FAILED,
+        DIALOG_WIDTH_KEY: element.width,
+        DIALOG_HEIGHT_KEY: element.height,
     }
 
 
@@ -236,8 +243,13 @@ start_window = Window(
 
 selected_image_window = Window(
     DynamicMedia(selector=DIALOG_BACKGROUND_KEY, when=DIALOG_IS_ELEMENT_READY_KEY),
-    FluentFormat("dialog-backgrounds-selected.not_ready", when=~F[DIALOG_IS_ELEMENT_READY_KEY]),
+    FluentFormat(
+        "dialog-backgrounds-selected.not_ready",
+        when=~F[DIALOG_IS_ELEMENT_READY_KEY] & ~F[DIALOG_IS_ELEMENT_FAILED_KEY],
+    ),
+    FluentFormat("dialog-backgrounds-selected.failed", when=DIALOG_IS_ELEMENT_FAILED_KEY),
     FluentFormat("dialog-backgrounds-selected"),
+    FluentFormat("dialog-backgrounds-selected.details", when=F[DIALOG_WIDTH_KEY]),
     StartWithData(
         FluentFormat("dialog-backgrounds-selected.create"),
         id="schedule_from_selected",
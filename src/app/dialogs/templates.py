@@ -2,6 +2,7 @@ import io
 import json
 import logging
 from functools import partial
+from typing import cast
 
 from aiogram import Bot
 from aiogram.types import BufferedInputFile, CallbackQuery, ContentType, Message
@@ -12,9 +13,12 @@ from fluentogram import TranslatorRunner
 from magic_filter import F
 from pydantic import ValidationError
 
+from app.middlewares.db_session import USER_ENTITY_KEY
 from app.middlewares.i18n import I18N_KEY
 from app.middlewares.registry import TEMPLATE_REGISTRY_KEY
 from bot_registry.templates import TemplateRegistryAbstract
+from core.entities import UserEntity
+from services.renderer.cost import estimate_cost
 from services.renderer.templates import Template
 
 from .custom_widgets import FluentFormat
@@ -24,6 +28,7 @@ from .utils import current_user_id
 logger = logging.getLogger(__name__)
 
 DIALOG_HAS_USER_TEMPLATE_KEY = "has_user_template"
+TEMPLATE_COST_LIMIT_KEY = "template_cost_limit"
 
 FILE_SIZE_LIMIT = 1 * 1024 * 1024
 
@@ -32,7 +37,8 @@ async def send_template(
     bot: Bot, chat_id: int, template: Template, filename: str, description: str | None = None
 ) -> None:
     logger.debug("Send template as '%s' to chat %d", filename, chat_id)
-    body = template.model_dump_json(by_alias=True, exclude_none=True).encode()
+    # Inheriting templates are sent as they were uploaded, without parts of the base template.
+    body = (template.delta or template).dump_json().encode()
     await bot.send_document(chat_id, BufferedInputFile(file=body, filename=filename), caption=description)
 
 
@@ -64,6 +70,33 @@ async def handle_new_template(
         await message.answer(i18n.get("notify-templates.error_validation"))
         return
 
+    resolved_template = new_template
+    if new_template.base is not None:
+        base_template = await template_registry.get_template(None)
+        try:
+            if base_template is None:
+                raise ValueError("Base template is missing")
+            resolved_template = new_template.resolve(base_template)
+        except ValueError:
+            logger.info("Cannot resolve template over the base one", exc_info=True)
+            await message.answer(i18n.get("notify-templates.error_validation"))
+            return
+
+    cost = estimate_cost(resolved_template)
+    cost_limit: float = manager.middleware_data.get(TEMPLATE_COST_LIMIT_KEY) or 0
+    if cost_limit and cost.estimate() > cost_limit:
+        user = cast(UserEntity, manager.middleware_data[USER_ENTITY_KEY])
+        if not user.is_admin:
+            logger.info("Template of %d exceeds cost limit: %s", user_id, cost)
+            await message.answer(
+                i18n.get("notify-templates.error_cost", cost=round(cost.estimate()), limit=round(cost_limit))
+            )
+            return
+        logger.warning("Admin %d uploaded template exceeding cost limit: %s", user_id, cost)
+        await message.answer(
+            i18n.get("notify-templates.warning_cost", cost=round(cost.estimate()), limit=round(cost_limit))
+        )
+
     old_template: Template | None = await template_registry.get_template(user_id)
     if old_template is not None:
         logger.info("Sending back previous template")
@@ -1,8 +1,13 @@
+import asyncio
 import html
+import io
 import logging
+import zipfile
 from enum import StrEnum
-from typing import Any, cast
+from pathlib import Path, PurePosixPath
+from typing import IO, Any, AsyncGenerator, AsyncIterable, Iterable, cast
 
+from aiogram import Bot
 from aiogram.types import CallbackQuery, ContentType, Message
 from aiogram_dialog import Dialog, DialogManager, Window
 from aiogram_dialog.api.entities import ShowMode
@@ -10,22 +15,41 @@ from aiogram_dialog.widgets.input import MessageInput, TextInput
 from aiogram_dialog.widgets.kbd import Button, Cancel, SwitchTo
 from fluentogram import TranslatorRunner
 from magic_filter import F
-from PIL import Image, UnidentifiedImageError
+from PIL import Image, ImageFile
 
+from app.middlewares.album import ALBUM_KEY
 from app.middlewares.db_session import USER_ENTITY_KEY
 from app.middlewares.i18n import I18N_KEY
 from app.middlewares.registry import ELEMENT_REGISTRY_KEY, TEMPLATE_REGISTRY_KEY
-from bot_registry import ElementsRegistryAbstract, TemplateRegistryAbstract
+from bot_registry import (
+    ElementsRegistryAbstract,
+    ElementUpload,
+    TemplateRegistryAbstract,
+)
 from core.entities import UserEntity
 from core.exceptions import DuplicateNameException
 
 from .custom_widgets import FluentFormat
 from .states import UploadBackgroundStates
-from .utils import active_user_id, has_admin_privileges, save_to_dialog_data
+from .utils import (
+    active_user_id,
+    current_chat_id,
+    has_admin_privileges,
+    save_to_dialog_data,
+)
 
 logger = logging.getLogger(__name__)
 
 FILE_SIZE_LIMIT = 10 * 1024 * 1024
+# Dimensions are read from the image header, which is usually at the beginning of the file.
+# JPEG may have large metadata before it, so a few chunks are allowed.
+HEADER_READ_LIMIT = 256 * 1024
+HEADER_CHUNK_SIZE = 16 * 1024
+# Bot API does not allow bots to download larger files.
+ARCHIVE_SIZE_LIMIT = 20 * 1024 * 1024
+ARCHIVE_MIME_TYPES = ("application/zip", "application/x-zip-compressed")
+# Metadata added by macOS archiver, not actual files.
+ARCHIVE_IGNORED_PREFIX = "__MACOSX/"
 
 
 class _ErrorReason(StrEnum):
@@ -76,11 +100,303 @@ async def on_dialog_start(_: Any, manager: DialogManager):
     logger.debug("Ready to accept image. Expected shape is %d x %d", width, height)
 
 
+async def _read_image_size(bot: Bot, file_id: str) -> tuple[int, int] | None:
+    """
+    Downloads the file only until Pillow recognizes its header. Returns None if it is not an image.
+    The whole file is downloaded once, by the converter.
+    """
+    file = await bot.get_file(file_id)
+    assert file.file_path is not None, "file is available for download"
+    if bot.session.api.is_local:
+        local_path = bot.session.api.wrap_local_file.to_local(file.file_path)
+        head = await asyncio.to_thread(_read_head, local_path)
+        stream: AsyncGenerator[bytes, None] = _iter_once(head)
+    else:
+        stream = bot.session.stream_content(
+            bot.session.api.file_url(bot.token, file.file_path),
+            headers={"Range": f"bytes=0-{HEADER_READ_LIMIT - 1}"},
+            chunk_size=HEADER_CHUNK_SIZE,
+        )
+
+    try:
+        return await _parse_image_size_async(stream)
+    finally:
+        # Closes the connection without reading the rest of the file.
+        await stream.aclose()
+
+
+def _read_head(path: str | Path) -> bytes:
+    with open(path, "rb") as f:
+        return f.read(HEADER_READ_LIMIT)
+
+
+async def _iter_once(data: bytes) -> AsyncGenerator[bytes, None]:
+    yield data
+
+
+# Raised by Pillow for files which are not images, are broken or declare too many pixels.
+_IMAGE_ERRORS = (Image.DecompressionBombError, OSError, SyntaxError)
+
+
+async def _parse_image_size_async(chunks: AsyncIterable[bytes]) -> tuple[int, int] | None:
+    parser = ImageFile.Parser()
+    read = 0
+    try:
+        async for chunk in chunks:
+            parser.feed(chunk)
+            if parser.image is not None:
+                return parser.image.size
+            read += len(chunk)
+            if read >= HEADER_READ_LIMIT:
+                break
+    except _IMAGE_ERRORS:
+        pass
+    return None
+
+
+def _parse_image_size(chunks: Iterable[bytes]) -> tuple[int, int] | None:
+    """
+    Same as :func:`_parse_image_size_async`, but for chunks which are read synchronously.
+    """
+    parser = ImageFile.Parser()
+    read = 0
+    try:
+        for chunk in chunks:
+            parser.feed(chunk)
+            if parser.image is not None:
+                return parser.image.size
+            read += len(chunk)
+            if read >= HEADER_READ_LIMIT:
+                break
+    except _IMAGE_ERRORS:
+        pass
+    return None
+
+
+def _is_archive(message: Message) -> bool:
+    document = message.document
+    if document is None:
+        return False
+    return document.mime_type in ARCHIVE_MIME_TYPES or (document.file_name or "").lower().endswith(".zip")
+
+
+class _RemoteFile(io.RawIOBase):
+    """
+    Read-only file which downloads only requested ranges of a file from the Bot API. It is read in a worker thread,
+    while downloads run in the event loop.
+    """
+
+    def __init__(self, bot: Bot, url: str, size: int, loop: asyncio.AbstractEventLoop):
+        self.bot = bot
+        self.url = url
+        self.size = size
+        self.loop = loop
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: self.size}[whence]
+        self._position = max(base + offset, 0)
+        return self._position
+
+    def readinto(self, buffer: Any) -> int:
+        end = min(self._position + len(buffer), self.size)
+        if end <= self._position:
+            return 0
+        data = asyncio.run_coroutine_threadsafe(self._download(self._position, end), self.loop).result()
+        buffer[: len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    async def _download(self, start: int, end: int) -> bytes:
+        chunks = [
+            chunk
+            async for chunk in self.bot.session.stream_content(
+                self.url, headers={"Range": f"bytes={start}-{end - 1}"}, chunk_size=HEADER_CHUNK_SIZE
+            )
+        ]
+        return b"".join(chunks)[: end - start]
+
+
+def _iter_chunks(stream: IO[bytes]) -> Iterable[bytes]:
+    while chunk := stream.read(HEADER_CHUNK_SIZE):
+        yield chunk
+
+
+def _read_archive(source: Path | IO[bytes]) -> list[tuple[str, tuple[int, int] | None]]:
+    """
+    Returns names of archive members with their dimensions, None for members which are not images or are too big.
+    Only the central directory and beginnings of members are read.
+    """
+    members: list[tuple[str, tuple[int, int] | None]] = []
+    with zipfile.ZipFile(source) as archive:
+        for info in archive.infolist():
+            if info.is_dir() or info.filename.startswith(ARCHIVE_IGNORED_PREFIX):
+                continue
+            if info.file_size > FILE_SIZE_LIMIT:
+                members.append((info.filename, None))
+                continue
+            with archive.open(info) as member:
+                members.append((info.filename, _parse_image_size(_iter_chunks(member))))
+    return members
+
+
+async def _read_archive_from_telegram(bot: Bot, file_id: str) -> list[tuple[str, tuple[int, int] | None]]:
+    """
+    Reads the archive without downloading it as a whole. The whole archive is downloaded once, by the converter.
+    """
+    file = await bot.get_file(file_id)
+    assert file.file_path is not None, "file is available for download"
+    source: Path | IO[bytes]
+    if bot.session.api.is_local:
+        source = Path(bot.session.api.wrap_local_file.to_local(file.file_path))
+    else:
+        url = bot.session.api.file_url(bot.token, file.file_path)
+        remote = _RemoteFile(bot, url, cast(int, file.file_size), asyncio.get_running_loop())
+        # Buffered, so small reads of zip headers do not turn into separate requests.
+        source = io.BufferedReader(remote, buffer_size=HEADER_CHUNK_SIZE)
+    try:
+        return await asyncio.to_thread(_read_archive, source)
+    except zipfile.BadZipFile:
+        logger.info("Archive rejected: cannot open as zip (file_id %s)", file_id)
+        return []
+
+
+def _unique_name(name: str, used: set[str]) -> str:
+    name = name[: ElementsRegistryAbstract.MAX_NAME_LENGTH]
+    candidate = name
+    index = 1
+    while candidate in used:
+        index += 1
+        suffix = f" ({index})"
+        candidate = name[: ElementsRegistryAbstract.MAX_NAME_LENGTH - len(suffix)] + suffix
+    return candidate
+
+
+async def handle_bulk_upload(messages: list[Message], manager: DialogManager) -> None:
+    """
+    Saves images from a media group or zip archives without asking about each of them. Files which are not images
+    are skipped, images of wrong dimensions are cropped to their most detailed part and resized to the template size.
+    """
+    i18n: TranslatorRunner = manager.middleware_data[I18N_KEY]
+    registry: ElementsRegistryAbstract = manager.middleware_data[ELEMENT_REGISTRY_KEY]
+    user_id = active_user_id(manager)
+    message_to_answer = messages[0]
+    if user_id is None and not has_admin_privileges(manager):
+        await message_to_answer.answer(i18n.get("notify-forbidden"))
+        await manager.done()
+        return
+    bot = message_to_answer.bot
+    assert bot is not None, "No bot context in message"
+
+    uploads: list[ElementUpload] = []
+    sizes: list[tuple[int, int]] = []
+    skipped = 0
+    for message in messages:
+        image_size: tuple[int, int] | None = None
+        if (photos := message.photo) is not None:
+            photo = photos[-1]
+            image_size = (photo.width, photo.height)
+            upload = ElementUpload(
+                name=message.caption or registry.generate_trivial_name(), file_id=photo.file_id, file_type="photo"
+            )
+        elif (document := message.document) is not None and _is_archive(message):
+            if cast(int, document.file_size) > ARCHIVE_SIZE_LIMIT:
+                logger.info("Archive rejected: file size is %d", document.file_size)
+                skipped += 1
+                continue
+            for member, member_size in await _read_archive_from_telegram(bot, document.file_id):
+                if member_size is None:
+                    skipped += 1
+                    continue
+                uploads.append(
+                    ElementUpload(
+                        name=PurePosixPath(member).stem,
+                        file_id=document.file_id,
+                        file_type="document",
+                        member=member,
+                    )
+                )
+                sizes.append(member_size)
+            continue
+        elif document is not None:
+            if cast(int, document.file_size) <= FILE_SIZE_LIMIT:
+                image_size = await _read_image_size(bot, document.file_id)
+            upload = ElementUpload(
+                name=message.caption or document.file_name or registry.generate_trivial_name(),
+                file_id=document.file_id,
+                file_type="document",
+            )
+        else:
+            # Media groups may contain videos as well.
+            skipped += 1
+            continue
+        if image_size is None:
+            skipped += 1
+            continue
+        uploads.append(upload)
+        sizes.append(image_size)
+    logger.info("Bulk upload of %d images, %d files skipped", len(uploads), skipped)
+
+    if not uploads:
+        await message_to_answer.answer(i18n.get("notify-bulk_upload.empty"))
+        return
+    limit = await registry.get_elements_limit(user_id)
+    current = await registry.get_elements_count(user_id)
+    if current + len(uploads) > limit:
+        await message_to_answer.answer(
+            i18n.get("notify-bulk_upload.limit", count=len(uploads), available=max(limit - current, 0))
+        )
+        return
+
+    used_names = {element.name for element in await registry.get_elements(user_id)}
+    for upload in uploads:
+        upload.name = _unique_name(upload.name, used_names)
+        used_names.add(upload.name)
+
+    expected = (manager.dialog_data[DIALOG_EXPECTED_WIDTH_KEY], manager.dialog_data[DIALOG_EXPECTED_HEIGHT_KEY])
+    resized = 0
+    if not manager.start_data[START_DATA_GLOBAL_SCOPE_KEY] and expected != (None, None):
+        for upload, size in zip(uploads, sizes):
+            if size != expected:
+                upload.resize_mode = "smart"
+                resized += 1
+
+    try:
+        elements = await registry.save_elements(user_id, uploads, expected, chat_id=current_chat_id(manager))
+    except DuplicateNameException:
+        # Names are checked above, so another upload has just taken some of them.
+        await message_to_answer.answer(i18n.get("notify-bulk_upload.retry"))
+        return
+
+    lines = [i18n.get("notify-bulk_upload", accepted=len(elements))]
+    if skipped:
+        lines.append(i18n.get("notify-bulk_upload.skipped", skipped=skipped))
+    if resized:
+        lines.append(i18n.get("notify-bulk_upload.resized", resized=resized, width=expected[0], height=expected[1]))
+    await message_to_answer.answer("\n".join(lines))
+    await manager.done(result={RESULT_ELEMENT_ID_KEY: elements[0].element_id}, show_mode=ShowMode.SEND)
+
+
 async def handle_image_upload(
     message: Message,
     _: MessageInput,
     manager: DialogManager,
 ) -> None:
+    album: list[Message] | None = manager.middleware_data.get(ALBUM_KEY)
+    if album is not None or _is_archive(message):
+        await handle_bulk_upload(album or [message], manager)
+        return
+
+    image_size: tuple[int, int] | None = None
     if (photos := message.photo) is not None:
         logger.debug("Accepted photo object")
         photo = photos[-1]
@@ -88,6 +404,8 @@ async def handle_image_upload(
         file_size = cast(int, photo.file_size)
         sent_name = message.caption
         is_document = False
+        # Photos are always re-encoded by Telegram, so their dimensions are known without downloading.
+        image_size = (photo.width, photo.height)
     elif (document := message.document) is not None:
         logger.debug("Accepted document object")
         file_id = document.file_id
@@ -109,20 +427,17 @@ async def handle_image_upload(
         await manager.switch_to(UploadBackgroundStates.UPLOAD_FAILED)
         return
 
-    bot = message.bot
-    assert bot is not None, "No bot context in message"
-    file = await bot.download(file_id)
-    assert file is not None, "image loaded to file system"
-
-    try:
-        image = Image.open(file)
-    except UnidentifiedImageError:
+    if image_size is None:
+        bot = message.bot
+        assert bot is not None, "No bot context in message"
+        image_size = await _read_image_size(bot, file_id)
+    if image_size is None:
         logger.info("Image rejected: cannot open as image (file_id %s)", file_id)
         manager.dialog_data[DIALOG_FAIL_REASON_KEY] = _ErrorReason.UNREADABLE
         await manager.switch_to(UploadBackgroundStates.UPLOAD_FAILED)
         return
 
-    width, height = image.size
+    width, height = image_size
     manager.dialog_data[DIALOG_REAL_WIDTH_KEY] = width
     manager.dialog_data[DIALOG_REAL_HEIGHT_KEY] = height
     manager.dialog_data[DIALOG_RESIZE_MODE_KEY] = "ignore"
@@ -238,6 +553,12 @@ uploaded_bad_dimensions_window = Window(
         expected_width=F["dialog_data"]["expected_width"],
         expected_height=F["dialog_data"]["expected_height"],
     ),
+    SwitchTo(
+        FluentFormat("dialog-upload-dim.smart"),
+        id="bad_dimensions_smart",
+        state=UploadBackgroundStates.UPLOADED_EXPECT_NAME,
+        on_click=save_to_dialog_data("resize_mode", "smart"),
+    ),
     SwitchTo(
         FluentFormat("dialog-upload-dim.resize"),
         id="bad_dimensions_resize",
@@ -78,9 +78,10 @@ class BotAwareMessageManager(MessageManager):
         async with self.session_pool() as session:
             registry = DbElementRegistry(session=session, js=self.js)
             # We don't check existing via `.is_element_content_ready` since this is not called unless so.
-            content = await registry.get_element_content(user_id or None, element_id)
+            # Media is sent as a photo, so Telegram would compress it anyway. Thumbnail is much smaller to send.
+            content = await registry.get_element_content(user_id or None, element_id, derivative="thumbnail")
             file_name = (await registry.get_element(user_id or None, element_id)).name
-            input_document = BufferedInputFile(content, filename=str(Path(file_name).with_suffix(".png")))
+            input_document = BufferedInputFile(content, filename=str(Path(file_name).with_suffix(".jpg")))
             return input_document
 
     # Widget DynamicMedia caches file_id by our URI. Nevertheless, we explicitly save file_id in the registry,
@@ -0,0 +1,46 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import Message, TelegramObject
+
+logger = logging.getLogger(__name__)
+
+
+ALBUM_KEY = "album"
+# Telegram sends messages of a media group one by one, usually within a fraction of a second.
+ALBUM_LATENCY = 0.5
+
+
+class AlbumMiddleware(BaseMiddleware):
+    """
+    Collects messages of a media group, so the handler is called once for the first of them with all messages
+    in `data[ALBUM_KEY]`. Must be an outer middleware, so the rest of the messages do not reach the handlers.
+    """
+
+    def __init__(self, latency: float = ALBUM_LATENCY):
+        self.latency = latency
+        self._albums: dict[tuple[int, str], list[Message]] = {}
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        if not isinstance(event, Message) or event.media_group_id is None:
+            return await handler(event, data)
+
+        key = (event.chat.id, event.media_group_id)
+        if (album := self._albums.get(key)) is not None:
+            album.append(event)
+            return None
+
+        self._albums[key] = [event]
+        # Updates are handled as separate tasks, so other messages of the group arrive while this one waits.
+        await asyncio.sleep(self.latency)
+        album = self._albums.pop(key)
+        logger.debug("Collected media group %s of %d messages", event.media_group_id, len(album))
+        data[ALBUM_KEY] = sorted(album, key=lambda message: message.message_id)
+        return await handler(event, data)
@@ -1,4 +1,4 @@
-from .image_elements import DbElementRegistry, ElementsRegistryAbstract
+from .image_elements import DbElementRegistry, ElementsRegistryAbstract, ElementUpload
 from .templates import DbTemplateRegistry, TemplateRegistryAbstract
 from .texts import DbScheduleRegistry, ScheduleRegistryAbstract
 from .users import DbUserRegistry, UserRegistryAbstract
@@ -6,6 +6,7 @@ from .users import DbUserRegistry, UserRegistryAbstract
 __all__ = [
     "ElementsRegistryAbstract",
     "DbElementRegistry",
+    "ElementUpload",
     "TemplateRegistryAbstract",
     "DbTemplateRegistry",
     "ScheduleRegistryAbstract",
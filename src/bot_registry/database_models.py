@@ -8,7 +8,7 @@ from sqlalchemy.engine.default import DefaultExecutionContext
 from sqlalchemy.ext.asyncio import AsyncAttrs
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
-from core.entities import PreferredLanguage
+from core.entities import ImageStatus, PreferredLanguage
 
 
 class Base(DeclarativeBase, AsyncAttrs):
@@ -58,5 +58,14 @@ class ImageElementModel(Base):
     file_id_photo: Mapped[str | None] = mapped_column(VARCHAR(90), nullable=True)
     file_id_document: Mapped[str | None] = mapped_column(VARCHAR(90), nullable=True)
     display_order: Mapped[int] = mapped_column(default=_next_display_order, nullable=False)
+    # SHA-256 of the converted image, its content is stored once for all elements with the same hash.
+    content_hash: Mapped[str | None] = mapped_column(VARCHAR(64), nullable=True, index=True)
+    # Set by events of the converter, so readiness is known without requests to the object store.
+    status: Mapped[ImageStatus] = mapped_column(
+        ORMEnum(ImageStatus), default=ImageStatus.PROCESSING, server_default=ImageStatus.PROCESSING.name
+    )
+    width: Mapped[int | None] = mapped_column(nullable=True)
+    height: Mapped[int | None] = mapped_column(nullable=True)
+    content_bytes: Mapped[int | None] = mapped_column(nullable=True)
 
     owner: Mapped[UserModel | None] = relationship(back_populates="elements")
@@ -2,9 +2,10 @@ import io
 import json
 import logging
 from abc import ABC, abstractmethod
+from dataclasses import dataclass
 from datetime import datetime
 from typing import ClassVar, Literal, cast, final
-from uuid import UUID
+from uuid import UUID, uuid4
 
 import sqlalchemy.exc
 from nats.js.errors import ObjectNotFoundError
@@ -13,7 +14,7 @@ from PIL import Image
 from sqlalchemy import delete, func, select, text, update
 
 from bot_registry.database_models import ImageElementModel
-from core.entities import ImageEntity
+from core.entities import ImageEntity, ImageStatus
 from core.exceptions import (
     DuplicateNameException,
     ImageContentEmpty,
@@ -21,11 +22,16 @@ from core.exceptions import (
     ImageNotProcessedException,
 )
 from services.converter import (
+    BATCH_ID_HEADER,
+    CHAT_ID_HEADER,
     IMAGE_FORMAT,
+    RENDER_SUFFIX,
     RESIZE_MODE_HEADER,
     SAVE_NAME_HEADER,
     TARGET_SIZE_HEADER,
+    THUMBNAIL_SUFFIX,
 )
+from services.converter.content import content_name, delete_objects
 
 from .database_mixin import DatabaseRegistryMixin
 from .nats_mixin import NATSRegistryMixin
@@ -36,6 +42,26 @@ logger = logging.getLogger(__name__)
 LOCAL_SCOPE_ELEMENTS_LIMIT = 10
 GLOBAL_SCOPE_ELEMENTS_LIMIT = 1_000
 
+ImageDerivative = Literal["full", "render", "thumbnail"]
+DERIVATIVE_SUFFIXES: dict[ImageDerivative, str] = {
+    "full": "",
+    "render": RENDER_SUFFIX,
+    "thumbnail": THUMBNAIL_SUFFIX,
+}
+
+
+@dataclass
+class ElementUpload:
+    """
+    One of several images uploaded at once. Images from a zip archive share its `file_id` and differ by `member`.
+    """
+
+    name: str
+    file_id: str
+    file_type: Literal["photo", "document"]
+    resize_mode: Literal["resize", "smart", "crop", "ignore"] = "ignore"
+    member: str | None = None
+
 
 class ElementsRegistryAbstract(ABC):
     @abstractmethod
@@ -51,15 +77,17 @@ class ElementsRegistryAbstract(ABC):
         raise NotImplementedError
 
     async def is_element_content_ready(self, user_id: int | None, element_id: str | UUID) -> bool:
-        try:
-            _ = self.get_element_content(user_id, element_id)
-        except ImageNotProcessedException:
-            return False
-        else:
-            return True
+        element = await self.get_element(user_id, element_id)
+        return element.status == ImageStatus.READY
 
     @abstractmethod
-    async def get_element_content(self, user_id: int | None, element_id: str | UUID) -> bytes:
+    async def get_element_content(
+        self, user_id: int | None, element_id: str | UUID, derivative: ImageDerivative = "full"
+    ) -> bytes:
+        """
+        Derivatives other than the full image are smaller or faster to decode. If the element has no such
+        derivative (e.g. it was converted before they were introduced), the full image is returned instead.
+        """
         raise NotImplementedError
 
     @abstractmethod
@@ -71,10 +99,24 @@ class ElementsRegistryAbstract(ABC):
         target_size: tuple[int, int],
         file_id_photo: str | None = None,
         file_id_document: str | None = None,
-        resize_mode: Literal["resize", "crop", "ignore"] = "ignore",
+        resize_mode: Literal["resize", "smart", "crop", "ignore"] = "ignore",
     ) -> ImageEntity:
         raise NotImplementedError
 
+    @abstractmethod
+    async def save_elements(
+        self,
+        user_id: int | None,
+        uploads: list[ElementUpload],
+        target_size: tuple[int, int],
+        chat_id: int,
+    ) -> list[ImageEntity]:
+        """
+        Saves all elements or none of them, and converts them as one job. When all of them are processed,
+        a summary is sent to `chat_id`.
+        """
+        raise NotImplementedError
+
     @abstractmethod
     async def update_element_file_id(
         self,
@@ -89,6 +131,24 @@ class ElementsRegistryAbstract(ABC):
     async def update_element_name(self, user_id: int | None, element_id: str | UUID, name: str) -> None:
         raise NotImplementedError
 
+    @abstractmethod
+    async def mark_element_ready(
+        self,
+        user_id: int | None,
+        element_id: str | UUID,
+        content_hash: str,
+        size: tuple[int, int],
+        content_bytes: int,
+    ) -> bool:
+        """
+        Returns False if there is no such element, e.g. it was deleted while its image was converted.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def mark_element_failed(self, user_id: int | None, element_id: str | UUID) -> None:
+        raise NotImplementedError
+
     @abstractmethod
     async def reorder_make_first(self, user_id: int | None, element_id: str | UUID) -> None:
         raise NotImplementedError
@@ -118,12 +178,18 @@ class ElementsRegistryAbstract(ABC):
             name=element_db.name,
             file_id_photo=element_db.file_id_photo,
             file_id_document=element_db.file_id_document,
+            status=element_db.status,
+            width=element_db.width,
+            height=element_db.height,
+            content_bytes=element_db.content_bytes,
         )
 
+    MAX_NAME_LENGTH = 50
+
     @classmethod
     @final
     def validate_name(cls, name: str) -> str:
-        if len(name) > 50:
+        if len(name) > cls.MAX_NAME_LENGTH:
             raise ValueError(f"Name is too long: {len(name)}")
         return name
 
@@ -148,6 +214,7 @@ class DbElementRegistry(ElementsRegistryAbstract, DatabaseRegistryMixin, NATSReg
     BUCKET_NAME: ClassVar[str] = "assets"
     CONVERT_RAW_SUBJECT_NAME: ClassVar[str] = "assets.convert.raw"
     CONVERT_FILE_ID_SUBJECT_NAME: ClassVar[str] = "assets.convert.file_id"
+    CONVERT_BATCH_SUBJECT_NAME: ClassVar[str] = "assets.convert.batch"
 
     async def get_elements(self, user_id: int | None) -> list[ImageEntity]:
         result = await self.session.execute(
@@ -175,10 +242,19 @@ class DbElementRegistry(ElementsRegistryAbstract, DatabaseRegistryMixin, NATSReg
         )
         return cast(int, result.scalar())
 
-    async def get_element_content(self, user_id: int | None, element_id: str | UUID) -> bytes:
+    async def get_element_content(
+        self, user_id: int | None, element_id: str | UUID, derivative: ImageDerivative = "full"
+    ) -> bytes:
         bucket = await self._bucket()
+        name = self._nats_object_name(user_id, element_id)
         try:
-            result = await bucket.get(self._nats_object_name(user_id, element_id))
+            try:
+                result = await bucket.get(f"{name}{DERIVATIVE_SUFFIXES[derivative]}")
+            except ObjectNotFoundError:
+                if derivative == "full":
+                    raise
+                logger.debug("No %s derivative for %s, using the full image", derivative, name)
+                result = await bucket.get(name)
         except ObjectNotFoundError as e:
             raise ImageNotProcessedException(user_id, element_id) from e
 
@@ -186,15 +262,6 @@ class DbElementRegistry(ElementsRegistryAbstract, DatabaseRegistryMixin, NATSReg
             raise ImageContentEmpty(user_id, element_id)
         return result.data
 
-    async def is_element_content_ready(self, user_id: int | None, element_id: str | UUID) -> bool:
-        bucket = await self._bucket()
-        try:
-            _ = await bucket.get_info(self._nats_object_name(user_id, element_id))
-        except ObjectNotFoundError:
-            return False
-        else:
-            return True
-
     async def save_element(
         self,
         element: Image.Image | None,
@@ -203,7 +270,7 @@ class DbElementRegistry(ElementsRegistryAbstract, DatabaseRegistryMixin, NATSReg
         target_size: tuple[int, int],
         file_id_photo: str | None = None,
         file_id_document: str | None = None,
-        resize_mode: Literal["resize", "crop", "ignore"] = "ignore",
+        resize_mode: Literal["resize", "smart", "crop", "ignore"] = "ignore",
     ) -> ImageEntity:
         if element is None and file_id_photo is None and file_id_document is None:
             raise ValueError("Cannot save element without image or file_id to get it")
@@ -242,6 +309,61 @@ class DbElementRegistry(ElementsRegistryAbstract, DatabaseRegistryMixin, NATSReg
         )
         return self._convert_to_entity(element_model)
 
+    async def save_elements(
+        self,
+        user_id: int | None,
+        uploads: list[ElementUpload],
+        target_size: tuple[int, int],
+        chat_id: int,
+    ) -> list[ImageEntity]:
+        # Display order is set explicitly, since the default one is computed before any of these rows is inserted.
+        last_order = (
+            await self.session.execute(
+                select(func.max(ImageElementModel.display_order)).where(ImageElementModel.user_id == user_id)
+            )
+        ).scalar()
+        first_order = 0 if last_order is None else last_order + 1
+        element_models = [
+            ImageElementModel(
+                user_id=user_id,
+                name=upload.name,
+                # Members of archives have no file_id of their own.
+                file_id_photo=upload.file_id
+                if upload.file_type == "photo" and upload.resize_mode == "ignore" and upload.member is None
+                else None,
+                file_id_document=upload.file_id
+                if upload.file_type == "document" and upload.resize_mode == "ignore" and upload.member is None
+                else None,
+                display_order=first_order + i,
+            )
+            for i, upload in enumerate(uploads)
+        ]
+        try:
+            self.session.add_all(element_models)
+            await self.session.commit()
+        except sqlalchemy.exc.IntegrityError as e:
+            await self.session.rollback()
+            raise DuplicateNameException(", ".join(upload.name for upload in uploads)) from e
+
+        items = [
+            {
+                "save_name": self._nats_object_name(user_id, element_model.element_id),
+                "file_id": upload.file_id,
+                "member": upload.member,
+                "resize_mode": upload.resize_mode,
+                "target_size": target_size,
+            }
+            for upload, element_model in zip(uploads, element_models)
+        ]
+        batch_id = str(uuid4())
+        logger.info("Converting %d elements of %s as batch %s", len(items), user_id, batch_id)
+        await self.js.publish(
+            subject=self.CONVERT_BATCH_SUBJECT_NAME,
+            payload=json.dumps({"items": items}).encode(),
+            headers={BATCH_ID_HEADER: batch_id, CHAT_ID_HEADER: str(chat_id)},
+        )
+        return [self._convert_to_entity(element_model) for element_model in element_models]
+
     async def update_element_file_id(
         self,
         user_id: int | None,
@@ -266,6 +388,38 @@ class DbElementRegistry(ElementsRegistryAbstract, DatabaseRegistryMixin, NATSReg
         )
         await self.session.commit()
 
+    async def mark_element_ready(
+        self,
+        user_id: int | None,
+        element_id: str | UUID,
+        content_hash: str,
+        size: tuple[int, int],
+        content_bytes: int,
+    ) -> bool:
+        logger.debug("Content of %s/%s is %s", user_id, element_id, content_hash)
+        width, height = size
+        result = await self.session.execute(
+            update(ImageElementModel)
+            .where(ImageElementModel.user_id == user_id, ImageElementModel.element_id == element_id)
+            .values(
+                status=ImageStatus.READY,
+                content_hash=content_hash,
+                width=width,
+                height=height,
+                content_bytes=content_bytes,
+            )
+        )
+        await self.session.commit()
+        return bool(result.rowcount)
+
+    async def mark_element_failed(self, user_id: int | None, element_id: str | UUID) -> None:
+        await self.session.execute(
+            update(ImageElementModel)
+            .where(ImageElementModel.user_id == user_id, ImageElementModel.element_id == element_id)
+            .values(status=ImageStatus.FAILED)
+        )
+        await self.session.commit()
+
     async def reorder_make_first(self, user_id: int | None, element_id: str | UUID) -> None:
         element = await self.get_element(user_id, element_id)
         if element is None:
@@ -315,6 +469,13 @@ class DbElementRegistry(ElementsRegistryAbstract, DatabaseRegistryMixin, NATSReg
 
     async def delete_element(self, user_id: int | None, element_id: str | UUID) -> None:
         logger.info("Removing %s/%s", user_id, element_id)
+        content_hash = (
+            await self.session.execute(
+                select(ImageElementModel.content_hash).where(
+                    ImageElementModel.user_id == user_id, ImageElementModel.element_id == element_id
+                )
+            )
+        ).scalar()
         await self.session.execute(
             update(ImageElementModel)
             .where(
@@ -334,6 +495,32 @@ class DbElementRegistry(ElementsRegistryAbstract, DatabaseRegistryMixin, NATSReg
             )
         )
         await self.session.commit()
+        await self.delete_element_content(user_id, element_id, content_hash)
+
+    async def delete_element_content(
+        self, user_id: int | None, element_id: str | UUID, content_hash: str | None
+    ) -> None:
+        """
+        Removes objects of a deleted element. Links are always removed, the content only if no element refers to it.
+        Elements stored before deduplication have no hash, their objects are the content itself.
+        """
+        bucket = await self._bucket()
+        suffixes = list(DERIVATIVE_SUFFIXES.values())
+        await delete_objects(bucket, self._nats_object_name(user_id, element_id), suffixes)
+        if content_hash is None:
+            return
+        references = (
+            await self.session.execute(
+                select(func.count(ImageElementModel.element_id)).where(ImageElementModel.content_hash == content_hash)
+            )
+        ).scalar()
+        if references:
+            logger.debug("Content %s is still used by %d elements", content_hash, references)
+            return
+        # The same image may be converted right now, and its hash is not recorded yet. Then its element is left
+        # without content and has to be uploaded again, which is rare enough to not lock anything here.
+        logger.info("Removing unused content %s", content_hash)
+        await delete_objects(bucket, content_name(content_hash), suffixes)
 
     async def _bucket(self) -> ObjectStore:
         return await self.js.object_store(self.BUCKET_NAME)
@@ -341,3 +528,8 @@ class DbElementRegistry(ElementsRegistryAbstract, DatabaseRegistryMixin, NATSReg
     @staticmethod
     def _nats_object_name(user_id: int | None, element_id: str | UUID) -> str:
         return f"{user_id or 0}.{element_id}"
+
+    @staticmethod
+    def parse_nats_object_name(name: str) -> tuple[int | None, str]:
+        user_id, element_id = name.split(".")
+        return int(user_id) or None, element_id
@@ -1,14 +1,17 @@
-import json
 import logging
 from abc import ABC, abstractmethod
 
 from bot_registry.database_models import UserModel
 from core.entities import TemplateEntity
+from services.renderer.inheritance import TemplateResolver, template_hash
 
 from .database_mixin import DatabaseRegistryMixin
 
 logger = logging.getLogger(__name__)
 
+# Templates are shared by all sessions, so parsing and resolving them is done once per process.
+_resolver = TemplateResolver()
+
 
 class TemplateRegistryAbstract(ABC):
     @abstractmethod
@@ -24,14 +27,32 @@ class TemplateRegistryAbstract(ABC):
 
 
 class DbTemplateRegistry(TemplateRegistryAbstract, DatabaseRegistryMixin):
-    async def get_template(self, user_id: int | None) -> TemplateEntity | None:
+    async def _load_template(self, user_id: int | None) -> tuple[TemplateEntity, str] | None:
         user: UserModel | None = await self.session.get(UserModel, user_id or 0)
         if user is None or (template_data := user.user_template) is None:
             return None
 
-        template_dict = json.loads(template_data)
-        template = TemplateEntity.model_validate(template_dict)
-        return template
+        data_hash = template_hash(template_data)
+        return _resolver.parse(template_data, data_hash), data_hash
+
+    async def get_template(self, user_id: int | None) -> TemplateEntity | None:
+        loaded = await self._load_template(user_id)
+        if loaded is None:
+            return None
+        template, data_hash = loaded
+        if template.base is None:
+            return template
+
+        base_loaded = await self._load_template(None) if user_id else None
+        if base_loaded is None:
+            logger.error("Cannot resolve template of user %s without base template", user_id)
+            return None
+        base, base_hash = base_loaded
+        try:
+            return _resolver.resolve(template, data_hash, base, base_hash)
+        except ValueError:
+            logger.exception("Cannot resolve template of user %s", user_id)
+            return None
 
     async def update_template(self, user_id: int | None, template: TemplateEntity | None) -> None:
         logger.info("Saving template for user %d", user_id)
@@ -40,6 +61,8 @@ class DbTemplateRegistry(TemplateRegistryAbstract, DatabaseRegistryMixin):
             logger.error("Cannot save template for unknown user id %d", user_id)
             return
 
-        user.user_template = template.model_dump_json(by_alias=True, exclude_none=True) if template else None
+        # Inheriting templates are stored as is, not resolved, so changes of the base one are applied to them.
+        template = (template.delta or template) if template else None
+        user.user_template = template.dump_json() if template else None
         self.session.add(user)
         await self.session.commit()
@@ -14,12 +14,15 @@ from bot_registry.database_models import UserModel
 from core.entities import ScheduleEntity, TemplateEntity
 from core.fluentogram_utils import clear_fluentogram_message
 from services.renderer import (
+    BASE_HASH_HEADER,
     CHAT_ID_HEADER,
     ELEMENT_NAME_HEADER,
     INPUT_SUBJECT_NAME,
     START_DATE_HEADER,
+    TEMPLATE_HASH_HEADER,
     USER_ID_HEADER,
 )
+from services.renderer.inheritance import template_hash
 from services.renderer.weekdays import Entry, Time, WeekDay
 
 from .database_mixin import DatabaseRegistryMixin
@@ -159,9 +162,20 @@ class DbScheduleRegistry(ScheduleRegistryAbstract, DatabaseRegistryMixin, NATSRe
         template: TemplateEntity,
         start: date,
     ) -> None:
+        headers = {
+            USER_ID_HEADER: str(user_id),
+            CHAT_ID_HEADER: str(chat_id),
+            ELEMENT_NAME_HEADER: f"{user_id}.{background_id}",
+            START_DATE_HEADER: start.isoformat(),
+        }
+        if (delta := template.delta) is not None and template.base_hash is not None:
+            # Only differences from the base template are sent, renderer resolves them by itself.
+            headers[TEMPLATE_HASH_HEADER] = template_hash(delta.dump_json())
+            headers[BASE_HASH_HEADER] = template.base_hash
+            template = delta
         payload: bytes = msgpack.packb(
             [
-                template.model_dump(by_alias=True, exclude_none=True, mode="json"),
+                template.dump(),
                 schedule.model_dump(by_alias=True, exclude_none=True, mode="json"),
             ]
         )
@@ -169,10 +183,5 @@ class DbScheduleRegistry(ScheduleRegistryAbstract, DatabaseRegistryMixin, NATSRe
         await self.js.publish(
             subject=INPUT_SUBJECT_NAME,
             payload=payload,
-            headers={
-                USER_ID_HEADER: str(user_id),
-                CHAT_ID_HEADER: str(chat_id),
-                ELEMENT_NAME_HEADER: f"{user_id}.{background_id}",
-                START_DATE_HEADER: start.isoformat(),
-            },
+            headers=headers,
         )
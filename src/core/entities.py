@@ -13,6 +13,12 @@ class PreferredLanguage(StrEnum):
     ENGLISH = "en"
 
 
+class ImageStatus(StrEnum):
+    PROCESSING = "processing"
+    READY = "ready"
+    FAILED = "failed"
+
+
 @dataclass
 class UserEntity:
     telegram_id: int
@@ -28,11 +34,16 @@ class ImageEntity:
     name: str
     file_id_photo: str | None
     file_id_document: str | None
+    status: ImageStatus
+    width: int | None
+    height: int | None
+    content_bytes: int | None
 
 
 __all__ = [
     "UserEntity",
     "ImageEntity",
+    "ImageStatus",
     "PreferredLanguage",
     "TemplateEntity",
     "ScheduleEntity",
@@ -7,51 +7,490 @@ import io
 import json
 import logging
 import os
+import shutil
+import tempfile
+import zipfile
 from asyncio import Event
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
+from dataclasses import dataclass
 from functools import partial
-from typing import cast
+from pathlib import Path
+from typing import (
+    IO,
+    Any,
+    Awaitable,
+    Callable,
+    Literal,
+    Mapping,
+    TypeVar,
+    cast,
+    get_args,
+)
 
 import nats
+import numpy as np
 from aiogram import Bot
 from aiogram.client.default import DefaultBotProperties
 from nats.aio.msg import Msg
 from nats.js import JetStreamContext
+from nats.js.errors import NotFoundError
 from nats.js.object_store import ObjectStore
 from PIL import Image
 
+from services.converter.content import content_name, link_content, store_content
+from services.raw_image import write_raw
+from services.stats import start_stats_task
+
 BUCKET_NAME = "assets"
 CONVERT_RAW_SUBJECT_NAME = "assets.convert.raw"
 CONVERT_FILE_ID_SUBJECT_NAME = "assets.convert.file_id"
+# Published after an image is stored or cannot be converted, so the bot may record status of the element.
+ASSET_STORED_SUBJECT_NAME = "assets.stored"
+ASSET_FAILED_SUBJECT_NAME = "assets.failed"
+# Several images converted as one job, with a single summary published after all of them are processed.
+CONVERT_BATCH_SUBJECT_NAME = "assets.convert.batch"
+BATCH_DONE_SUBJECT_NAME = "assets.batch.done"
 IMAGE_FORMAT = "png"
 
 SAVE_NAME_HEADER = "Sch-Save-Name"
 RESIZE_MODE_HEADER = "Sch-Resize-Mode"
 TARGET_SIZE_HEADER = "Sch-Target-Size"
+CONTENT_HASH_HEADER = "Sch-Content-Hash"
+IMAGE_SIZE_HEADER = "Sch-Image-Size"
+CONTENT_BYTES_HEADER = "Sch-Content-Bytes"
+BATCH_ID_HEADER = "Sch-Batch-Id"
+CHAT_ID_HEADER = "Sch-Chat-Id"
+
+# Derivatives are stored next to the full image, under its name with a suffix.
+RENDER_SUFFIX = ".render"
+RENDER_COMPRESS_LEVEL = 1
+THUMBNAIL_SUFFIX = ".thumb"
+THUMBNAIL_FORMAT = "jpeg"
+THUMBNAIL_SIZE = (1280, 1280)
+THUMBNAIL_QUALITY = 85
+# Suffixes in order of storing: the full image goes last, see :func:`_convert_and_store`.
+DERIVATIVE_SUFFIXES = (THUMBNAIL_SUFFIX, RENDER_SUFFIX, "")
+# Uploads and converted images are kept in a temporary directory (see `TMPDIR`) until they are stored.
+WORK_DIR_PREFIX = "converter-"
+# Longest wait for new messages, after which the fetch is repeated.
+FETCH_TIMEOUT = 5.0
+
+ExecutorType = Literal["thread", "process"]
+# Format of the render-ready derivative: raw images (see :mod:`services.raw_image`) are mapped without decoding,
+# but take several times more space than PNG.
+RenderFormat = Literal["png", "raw"]
+ResizeQuality = Literal["exact", "balanced", "fast"]
+# For each quality: minimal size of decoded image relative to the target size (JPEG decoder can downscale by 2, 4 or 8)
+# and `reducing_gap` of :meth:`PIL.Image.Image.resize`. None disables the optimization.
+RESIZE_SETTINGS: dict[ResizeQuality, tuple[float | None, float | None]] = {
+    "exact": (None, None),
+    "balanced": (2.0, 3.0),
+    "fast": (1.0, 2.0),
+}
+
+T = TypeVar("T")
+
+# Smart mode looks for the most detailed region on a grayscale copy of at most this size.
+SALIENCY_SIZE = 256
+# Preference of the center, so a region with few details is not cropped to a corner.
+SALIENCY_CENTER_WEIGHT = 0.1
 
 logger = logging.getLogger(__name__)
 
 
-async def convert_image(
-    image: Image.Image, store: ObjectStore, resize_mode: str, save_name: str, target_size: tuple[int, int]
-) -> None:
-    stream = io.BytesIO()
+def _open(source: bytes | Path, formats: list[str] | None) -> Image.Image:
+    # Image from a file is decoded from disk, without reading the whole file into memory.
+    return Image.open(io.BytesIO(source) if isinstance(source, bytes) else source, formats=formats)
+
+
+def _saliency_map(image: Image.Image) -> np.ndarray:
+    """
+    Returns magnitude of brightness gradient: edges and textures are large, flat areas such as sky are close to zero.
+    """
+    pixels = np.asarray(image, dtype=np.float32)
+    edges = np.zeros_like(pixels)
+    edges[:, 1:] += np.abs(np.diff(pixels, axis=1))
+    edges[1:, :] += np.abs(np.diff(pixels, axis=0))
+    return edges
+
+
+def _best_window(profile: np.ndarray, window: int) -> int:
+    """
+    Returns the start of the window with the largest sum of the profile, slightly preferring the center.
+    """
+    cumsum = np.concatenate(([0.0], np.cumsum(profile, dtype=np.float64)))
+    sums = cumsum[window:] - cumsum[:-window]
+    if len(sums) > 1:
+        offsets = np.abs(np.linspace(-1.0, 1.0, len(sums)))
+        # One is negligible for any detailed region, but makes a flat image cropped at the center.
+        sums = (sums + 1) * (1 - SALIENCY_CENTER_WEIGHT * offsets)
+    return int(np.argmax(sums))
+
+
+def salient_box(saliency: np.ndarray, aspect_ratio: float) -> tuple[float, float, float, float]:
+    """
+    Returns the largest box of the aspect ratio (width / height) containing most of the saliency,
+    as fractions of the image size. Only one dimension is cropped, so the box touches two opposite borders.
+    """
+    height, width = saliency.shape
+    if width / height > aspect_ratio:
+        window = max(1, min(width, round(height * aspect_ratio)))
+        left = _best_window(saliency.sum(axis=0), window)
+        return left / width, 0.0, (left + window) / width, 1.0
+    window = max(1, min(height, round(width / aspect_ratio)))
+    top = _best_window(saliency.sum(axis=1), window)
+    return 0.0, top / height, 1.0, (top + window) / height
+
+
+def find_salient_box(
+    image: Image.Image, source: bytes | Path, formats: list[str] | None, aspect_ratio: float
+) -> tuple[float, float, float, float]:
+    """
+    Same as :func:`salient_box`, but for a decoded image. Takes a few tens of milliseconds for a 12 MP JPEG.
+    """
+    if image.format == "JPEG":
+        # Separate copy decoded at 1/8 of the size, while the image itself is decoded only for the final resize.
+        probe = _open(source, formats)
+        probe.draft("L", (SALIENCY_SIZE, SALIENCY_SIZE))
+    else:
+        probe = image
+    small = probe.convert("L")
+    small.thumbnail((SALIENCY_SIZE, SALIENCY_SIZE))
+    return salient_box(_saliency_map(small), aspect_ratio)
+
+
+def _smart_resize(
+    image: Image.Image,
+    source: bytes | Path,
+    formats: list[str] | None,
+    target_size: tuple[int, int],
+    quality: ResizeQuality,
+) -> Image.Image:
+    """
+    Crops the image to the aspect ratio of the target size keeping the most detailed region, then resizes it.
+    """
+    target_w, target_h = target_size
+    left, top, right, bottom = find_salient_box(image, source, formats, target_w / target_h)
+
+    draft_scale, reducing_gap = RESIZE_SETTINGS[quality]
+    if draft_scale is not None:
+        width, height = image.size
+        scale = draft_scale * max(target_w / ((right - left) * width), target_h / ((bottom - top) * height))
+        image.draft(None, (int(width * scale), int(height * scale)))
+    # Coordinates are relative, since the draft may have reduced the image.
+    width, height = image.size
+    box = (left * width, top * height, right * width, bottom * height)
+    return image.resize(target_size, box=box, reducing_gap=reducing_gap)
+
+
+def _resize(image: Image.Image, target_size: tuple[int, int], quality: ResizeQuality) -> Image.Image:
+    draft_scale, reducing_gap = RESIZE_SETTINGS[quality]
+    if draft_scale is not None:
+        # Image is not decoded yet, so the decoder may skip most of the pixels. Ignored by formats other than JPEG.
+        target_w, target_h = target_size
+        image.draft(None, (int(target_w * draft_scale), int(target_h * draft_scale)))
+    return image.resize(target_size, reducing_gap=reducing_gap)
+
+
+def _prepare(
+    source: bytes | Path,
+    resize_mode: str,
+    target_size: tuple[int, int],
+    formats: list[str] | None,
+    quality: ResizeQuality,
+) -> Image.Image:
+    image = _open(source, formats)
     target_w, target_h = target_size
     if resize_mode == "ignore":
-        image.save(stream, format=IMAGE_FORMAT)
+        return image
     elif resize_mode == "crop":
-        image = image.crop((0, 0, target_w, target_h))  # (x1, y1, x2, y2), >image.size = black
-        image.save(stream, format=IMAGE_FORMAT)
+        return image.crop((0, 0, target_w, target_h))  # (x1, y1, x2, y2), >image.size = black
     elif resize_mode == "resize":
-        image = image.resize((target_w, target_h))
-        image.save(stream, format=IMAGE_FORMAT)
+        return _resize(image, (target_w, target_h), quality)
+    elif resize_mode == "smart":
+        return _smart_resize(image, source, formats, (target_w, target_h), quality)
     else:
         raise ValueError(f"Unknown resize mode: {resize_mode}")
 
+
+def _save_derivatives(image: Image.Image, outputs: Mapping[str, IO[bytes]], render_format: RenderFormat) -> None:
+    image.load()
+    thumbnail = image.convert("RGB")
+    thumbnail.thumbnail(THUMBNAIL_SIZE)
+    thumbnail.save(outputs[THUMBNAIL_SUFFIX], format=THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY)
+    # Renderer drops the alpha channel anyway, and does so on every rendering unless it is dropped here.
+    render = image if image.mode == "RGB" else image.convert("RGB")
+    if render_format == "raw":
+        write_raw(render, outputs[RENDER_SUFFIX])
+    else:
+        render.save(outputs[RENDER_SUFFIX], format=IMAGE_FORMAT, compress_level=RENDER_COMPRESS_LEVEL)
+    image.save(outputs[""], format=IMAGE_FORMAT)
+
+
+def convert_derivatives(
+    data: bytes,
+    resize_mode: str,
+    target_size: tuple[int, int],
+    formats: list[str] | None = None,
+    quality: ResizeQuality = "balanced",
+    render_format: RenderFormat = "png",
+) -> dict[str, bytes]:
+    """
+    Decodes the image once and encodes all its derivatives, keyed by suffix of their object names.
+    The full image has an empty suffix and goes last, see :func:`_convert_and_store`.
+    """
+    outputs = {suffix: io.BytesIO() for suffix in DERIVATIVE_SUFFIXES}
+    _save_derivatives(_prepare(data, resize_mode, target_size, formats, quality), outputs, render_format)
+    return {suffix: stream.getvalue() for suffix, stream in outputs.items()}
+
+
+def convert_derivatives_to_files(
+    source: bytes | Path,
+    output_dir: Path,
+    resize_mode: str,
+    target_size: tuple[int, int],
+    formats: list[str] | None = None,
+    quality: ResizeQuality = "balanced",
+    render_format: RenderFormat = "png",
+) -> dict[str, Path]:
+    """
+    Same as :func:`convert_derivatives`, but derivatives are written to files in `output_dir`, so neither encoded
+    image is kept in memory, and only paths are passed back from a worker process.
+    """
+    paths = {suffix: output_dir / f"derivative{suffix}" for suffix in DERIVATIVE_SUFFIXES}
+    image = _prepare(source, resize_mode, target_size, formats, quality)
+    with ExitStack() as stack:
+        outputs = {suffix: stack.enter_context(path.open("wb")) for suffix, path in paths.items()}
+        _save_derivatives(image, outputs, render_format)
+    return paths
+
+
+class ConversionPool:
+    """
+    Runs conversions in the executor with at most `limit` conversions in progress, including downloading and storing.
+    `submit` waits for a free slot, so messages are left in NATS instead of piling up in memory.
+    """
+
+    def __init__(
+        self,
+        executor: Executor,
+        limit: int,
+        quality: ResizeQuality = "balanced",
+        render_format: RenderFormat = "png",
+    ):
+        self.executor = executor
+        self.limit = limit
+        self.quality = quality
+        self.render_format = render_format
+        self._slots = asyncio.Semaphore(limit)
+        self._tasks: set[asyncio.Task] = set()
+        self._active = 0
+
+    async def submit(self, job: Callable[[], Awaitable[None]]) -> None:
+        await self._slots.acquire()
+        self._active += 1
+        task = asyncio.create_task(self._run(job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def run(self, job: Callable[[], Awaitable[T]]) -> T:
+        """
+        Waits for a free slot and for the job itself, so parts of a larger job share the limit with other ones.
+        """
+        async with self._slots:
+            self._active += 1
+            try:
+                return await job()
+            finally:
+                self._active -= 1
+
+    async def _run(self, job: Callable[[], Awaitable[None]]) -> None:
+        try:
+            await job()
+        except Exception:
+            # Message is not acknowledged and will be redelivered.
+            logger.exception("Failed to convert image")
+        finally:
+            self._active -= 1
+            self._slots.release()
+
+    async def convert_derivatives_to_files(
+        self,
+        source: bytes | Path,
+        output_dir: Path,
+        resize_mode: str,
+        target_size: tuple[int, int],
+        formats: list[str] | None = None,
+    ) -> dict[str, Path]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor,
+            partial(
+                convert_derivatives_to_files,
+                source,
+                output_dir,
+                resize_mode,
+                target_size,
+                formats=formats,
+                quality=self.quality,
+                render_format=self.render_format,
+            ),
+        )
+
+    def in_progress(self) -> int:
+        return self._active
+
+    def free_slots(self) -> int:
+        return self.limit - self._active
+
+    async def drain(self) -> None:
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+async def _convert_and_store(
+    js: JetStreamContext,
+    store: ObjectStore,
+    pool: ConversionPool,
+    save_name: str,
+    resize_mode: str,
+    target_size: tuple[int, int],
+    source: bytes | Path,
+    formats: list[str] | None,
+    work_dir: Path,
+) -> bool:
+    """
+    Returns False if the image cannot be converted. Either way, the result is published for the bot.
+    """
+    try:
+        derivatives = await pool.convert_derivatives_to_files(
+            source, work_dir, resize_mode, target_size, formats=formats
+        )
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        # Broken or unsupported image fails on every attempt, so the message is not redelivered.
+        logger.warning("Cannot convert %s: %r", save_name, e)
+        await js.publish(ASSET_FAILED_SUBJECT_NAME, payload=repr(e).encode(), headers={SAVE_NAME_HEADER: save_name})
+        return False
     logging.debug("Converted %s", save_name)
-    await store.put(save_name, stream.getvalue())
+    full_image = derivatives[""]
+    content_bytes = full_image.stat().st_size
+    # Only the header is parsed here.
+    with Image.open(full_image) as image:
+        width, height = image.size
+    digest = await store_content(store, derivatives)
+    # The full image is linked last: its presence means the element is ready, so derivatives must exist by then.
+    await link_content(store, BUCKET_NAME, save_name, digest, list(derivatives))
+    logger.info("Stored %s as %s", save_name, content_name(digest))
+    await js.publish(
+        ASSET_STORED_SUBJECT_NAME,
+        headers={
+            SAVE_NAME_HEADER: save_name,
+            CONTENT_HASH_HEADER: digest,
+            IMAGE_SIZE_HEADER: json.dumps([width, height]),
+            CONTENT_BYTES_HEADER: str(content_bytes),
+        },
+    )
+    return True
+
+
+async def _convert_message(
+    msg: Msg,
+    data: bytes | None,
+    js: JetStreamContext,
+    store: ObjectStore,
+    pool: ConversionPool,
+    save_name: str,
+    resize_mode: str,
+    target_size: tuple[int, int],
+    bot: Bot | None = None,
+) -> None:
+    with tempfile.TemporaryDirectory(prefix=WORK_DIR_PREFIX) as work_dir:
+        source: bytes | Path
+        if data is None:
+            assert bot is not None
+            # Downloaded file is streamed to disk instead of memory.
+            source = Path(work_dir, "upload")
+            await bot.download(msg.data.decode(), destination=source)
+            formats = None
+        else:
+            source = data
+            formats = [IMAGE_FORMAT]
+        await _convert_and_store(js, store, pool, save_name, resize_mode, target_size, source, formats, Path(work_dir))
+    # Acknowledged only after the result is stored, so the message is redelivered if anything fails before.
+    await msg.ack()
+
+
+def _extract_member(archive: Path, member: str, destination: Path) -> None:
+    # Members are copied in chunks, and cannot be larger than their declared size.
+    with zipfile.ZipFile(archive) as zip_file, zip_file.open(member) as source, destination.open("wb") as target:
+        shutil.copyfileobj(source, target)
+
+
+async def _convert_batch_item(
+    msg: Msg,
+    item: dict[str, Any],
+    js: JetStreamContext,
+    store: ObjectStore,
+    pool: ConversionPool,
+    bot: Bot,
+    archives: dict[str, Path],
+    work_dir: Path,
+) -> bool:
+    save_name = item["save_name"]
+    try:
+        work_dir.mkdir()
+        source = work_dir / "upload"
+        if (member := item.get("member")) is None:
+            await bot.download(item["file_id"], destination=source)
+        else:
+            await asyncio.to_thread(_extract_member, archives[item["file_id"]], member, source)
+        target_w, target_h = cast(list[int], item["target_size"])
+        return await _convert_and_store(
+            js, store, pool, save_name, item["resize_mode"], (target_w, target_h), source, None, work_dir
+        )
+    except Exception as e:
+        # Redelivery would convert the whole batch again, so the item is reported as failed instead.
+        logger.exception("Failed to convert %s", save_name)
+        await js.publish(ASSET_FAILED_SUBJECT_NAME, payload=repr(e).encode(), headers={SAVE_NAME_HEADER: save_name})
+        return False
+    finally:
+        # Large batches take longer than the acknowledgement timeout.
+        await msg.in_progress()
+
 
+async def _convert_batch(msg: Msg, js: JetStreamContext, store: ObjectStore, pool: ConversionPool, bot: Bot) -> None:
+    items = cast(list[dict[str, Any]], json.loads(msg.data)["items"])
+    with tempfile.TemporaryDirectory(prefix=WORK_DIR_PREFIX) as work_dir:
+        # Each archive is downloaded once for all its members.
+        archives: dict[str, Path] = {}
+        for item in items:
+            file_id = item["file_id"]
+            if item.get("member") is not None and file_id not in archives:
+                archives[file_id] = Path(work_dir, f"archive{len(archives)}.zip")
+                await bot.download(file_id, destination=archives[file_id])
+                # A large archive may take most of the acknowledgement timeout before any item is converted.
+                await msg.in_progress()
 
-async def convert_raw_handler(msg: Msg, store: ObjectStore) -> None:
+        results = await asyncio.gather(
+            *(
+                pool.run(
+                    partial(_convert_batch_item, msg, item, js, store, pool, bot, archives, Path(work_dir, str(i)))
+                )
+                for i, item in enumerate(items)
+            )
+        )
+    summary = {
+        "stored": [item["save_name"] for item, stored in zip(items, results) if stored],
+        "failed": [item["save_name"] for item, stored in zip(items, results) if not stored],
+    }
+    logger.info("Batch converted: %d stored, %d failed", len(summary["stored"]), len(summary["failed"]))
+    # Identifiers of the job are returned as is, so the bot knows whom to notify.
+    headers = {key: value for key, value in (msg.headers or {}).items() if key in (BATCH_ID_HEADER, CHAT_ID_HEADER)}
+    await js.publish(BATCH_DONE_SUBJECT_NAME, payload=json.dumps(summary).encode(), headers=headers)
+    await msg.ack()
+
+
+async def convert_raw_handler(msg: Msg, js: JetStreamContext, store: ObjectStore, pool: ConversionPool) -> None:
     if msg.headers is None:
         logger.error("Got message without headers")
         raise ValueError("Headers are required for message processing")
@@ -61,13 +500,14 @@ async def convert_raw_handler(msg: Msg, store: ObjectStore) -> None:
     target_w, target_h = cast(list[int], json.loads(msg.headers[TARGET_SIZE_HEADER]))
 
     logger.info("Converting %s with mode %s", save_name, resize_mode)
-
-    image: Image.Image = Image.open(io.BytesIO(msg.data), formats=[IMAGE_FORMAT])
-    await convert_image(image, store, resize_mode, save_name, target_size=(target_w, target_h))
-    await msg.ack()
+    await pool.submit(
+        partial(_convert_message, msg, msg.data, js, store, pool, save_name, resize_mode, (target_w, target_h))
+    )
 
 
-async def convert_file_id_handler(msg: Msg, store: ObjectStore, bot: Bot) -> None:
+async def convert_file_id_handler(
+    msg: Msg, js: JetStreamContext, store: ObjectStore, bot: Bot, pool: ConversionPool
+) -> None:
     if msg.headers is None:
         logger.error("Got message without headers")
         raise ValueError("Headers are required for message processing")
@@ -77,32 +517,132 @@ async def convert_file_id_handler(msg: Msg, store: ObjectStore, bot: Bot) -> Non
     target_w, target_h = cast(list[int], json.loads(msg.headers[TARGET_SIZE_HEADER]))
 
     logger.info("Converting %s with mode %s", save_name, resize_mode)
+    await pool.submit(
+        partial(_convert_message, msg, None, js, store, pool, save_name, resize_mode, (target_w, target_h), bot=bot)
+    )
 
-    file_id = msg.data.decode()
-    file = await bot.download(file_id)
-    assert file is not None, "image loaded to file system"
-    image = Image.open(file)
 
-    await convert_image(image, store, resize_mode, save_name, target_size=(target_w, target_h))
-    await msg.ack()
+async def convert_batch_handler(
+    msg: Msg, js: JetStreamContext, store: ObjectStore, bot: Bot, pool: ConversionPool
+) -> None:
+    """
+    Batches are handled one at a time, and their items are converted in parallel within the limit of the pool.
+    """
+    logger.info("Converting batch %s", (msg.headers or {}).get(BATCH_ID_HEADER))
+    await _convert_batch(msg, js, store, pool, bot)
 
 
-async def convert_loop(js: JetStreamContext, bot: Bot, shutdown_event: asyncio.Event | None = None):
+def create_executor(executor_type: ExecutorType, workers: int) -> Executor:
+    if executor_type == "process":
+        return ProcessPoolExecutor(max_workers=workers)
+    return ThreadPoolExecutor(max_workers=workers)
+
+
+@dataclass
+class ConsumerStats:
+    fetched: int = 0
+    # Messages left in the stream for the consumer, as of the last fetch.
+    pending: int = 0
+
+
+async def _pull_subscribe(js: JetStreamContext, subject: str, durable: str) -> JetStreamContext.PullSubscription:
+    """
+    Consumers used to be push-based, and a durable consumer cannot change its kind. The old one is deleted:
+    the stream is a work queue, so unacknowledged messages stay there and are delivered to the new consumer.
+    """
+    stream = await js.find_stream_name_by_subject(subject)
+    try:
+        info = await js.consumer_info(stream, durable)
+    except NotFoundError:
+        pass
+    else:
+        if info.config.deliver_subject is not None:
+            logger.warning("Replacing push consumer %s with a pull one", durable)
+            await js.delete_consumer(stream, durable)
+    return await js.pull_subscribe(subject, durable=durable)
+
+
+async def consume(
+    sub: JetStreamContext.PullSubscription,
+    handler: Callable[[Msg], Awaitable[None]],
+    pool: ConversionPool,
+    stats: ConsumerStats,
+    batch_size: int,
+    fetch_timeout: float = FETCH_TIMEOUT,
+) -> None:
+    """
+    Fetches messages in batches until cancelled and handles them in order. A batch is not larger than the number
+    of free slots of the pool, which is enough while the handler only waits for a slot. A handler which waits
+    for the whole conversion must be used with `batch_size=1`, otherwise the rest of the batch would wait
+    for it while their acknowledgement timeout is running.
+    """
+    while True:
+        try:
+            messages = await sub.fetch(max(1, min(batch_size, pool.free_slots())), timeout=fetch_timeout)
+        except nats.errors.TimeoutError:
+            stats.pending = 0
+            continue
+        stats.fetched += len(messages)
+        stats.pending = messages[-1].metadata.num_pending
+        for msg in messages:
+            try:
+                # Waits for a free slot of the pool, which is shared by all consumers.
+                await handler(msg)
+            except Exception:
+                # Message is not acknowledged and will be redelivered.
+                logger.exception("Cannot handle message from %s", msg.subject)
+
+
+async def convert_loop(
+    js: JetStreamContext,
+    bot: Bot,
+    shutdown_event: asyncio.Event | None = None,
+    executor_type: ExecutorType = "thread",
+    workers: int = 1,
+    concurrency: int = 2,
+    quality: ResizeQuality = "balanced",
+    render_format: RenderFormat = "png",
+    fetch_batch: int | None = None,
+    stats_interval: float = 60.0,
+):
     store = await js.object_store(BUCKET_NAME)
-    await js.subscribe(
-        CONVERT_RAW_SUBJECT_NAME,
-        cb=partial(convert_raw_handler, store=store),
-        durable="converter_raw",
-        manual_ack=True,
-    )
-    await js.subscribe(
-        CONVERT_FILE_ID_SUBJECT_NAME,
-        cb=partial(convert_file_id_handler, store=store, bot=bot),
-        durable="converter_file_id",
-        manual_ack=True,
-    )
+    executor = create_executor(executor_type, workers)
+    pool = ConversionPool(executor, concurrency, quality, render_format)
+    batch_size = fetch_batch or concurrency
+    consumers: dict[str, tuple[str, Callable[[Msg], Awaitable[None]], int]] = {
+        "converter_raw": (
+            CONVERT_RAW_SUBJECT_NAME,
+            partial(convert_raw_handler, js=js, store=store, pool=pool),
+            batch_size,
+        ),
+        "converter_file_id": (
+            CONVERT_FILE_ID_SUBJECT_NAME,
+            partial(convert_file_id_handler, js=js, store=store, bot=bot, pool=pool),
+            batch_size,
+        ),
+        # Batch handler returns only when the whole batch is converted.
+        "converter_batch": (
+            CONVERT_BATCH_SUBJECT_NAME,
+            partial(convert_batch_handler, js=js, store=store, bot=bot, pool=pool),
+            1,
+        ),
+    }
+    stats = {durable: ConsumerStats() for durable in consumers}
+    consume_tasks = []
+    for durable, (subject, handler, size) in consumers.items():
+        sub = await _pull_subscribe(js, subject, durable)
+        consume_tasks.append(asyncio.create_task(consume(sub, handler, pool, stats[durable], size)))
     logger.info("Connected to NATS")
 
+    def snapshot() -> dict[str, int]:
+        values = {"in_flight": pool.in_progress(), "free_slots": pool.free_slots()}
+        for durable, consumer_stats in stats.items():
+            values[f"{durable}.fetched"] = consumer_stats.fetched
+            values[f"{durable}.pending"] = consumer_stats.pending
+        return values
+
+    stats_task = start_stats_task("converter", snapshot, stats_interval)
+
     if shutdown_event is None:
         shutdown_event = Event()
 
@@ -112,23 +652,78 @@ async def convert_loop(js: JetStreamContext, bot: Bot, shutdown_event: asyncio.E
     except asyncio.CancelledError:
         logger.debug("Main task was cancelled")
     logger.warning("Exiting main task")
+    if stats_task is not None:
+        stats_task.cancel()
+    for task in consume_tasks:
+        task.cancel()
+    await pool.drain()
+    executor.shutdown()
 
 
-async def main(token: str, servers: str = "nats://localhost:4222"):
+async def main(
+    token: str,
+    servers: str = "nats://localhost:4222",
+    executor_type: ExecutorType = "thread",
+    workers: int = 1,
+    concurrency: int = 2,
+    quality: ResizeQuality = "balanced",
+    render_format: RenderFormat = "png",
+    fetch_batch: int | None = None,
+    stats_interval: float = 60.0,
+):
     nc = await nats.connect(servers=servers)
     js = nc.jetstream()
     bot = Bot(token, default=DefaultBotProperties(parse_mode="HTML"))
-    await convert_loop(js, bot)
+    await convert_loop(
+        js,
+        bot,
+        executor_type=executor_type,
+        workers=workers,
+        concurrency=concurrency,
+        quality=quality,
+        render_format=render_format,
+        fetch_batch=fetch_batch,
+        stats_interval=stats_interval,
+    )
     await nc.close()
 
 
 def entry():
     bot_token = os.getenv("TOKEN")
     nats_servers_ = os.getenv("NATS_SERVERS")
+    executor_type_ = os.getenv("CONVERTER_EXECUTOR") or "thread"
+    workers_ = int(os.getenv("CONVERTER_WORKERS") or os.cpu_count() or 1)
+    # Some conversions wait for downloading or storing, so a few more of them are allowed than there are workers.
+    concurrency_ = int(os.getenv("CONVERTER_CONCURRENCY") or 2 * workers_)
+    quality_ = os.getenv("CONVERTER_RESIZE_QUALITY") or "balanced"
+    render_format_ = os.getenv("CONVERTER_RENDER_FORMAT") or "png"
+    fetch_batch_ = int(os.getenv("CONVERTER_FETCH_BATCH") or concurrency_)
+    stats_interval_ = float(os.getenv("STATS_INTERVAL") or 60)
     if bot_token is None:
         logger.critical("Cannot run without bot token")
         exit(1)
     if nats_servers_ is None:
         logger.critical("Cannot run without nats url")
         exit(1)
-    asyncio.run(main(bot_token, nats_servers_))
+    if executor_type_ not in ("thread", "process"):
+        logger.critical("Unknown executor type: %s", executor_type_)
+        exit(1)
+    if quality_ not in RESIZE_SETTINGS:
+        logger.critical("Unknown resize quality: %s", quality_)
+        exit(1)
+    if render_format_ not in get_args(RenderFormat):
+        logger.critical("Unknown render format: %s", render_format_)
+        exit(1)
+    asyncio.run(
+        main(
+            bot_token,
+            nats_servers_,
+            cast(ExecutorType, executor_type_),
+            workers_,
+            concurrency_,
+            cast(ResizeQuality, quality_),
+            cast(RenderFormat, render_format_),
+            fetch_batch_,
+            stats_interval_,
+        )
+    )
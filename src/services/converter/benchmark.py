@@ -0,0 +1,323 @@
+"""
+Benchmarks of conversion. Run as `python -m services.converter.benchmark --help`.
+NATS is not required: uploads are generated in memory or read from files, results are discarded.
+"""
+
+import argparse
+import asyncio
+import io
+import multiprocessing
+import random
+import statistics
+import tempfile
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Awaitable, Callable, get_args
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+from services.converter import (
+    IMAGE_FORMAT,
+    WORK_DIR_PREFIX,
+    ConversionPool,
+    ResizeQuality,
+    convert_derivatives,
+    convert_derivatives_to_files,
+    create_executor,
+    find_salient_box,
+)
+
+PHONE_PHOTO_SIZE = (4032, 3024)
+
+
+def _make_upload(size: tuple[int, int], seed: int) -> bytes:
+    stream = io.BytesIO()
+    Image.effect_noise(size, 32 + seed).convert("RGB").save(stream, format=IMAGE_FORMAT)
+    return stream.getvalue()
+
+
+async def _measure_lag(stop: asyncio.Event, interval: float = 0.005) -> float:
+    """
+    Returns the longest time the event loop was blocked while the benchmark was running.
+    """
+    max_lag = 0.0
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        max_lag = max(max_lag, time.perf_counter() - start - interval)
+    return max_lag
+
+
+async def _run(
+    uploads: list[bytes],
+    args: argparse.Namespace,
+    convert: Callable[[bytes], Awaitable[object]],
+    pool: ConversionPool | None = None,
+) -> tuple[float, float]:
+    """
+    Without a pool, uploads are processed one by one, as push subscription callbacks are.
+    """
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(_measure_lag(stop))
+
+    async def job(data: bytes) -> None:
+        await convert(data)
+        await asyncio.sleep(args.store_delay)
+
+    start = time.perf_counter()
+    for data in uploads:
+        if pool is None:
+            await job(data)
+        else:
+            await pool.submit(partial(job, data))
+    if pool is not None:
+        await pool.drain()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    return elapsed, await lag_task
+
+
+async def benchmark_throughput(args: argparse.Namespace) -> None:
+    size = tuple(args.size)
+    target = tuple(args.target)
+    uploads = [_make_upload(size, i) for i in range(args.uploads)]
+    print(f"{len(uploads)} uploads of {size[0]}x{size[1]}, {sum(map(len, uploads)) / 2**20:.1f} MB in total")
+    print(f"{'mode':10} {'workers':>7} {'images/s':>9} {'max loop lag, ms':>17}")
+
+    async def inline(data: bytes) -> dict[str, Path]:
+        # Conversion in the event loop, as it was done before the worker pool.
+        with tempfile.TemporaryDirectory(prefix=WORK_DIR_PREFIX) as work_dir:
+            return convert_derivatives_to_files(data, Path(work_dir), args.mode, target)
+
+    modes: list[tuple[str, int, Executor | None]] = [("inline", 1, None)]
+    for executor_type in ("thread", "process"):
+        for workers in args.workers:
+            modes.append((executor_type, workers, create_executor(executor_type, workers)))
+
+    for name, workers, executor in modes:
+        pool: ConversionPool | None = None
+        convert = inline
+        if executor is not None:
+            pool = ConversionPool(executor, 2 * workers)
+
+            async def convert(data: bytes, pool: ConversionPool = pool) -> dict[str, Path]:
+                # Derivatives are written to files, as the service does.
+                with tempfile.TemporaryDirectory(prefix=WORK_DIR_PREFIX) as work_dir:
+                    return await pool.convert_derivatives_to_files(data, Path(work_dir), args.mode, target)
+
+            # Starts processes in advance, so their startup is not measured.
+            await convert(uploads[0])
+
+        elapsed, lag = await _run(uploads, args, convert, pool)
+        print(f"{name:10} {workers:7} {len(uploads) / elapsed:9.2f} {lag * 1000:17.1f}")
+        if executor is not None:
+            executor.shutdown()
+
+
+def _make_photo(size: tuple[int, int], seed: int) -> bytes:
+    """
+    Generates a JPEG resembling a phone photo: smooth color areas with sharp edges and sensor noise.
+    """
+    rng = random.Random(seed)
+    image = Image.linear_gradient("L").resize(size).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    width, height = size
+    for _ in range(40):
+        x, y = rng.randrange(width), rng.randrange(height)
+        r = rng.randrange(width // 20, width // 4)
+        color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=color)
+    image = image.filter(ImageFilter.GaussianBlur(2))
+    noise = Image.effect_noise(size, 20).convert("RGB")
+    image = Image.blend(image, noise, 0.1)
+    stream = io.BytesIO()
+    image.save(stream, format="jpeg", quality=90)
+    return stream.getvalue()
+
+
+def _convert(data: bytes, resize_mode: str, target: tuple[int, int], quality: ResizeQuality = "balanced") -> bytes:
+    """
+    Converts the image as the service does, with all derivatives written to files, and returns the full image.
+    """
+    with tempfile.TemporaryDirectory(prefix=WORK_DIR_PREFIX) as work_dir:
+        paths = convert_derivatives_to_files(data, Path(work_dir), resize_mode, target, quality=quality)
+        return paths[""].read_bytes()
+
+
+def _peak_memory() -> int:
+    """
+    Returns peak resident memory of the current process in bytes. Unlike `ru_maxrss`, it is reset by exec,
+    so a spawned process does not inherit the peak of its parent.
+    """
+    for line in Path("/proc/self/status").read_text().splitlines():
+        if line.startswith("VmHWM:"):
+            return int(line.split()[1]) * 1024
+    raise RuntimeError("Peak memory is not available")
+
+
+def _measure_resize(
+    data: bytes, target: tuple[int, int], quality: ResizeQuality, repeats: int
+) -> tuple[float, int, bytes]:
+    """
+    Runs in a fresh process, so the peak memory is not affected by previous conversions.
+    """
+    before = _peak_memory()
+    timings = []
+    result = b""
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = _convert(data, "resize", target, quality)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), _peak_memory() - before, result
+
+
+def _box_filter(values: np.ndarray, window: int) -> np.ndarray:
+    cumsum = values.cumsum(axis=0).cumsum(axis=1)
+    cumsum = np.pad(cumsum, ((1, 0), (1, 0)))
+    total = (
+        cumsum[window:, window:] - cumsum[:-window, window:] - cumsum[window:, :-window] + cumsum[:-window, :-window]
+    )
+    return total / window**2
+
+
+def ssim(first: Image.Image, second: Image.Image, window: int = 7) -> float:
+    """
+    Mean structural similarity of luminance, computed with a uniform window.
+    """
+    x = np.asarray(first.convert("L"), dtype=np.float64)
+    y = np.asarray(second.convert("L"), dtype=np.float64)
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    mu_x, mu_y = _box_filter(x, window), _box_filter(y, window)
+    var_x = _box_filter(x * x, window) - mu_x**2
+    var_y = _box_filter(y * y, window) - mu_y**2
+    covariance = _box_filter(x * y, window) - mu_x * mu_y
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * covariance + c2)) / ((mu_x**2 + mu_y**2 + c1) * (var_x + var_y + c2))
+    return float(ssim_map.mean())
+
+
+async def benchmark_resize(args: argparse.Namespace) -> None:
+    target = tuple(args.target)
+    if args.photos:
+        photos = [(path.name, path.read_bytes()) for path in args.photos]
+    else:
+        photos = [(f"synthetic-{i}.jpg", _make_photo(tuple(args.size), i)) for i in range(args.uploads)]
+    print(f"{'photo':20} {'quality':8} {'time, ms':>9} {'peak memory, MB':>16} {'SSIM':>7}")
+    context = multiprocessing.get_context("spawn")
+    loop = asyncio.get_running_loop()
+    for name, data in photos:
+        reference: Image.Image | None = None
+        # The exact quality goes first, since its output is the same as before and is used as the reference.
+        for quality in get_args(ResizeQuality):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                elapsed, peak, result = await loop.run_in_executor(
+                    executor, _measure_resize, data, target, quality, args.repeats
+                )
+            output = Image.open(io.BytesIO(result))
+            reference = reference or output
+            similarity = ssim(reference, output)
+            print(f"{name:20} {quality:8} {elapsed * 1000:9.1f} {peak / 2**20:16.1f} {similarity:7.4f}")
+
+
+def _measure_spill(path: Path, target: tuple[int, int], to_files: bool) -> tuple[float, int]:
+    """
+    Converts a downloaded file as the service did before (reading it into memory) or does now (from and to disk).
+    """
+    before = _peak_memory()
+    start = time.perf_counter()
+    if to_files:
+        with tempfile.TemporaryDirectory() as output_dir:
+            convert_derivatives_to_files(path, Path(output_dir), "resize", target)
+    else:
+        convert_derivatives(path.read_bytes(), "resize", target)
+    return time.perf_counter() - start, _peak_memory() - before
+
+
+async def benchmark_spill(args: argparse.Namespace) -> None:
+    target = tuple(args.target)
+    print(f"{'upload':12} {'file, MB':>9} {'mode':7} {'time, ms':>9} {'peak memory, MB':>16}")
+    context = multiprocessing.get_context("spawn")
+    loop = asyncio.get_running_loop()
+    with tempfile.TemporaryDirectory() as work_dir:
+        for image_format in ("jpeg", "png"):
+            path = Path(work_dir, f"upload.{image_format}")
+            photo = Image.open(io.BytesIO(_make_photo(tuple(args.size), 0)))
+            photo.save(path, format=image_format)
+            for mode in ("memory", "disk"):
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    elapsed, peak = await loop.run_in_executor(executor, _measure_spill, path, target, mode == "disk")
+                size = path.stat().st_size / 2**20
+                print(f"{image_format:12} {size:9.1f} {mode:7} {elapsed * 1000:9.1f} {peak / 2**20:16.1f}")
+
+
+def _time_median(func: Callable[[], object], repeats: int) -> float:
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+async def benchmark_smart(args: argparse.Namespace) -> None:
+    target = tuple(args.target)
+    if args.photos:
+        photos = [(path.name, path.read_bytes()) for path in args.photos]
+    else:
+        photos = []
+        for i in range(args.uploads):
+            jpeg = _make_photo(tuple(args.size), i)
+            stream = io.BytesIO()
+            Image.open(io.BytesIO(jpeg)).save(stream, format="png")
+            photos += [(f"synthetic-{i}.jpg", jpeg), (f"synthetic-{i}.png", stream.getvalue())]
+    aspect_ratio = target[0] / target[1]
+    print(f"{'photo':20} {'saliency, ms':>13} {'resize, ms':>11} {'smart, ms':>10} {'box':>24}")
+    for name, data in photos:
+        # For formats other than JPEG, the saliency pass includes decoding, which is needed for resizing anyway.
+        saliency = _time_median(
+            lambda: find_salient_box(Image.open(io.BytesIO(data)), data, None, aspect_ratio), args.repeats
+        )
+        box = find_salient_box(Image.open(io.BytesIO(data)), data, None, aspect_ratio)
+        resize = _time_median(lambda: _convert(data, "resize", target), args.repeats)
+        smart = _time_median(lambda: _convert(data, "smart", target), args.repeats)
+        box_str = ",".join(f"{value:.2f}" for value in box)
+        print(f"{name:20} {saliency * 1000:13.1f} {resize * 1000:11.1f} {smart * 1000:10.1f} {box_str:>24}")
+
+
+def entry():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--uploads", type=int, default=16)
+    parser.add_argument("--target", type=int, nargs=2, default=(1920, 1098), help="Target size of conversion")
+    subparsers = parser.add_subparsers(required=True)
+
+    throughput = subparsers.add_parser("throughput", help="Compare throughput of conversion with concurrent uploads")
+    throughput.add_argument("--size", type=int, nargs=2, default=(2560, 1440), help="Size of uploaded images")
+    throughput.add_argument("--mode", choices=("resize", "smart", "crop", "ignore"), default="resize")
+    throughput.add_argument("--workers", type=int, nargs="+", default=(1, 2, 4))
+    throughput.add_argument("--store-delay", type=float, default=0.05, help="Simulated time of storing, in seconds")
+    throughput.set_defaults(func=benchmark_throughput)
+
+    resize = subparsers.add_parser("resize", help="Compare time, memory and quality of resize settings")
+    resize.add_argument("photos", type=Path, nargs="*", help="Photos to resize, synthetic ones are used by default")
+    resize.add_argument("--size", type=int, nargs=2, default=PHONE_PHOTO_SIZE, help="Size of synthetic photos")
+    resize.add_argument("--repeats", type=int, default=3)
+    resize.set_defaults(func=benchmark_resize)
+
+    smart = subparsers.add_parser("smart", help="Measure time of finding salient region for the smart mode")
+    smart.add_argument("photos", type=Path, nargs="*", help="Photos to crop, synthetic ones are used by default")
+    smart.add_argument("--size", type=int, nargs=2, default=PHONE_PHOTO_SIZE, help="Size of synthetic photos")
+    smart.add_argument("--repeats", type=int, default=5)
+    smart.set_defaults(func=benchmark_smart)
+
+    spill = subparsers.add_parser("spill", help="Compare peak memory of conversion in memory and from disk")
+    spill.add_argument("--size", type=int, nargs=2, default=PHONE_PHOTO_SIZE, help="Size of uploaded photo")
+    spill.set_defaults(func=benchmark_spill)
+
+    args = parser.parse_args()
+    asyncio.run(args.func(args))
+
+
+if __name__ == "__main__":
+    entry()
@@ -0,0 +1,78 @@
+"""
+Content-addressed storage of converted images. Each unique image is stored once under the hash of its full version,
+and element objects are links to it, so identical uploads do not take space in the object store.
+"""
+
+import asyncio
+import hashlib
+import logging
+from pathlib import Path
+from typing import Mapping
+
+from nats.js.api import ObjectLink, ObjectMeta, ObjectMetaOptions
+from nats.js.errors import ObjectNotFoundError
+from nats.js.object_store import ObjectStore
+
+CONTENT_PREFIX = "sha256."
+# Chunk size of links does not matter, but the client requires it to be set.
+LINK_CHUNK_SIZE = 128 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+def content_hash(data: bytes | Path) -> str:
+    if isinstance(data, bytes):
+        return hashlib.sha256(data).hexdigest()
+    with data.open("rb") as file:
+        return hashlib.file_digest(file, "sha256").hexdigest()
+
+
+def content_name(digest: str) -> str:
+    return f"{CONTENT_PREFIX}{digest}"
+
+
+async def store_content(store: ObjectStore, derivatives: Mapping[str, bytes | Path]) -> str:
+    """
+    Stores derivatives under the hash of the full image unless they are already stored, returns the hash.
+    As with element objects, the full image is stored last and marks that all derivatives are present.
+    Derivatives saved to files are streamed to the store chunk by chunk.
+    """
+    digest = await asyncio.to_thread(content_hash, derivatives[""])
+    name = content_name(digest)
+    try:
+        await store.get_info(name)
+    except ObjectNotFoundError:
+        for suffix, data in derivatives.items():
+            if isinstance(data, bytes):
+                await store.put(f"{name}{suffix}", data)
+            else:
+                with data.open("rb") as file:
+                    await store.put(f"{name}{suffix}", file)
+    else:
+        logger.info("Content %s is already stored", name)
+    return digest
+
+
+async def link_content(store: ObjectStore, bucket: str, save_name: str, digest: str, suffixes: list[str]) -> None:
+    """
+    Makes `save_name` with every suffix a link to the content stored in the same bucket.
+    Links are followed by `ObjectStore.get`, but `ObjectStore.get_info` returns the link itself.
+    """
+    name = content_name(digest)
+    for suffix in suffixes:
+        options = ObjectMetaOptions(
+            link=ObjectLink(bucket=bucket, name=f"{name}{suffix}"), max_chunk_size=LINK_CHUNK_SIZE
+        )
+        await store.put(f"{save_name}{suffix}", b"", meta=ObjectMeta(name=f"{save_name}{suffix}", options=options))
+
+
+async def delete_objects(store: ObjectStore, name: str, suffixes: list[str]) -> None:
+    """
+    Deletes the object with every suffix. Missing ones are skipped, so elements stored before derivatives
+    or partially deleted ones may be deleted as well.
+    """
+    for suffix in suffixes:
+        try:
+            await store.delete(f"{name}{suffix}")
+        except ObjectNotFoundError:
+            pass
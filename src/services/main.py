@@ -18,11 +18,14 @@ from fluentogram import TranslatorHub, TranslatorRunner
 from nats.js import JetStreamContext
 from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 
+from app.asset_events import setup_asset_events
 from app.dialogs import all_dialogs
 from app.dialogs.states import MainMenuStates
+from app.dialogs.templates import TEMPLATE_COST_LIMIT_KEY
 from app.dialogs.utils import BotAwareMessageManager
 from app.handlers.commands import commands_router, set_commands
 from app.i18n import all_translator_locales, create_translator_hub, root_locale
+from app.middlewares.album import AlbumMiddleware
 from app.middlewares.blacklist import BlacklistMiddleware
 from app.middlewares.db_session import DbSessionMiddleware
 from app.middlewares.i18n import TranslatorRunnerMiddleware
@@ -79,6 +82,8 @@ async def setup_middlewares(
     tr_middleware = TranslatorRunnerMiddleware(hub)
     bl_middleware = BlacklistMiddleware()
 
+    # Outer middleware, so messages of a media group except the first one are dropped before anything else.
+    dp.message.outer_middleware(AlbumMiddleware())
     dp.message.middleware(db_middleware)
     dp.message.middleware(bl_middleware)
     dp.message.middleware(tr_middleware)
@@ -105,6 +110,7 @@ async def main(
     source_code_url: str,
     log_level: str = "WARNING",
     admin_id: int = -1,
+    template_cost_limit: float = 0.0,
 ) -> None:
     session_pool = await setup_db(db_url, admin_id, log_level)
     logging.info("Connected to DB")
@@ -126,10 +132,12 @@ async def main(
     dp.shutdown.register(_shutdown)
 
     dp["primary_admin_id"] = admin_id
+    dp[TEMPLATE_COST_LIMIT_KEY] = template_cost_limit
 
     logging.info("Setting up bot...")
     bot = Bot(token, default=DefaultBotProperties(parse_mode="HTML"))
     await set_commands(bot, hub=hub, locales=hub_locales, root_locale=root_locale())
+    await setup_asset_events(js, session_pool, bot, hub, root_locale())
     await bot.delete_webhook(drop_pending_updates=True)
 
     logging.info("Starting bot...")
@@ -142,6 +150,7 @@ def entry():
     admin_tg_id = int(os.getenv("ADMIN_ID") or -1)
     nats_servers_ = os.getenv("NATS_SERVERS")
     source_code_url_ = os.getenv("SOURCE_CODE_URL")
+    template_cost_limit_ = float(os.getenv("TEMPLATE_COST_LIMIT_MS") or 0)
     if bot_token is None:
         logging.critical("Cannot run without bot token")
         exit(2)
@@ -168,6 +177,7 @@ def entry():
             log_level=log_level_,
             admin_id=admin_tg_id,
             source_code_url=source_code_url_,
+            template_cost_limit=template_cost_limit_,
         )
     )
 
@@ -0,0 +1,82 @@
+"""
+Uncompressed image format which can be memory-mapped and used by Pillow without any decoding.
+
+Layout is a fixed 32-byte header (magic, mode, width, height) followed by pixel rows exactly as Pillow keeps them
+in memory, so :func:`PIL.Image.frombuffer` shares the buffer instead of copying it.
+"""
+
+import struct
+from typing import IO
+
+from PIL import Image
+
+MAGIC = b"SCHRAW01"
+# magic, mode, width, height, padding
+_HEADER = struct.Struct("<8s8sII8x")
+HEADER_SIZE = _HEADER.size
+
+# Pillow keeps RGB images with 4 bytes per pixel, so RGB is stored as RGBX to make mapping possible.
+MAPPABLE_MODES = ("L", "RGBA", "RGBX")
+# Rows copied at once by :func:`write_raw`.
+WRITE_ROWS = 64
+
+
+def to_mappable(image: Image.Image) -> Image.Image:
+    if image.mode in MAPPABLE_MODES:
+        return image
+    if image.mode in ("RGB", "CMYK", "YCbCr"):
+        return image.convert("RGBX")
+    return image.convert("RGBA")
+
+
+def raw_size(image: Image.Image) -> int:
+    width, height = image.size
+    bytes_per_pixel = 1 if image.mode == "L" else 4
+    return HEADER_SIZE + width * height * bytes_per_pixel
+
+
+def encode_header(image: Image.Image) -> bytes:
+    if image.mode not in MAPPABLE_MODES:
+        raise ValueError(f"Mode {image.mode} cannot be stored as raw image")
+    width, height = image.size
+    return _HEADER.pack(MAGIC, image.mode.encode(), width, height)
+
+
+def encode_raw(image: Image.Image) -> bytes:
+    image = to_mappable(image)
+    return encode_header(image) + image.tobytes("raw", image.mode)
+
+
+def write_raw(image: Image.Image, stream: IO[bytes]) -> None:
+    """
+    Same as :func:`encode_raw`, but pixels are written in strips, so the whole encoded image is never in memory.
+    """
+    image = to_mappable(image)
+    stream.write(encode_header(image))
+    width, height = image.size
+    for top in range(0, height, WRITE_ROWS):
+        stream.write(image.crop((0, top, width, min(top + WRITE_ROWS, height))).tobytes("raw", image.mode))
+
+
+def is_raw(buffer: bytes | memoryview) -> bool:
+    return bytes(buffer[: len(MAGIC)]) == MAGIC
+
+
+def decode_raw(buffer: bytes | bytearray | memoryview) -> Image.Image:
+    """
+    Returns image sharing memory with the buffer (read-only if the buffer is so).
+    The buffer must stay unchanged while the image is used.
+    """
+    if len(buffer) < HEADER_SIZE:
+        raise ValueError("Buffer is too small for a raw image")
+    magic, mode_bytes, width, height = _HEADER.unpack_from(buffer)
+    if magic != MAGIC:
+        raise ValueError("Not a raw image")
+    mode = mode_bytes.rstrip(b"\0").decode()
+    if mode not in MAPPABLE_MODES:
+        raise ValueError(f"Unsupported raw image mode {mode}")
+    pixels = memoryview(buffer)[HEADER_SIZE:]
+    expected = width * height * (1 if mode == "L" else 4)
+    if len(pixels) != expected:
+        raise ValueError(f"Raw image is truncated: {len(pixels)} bytes instead of {expected}")
+    return Image.frombuffer(mode, (width, height), pixels, "raw", mode, 0, 1)
@@ -7,23 +7,49 @@ import io
 import locale
 import logging
 import os
+import time
 import uuid
 from asyncio import Event
+from concurrent.futures import Executor, ThreadPoolExecutor
 from contextlib import nullcontext
+from dataclasses import dataclass, field
 from datetime import date
 from functools import partial
+from typing import cast, get_args
 
 import msgpack
 import nats
 from nats.aio.msg import Msg
 from nats.js import JetStreamContext
 from nats.js.api import ObjectStoreConfig, StorageType
+from nats.js.errors import ObjectNotFoundError
 from nats.js.object_store import ObjectStore
 from PIL import Image, ImageDraw
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 
-from services.renderer.templates import Template
+from services.converter import RENDER_SUFFIX
+from services.renderer.access_stats import AccessStats
+from services.renderer.assets import AssetLoader
+from services.renderer.cost import estimate_cost
+from services.renderer.image_cache import RawImageCache
+from services.renderer.inheritance import TemplateResolver, template_hash
+from services.renderer.pipeline import (
+    DEFAULT_QUEUE_SIZE,
+    Pipeline,
+    Stage,
+    parse_stage_workers,
+)
+from services.renderer.templates import (
+    DEFAULT_LAYOUT_ENGINE,
+    DrawOp,
+    LayoutEngine,
+    Template,
+    draw_layers,
+)
+from services.renderer.warmup import WarmupSettings, mark_ready, warm_up
 from services.renderer.weekdays import Schedule
+from services.stats import start_stats_task
 
 ELEMENTS_BUCKET_NAME = "assets"
 RESULT_BUCKET_NAME = "rendered"
@@ -38,69 +64,213 @@ USER_ID_HEADER = "Sch-User-Id"
 CHAT_ID_HEADER = "Sch-Chat-Id"
 START_DATE_HEADER = "Sch-Start-Date"
 ELEMENT_NAME_HEADER = "Sch-Element-Name"
+TEMPLATE_HASH_HEADER = "Sch-Template-Hash"
+BASE_HASH_HEADER = "Sch-Base-Hash"
+
+RENDER_STAGES = ("fetch", "draw", "encode", "upload")
 
 logger = logging.getLogger(__name__)
 
 
-async def render(
-    msg: Msg,
-    js: JetStreamContext,
-    elements_store: ObjectStore,
-    result_store: ObjectStore,
-    session_pool: async_sessionmaker | None = None,
-):
+@dataclass
+class RenderJob:
+    msg: Msg
+    user_id: str
+    chat_id: str
+    element_name: str
+    start_date: date
+    image: Image.Image | None = None
+    layers: list[list[DrawOp]] = field(default_factory=list)
+    result: bytes | None = None
+    estimated_cost: float = 0.0
+
+    @property
+    def reply_headers(self) -> dict[str, str]:
+        return {
+            USER_ID_HEADER: self.user_id,
+            CHAT_ID_HEADER: self.chat_id,
+        }
+
+
+async def accept(msg: Msg, pipeline: Pipeline[RenderJob]) -> None:
     if msg.headers is None:
         logger.error("Got message without headers")
         raise ValueError("Headers are required for message processing")
 
-    user_id = msg.headers[USER_ID_HEADER]
-    chat_id = msg.headers[CHAT_ID_HEADER]
-    element_name = msg.headers[ELEMENT_NAME_HEADER]
-    start_date = date.fromisoformat(msg.headers[START_DATE_HEADER])
+    job = RenderJob(
+        msg=msg,
+        user_id=msg.headers[USER_ID_HEADER],
+        chat_id=msg.headers[CHAT_ID_HEADER],
+        element_name=msg.headers[ELEMENT_NAME_HEADER],
+        start_date=date.fromisoformat(msg.headers[START_DATE_HEADER]),
+    )
+    # Waits if the pipeline is saturated, so messages are left in NATS instead of piling up in memory.
+    await pipeline.submit(job)
 
-    logger.debug("Trying to parse objects")
-    template_dict, schedule_dict = msgpack.unpackb(msg.data)
-    template = Template.model_validate(template_dict)
-    schedule = Schedule.model_validate(schedule_dict)
-    logger.debug("Template and schedule successfully parsed")
 
-    logger.info("Converting %s for %s", element_name, user_id)
-    background_data = await elements_store.get(element_name)
-    if background_data.data is None:
-        logger.error("No content in image %s.%s", user_id, element_name)
-        raise ValueError("No content in image")
+def writable_background(image: Image.Image) -> Image.Image:
     # If background has an alpha channel, pasting an RGBA patches produces an unexpected transparency.
     # Now partially transparent background is not supported, see also :func:`PIL.Image.alpha_composite` .
-    background = Image.open(io.BytesIO(background_data.data), formats=[IMAGE_FORMAT]).convert(mode="RGB")
-    draw = ImageDraw.ImageDraw(background, mode="RGBA")
+    if image.mode != "RGB" or image.readonly:
+        image = image.convert(mode="RGB")
+    return image
+
 
-    headers = {
-        USER_ID_HEADER: user_id,
-        CHAT_ID_HEADER: chat_id,
-    }
+def _encode_result(image: Image.Image) -> bytes:
+    stream = io.BytesIO()
+    image.save(stream, format=IMAGE_FORMAT)
+    return stream.getvalue()
+
+
+async def load_template(
+    template_dict: dict,
+    headers: dict[str, str],
+    resolver: TemplateResolver,
+    session_pool: async_sessionmaker | None = None,
+) -> Template:
+    """
+    Parses the template, resolving it over the base one if necessary. Both steps are cached by hashes of templates.
+    """
+    base_hash = headers.get(BASE_HASH_HEADER)
+    delta_hash = headers.get(TEMPLATE_HASH_HEADER) or template_hash(msgpack.packb(template_dict))
+    if base_hash is not None and (resolved := resolver.get_resolved(base_hash, delta_hash)) is not None:
+        return resolved
+    template = resolver.parse(template_dict, delta_hash)
+    if template.base is None:
+        return template
+
+    if session_pool is None:
+        raise ValueError("Cannot load base template without database")
+    async with session_pool() as session:
+        result = await session.execute(text("SELECT user_template FROM users WHERE tg_id = 0"))
+        base_data: str | None = result.scalar()
+    if base_data is None:
+        raise ValueError("Base template is missing")
+    actual_base_hash = template_hash(base_data)
+    if base_hash is not None and base_hash != actual_base_hash:
+        logger.info("Base template was changed after the request was sent, using the current one")
+    base = resolver.parse(base_data, actual_base_hash)
+    return resolver.resolve(template, delta_hash, base, actual_base_hash)
+
+
+async def load_background(assets: AssetLoader, element_name: str) -> Image.Image:
+    """
+    Prefers the render-ready derivative, which is already RGB, over the full image.
+    """
     try:
-        async with (session_pool or nullcontext)() as session:
-            await template.apply(background, draw, start_date, schedule, store=elements_store, session=session)
+        return await assets.get_image(f"{element_name}{RENDER_SUFFIX}", mode="RGB")
+    except ObjectNotFoundError:
+        # Elements converted before derivatives were introduced.
+        return await assets.get_image(element_name, mode="RGB")
+
+
+async def fetch_stage(
+    job: RenderJob,
+    assets: AssetLoader,
+    executor: Executor,
+    resolver: TemplateResolver,
+    session_pool: async_sessionmaker | None = None,
+    layout_engine: LayoutEngine = DEFAULT_LAYOUT_ENGINE,
+) -> RenderJob:
+    logger.debug("Trying to parse objects")
+    template_dict, schedule_dict = msgpack.unpackb(job.msg.data)
+    template = await load_template(template_dict, job.msg.headers or {}, resolver, session_pool)
+    schedule = Schedule.model_validate(schedule_dict)
+    logger.debug("Template and schedule successfully parsed")
+    cost = estimate_cost(template)
+    job.estimated_cost = cost.estimate()
+    logger.info("Estimated cost of template for %s: %s", job.user_id, cost)
+
+    logger.info("Converting %s for %s", job.element_name, job.user_id)
+    background = await load_background(assets, job.element_name)
+    loop = asyncio.get_running_loop()
+    job.image = await loop.run_in_executor(executor, writable_background, background)
+
+    async with (session_pool or nullcontext)() as session:
+        job.layers = await template.prepare(
+            job.start_date, schedule, assets=assets, session=session, layout_engine=layout_engine
+        )
+    return job
+
+
+async def draw_stage(job: RenderJob, executor: Executor, region_executor: Executor | None = None) -> RenderJob:
+    assert job.image is not None
+    image = job.image
+    draw = ImageDraw.ImageDraw(image, mode="RGBA")
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    await loop.run_in_executor(executor, partial(draw_layers, image, draw, job.layers, executor=region_executor))
+    logger.debug(
+        "Drawn schedule for %s in %.1f ms, estimated %.1f ms",
+        job.user_id,
+        (time.perf_counter() - start) * 1000,
+        job.estimated_cost,
+    )
+    job.layers = []
+    return job
 
-        stream = io.BytesIO()
-        background.save(stream, format=IMAGE_FORMAT)
 
-        rendered_name = str(uuid.uuid4())
-        logger.info("Created schedule for %s as %s", user_id, rendered_name)
-        await result_store.put(name=rendered_name, data=stream.getvalue())
-        logger.debug("Saved %s into store", rendered_name)
-        await js.publish(subject=OUTPUT_SUBJECT_NAME, payload=rendered_name.encode(), headers=headers)
-    except ValueError as e:
-        logger.warning("Cannot render desired image: %s", e, exc_info=True)
-        await js.publish(subject=OUTPUT_SUBJECT_NAME_ERROR, payload=str(e).encode(), headers=headers)
+async def encode_stage(job: RenderJob, executor: Executor) -> RenderJob:
+    assert job.image is not None
+    loop = asyncio.get_running_loop()
+    job.result = await loop.run_in_executor(executor, _encode_result, job.image)
+    job.image = None
+    return job
 
-    await msg.ack()
+
+async def upload_stage(job: RenderJob, js: JetStreamContext, result_store: ObjectStore) -> None:
+    assert job.result is not None
+    rendered_name = str(uuid.uuid4())
+    logger.info("Created schedule for %s as %s", job.user_id, rendered_name)
+    await result_store.put(name=rendered_name, data=job.result)
+    logger.debug("Saved %s into store", rendered_name)
+    await js.publish(subject=OUTPUT_SUBJECT_NAME, payload=rendered_name.encode(), headers=job.reply_headers)
+    await job.msg.ack()
+
+
+async def handle_render_error(job: RenderJob, error: Exception, js: JetStreamContext) -> None:
+    if not isinstance(error, ValueError):
+        # Message is not acknowledged and will be redelivered.
+        logger.error("Failed to render schedule for %s", job.user_id, exc_info=error)
+        return
+    logger.warning("Cannot render desired image: %s", error, exc_info=error)
+    await js.publish(subject=OUTPUT_SUBJECT_NAME_ERROR, payload=str(error).encode(), headers=job.reply_headers)
+    await job.msg.ack()
 
 
 async def render_loop(
-    js: JetStreamContext, session_pool: async_sessionmaker | None = None, shutdown_event: asyncio.Event | None = None
+    js: JetStreamContext,
+    session_pool: async_sessionmaker | None = None,
+    shutdown_event: asyncio.Event | None = None,
+    render_threads: int = 1,
+    stage_workers: dict[str, int] | None = None,
+    queue_size: int = DEFAULT_QUEUE_SIZE,
+    stats_interval: float = 60.0,
+    shared_cache: RawImageCache | None = None,
+    disk_cache: RawImageCache | None = None,
+    warmup: WarmupSettings | None = None,
+    layout_engine: LayoutEngine = DEFAULT_LAYOUT_ENGINE,
 ):
+    warmup = warmup or WarmupSettings()
+    mark_ready(warmup, False)
+    stage_workers = stage_workers or {}
+    workers = {name: stage_workers.get(name, 1) for name in RENDER_STAGES}
+    # Decoding, drawing and encoding are CPU-bound, so they are done in threads outside the event loop.
+    executor = ThreadPoolExecutor(max_workers=workers["fetch"] + workers["draw"] + workers["encode"])
+    # Days of a template are drawn in parallel only if there is more than one thread to do so.
+    region_executor = ThreadPoolExecutor(max_workers=render_threads) if render_threads > 1 else None
     elements_store = await js.object_store(ELEMENTS_BUCKET_NAME)
+    access_stats = AccessStats()
+    assets = AssetLoader(
+        elements_store,
+        shared_cache=shared_cache,
+        disk_cache=disk_cache,
+        executor=executor,
+        access_stats=access_stats,
+    )
+    stats_kv = await AccessStats.bucket(js)
+    await warm_up(stats_kv, assets, warmup)
+    flush_task = asyncio.create_task(access_stats.flush_periodically(stats_kv, warmup.flush_interval))
     await js.create_object_store(
         "rendered",
         config=ObjectStoreConfig(
@@ -110,13 +280,39 @@ async def render_loop(
         ),
     )
     result_store = await js.object_store(RESULT_BUCKET_NAME)
+
+    pipeline: Pipeline[RenderJob] = Pipeline(
+        [
+            Stage(
+                "fetch",
+                partial(
+                    fetch_stage,
+                    assets=assets,
+                    executor=executor,
+                    resolver=TemplateResolver(),
+                    session_pool=session_pool,
+                    layout_engine=layout_engine,
+                ),
+                workers["fetch"],
+            ),
+            Stage("draw", partial(draw_stage, executor=executor, region_executor=region_executor), workers["draw"]),
+            Stage("encode", partial(encode_stage, executor=executor), workers["encode"]),
+            Stage("upload", partial(upload_stage, js=js, result_store=result_store), workers["upload"]),
+        ],
+        on_error=partial(handle_render_error, js=js),
+        queue_size=queue_size,
+    )
+    pipeline.start()
+    stats_task = start_stats_task("renderer", lambda: pipeline.occupancy() | assets.stats(), stats_interval)
+
     await js.subscribe(
         INPUT_SUBJECT_NAME,
-        cb=partial(render, js=js, elements_store=elements_store, result_store=result_store, session_pool=session_pool),
+        cb=partial(accept, pipeline=pipeline),
         durable="renderer",
         manual_ack=True,
     )
     logger.info("Connected to NATS")
+    mark_ready(warmup, True)
 
     if shutdown_event is None:
         shutdown_event = Event()
@@ -127,9 +323,31 @@ async def render_loop(
     except asyncio.CancelledError:
         logger.debug("Main task was cancelled")
     logger.warning("Exiting main task")
+    mark_ready(warmup, False)
+    if stats_task is not None:
+        stats_task.cancel()
+    flush_task.cancel()
+    await pipeline.stop()
+    await access_stats.flush(stats_kv)
+    executor.shutdown(wait=False)
+    if region_executor is not None:
+        region_executor.shutdown(wait=False)
 
 
-async def main(servers: str = "nats://localhost:4222", db_url: str | None = None):
+async def main(
+    servers: str = "nats://localhost:4222",
+    db_url: str | None = None,
+    render_threads: int = 1,
+    stage_workers: dict[str, int] | None = None,
+    queue_size: int = DEFAULT_QUEUE_SIZE,
+    stats_interval: float = 60.0,
+    shared_cache_dir: str | None = None,
+    shared_cache_size: int = 0,
+    disk_cache_dir: str | None = None,
+    disk_cache_size: int = 0,
+    warmup: WarmupSettings | None = None,
+    layout_engine: LayoutEngine = DEFAULT_LAYOUT_ENGINE,
+):
     nc = await nats.connect(servers=servers)
     js = nc.jetstream()
     if db_url:
@@ -137,17 +355,73 @@ async def main(servers: str = "nats://localhost:4222", db_url: str | None = None
         session_pool = async_sessionmaker(engine, expire_on_commit=False)
     else:
         session_pool = None
-    await render_loop(js, session_pool)
+    if shared_cache_dir and shared_cache_size > 0:
+        shared_cache = RawImageCache(shared_cache_dir, shared_cache_size)
+    else:
+        shared_cache = None
+    if disk_cache_dir and disk_cache_size > 0:
+        disk_cache = RawImageCache(disk_cache_dir, disk_cache_size)
+    else:
+        disk_cache = None
+    await render_loop(
+        js,
+        session_pool,
+        render_threads=render_threads,
+        stage_workers=stage_workers,
+        queue_size=queue_size,
+        stats_interval=stats_interval,
+        shared_cache=shared_cache,
+        disk_cache=disk_cache,
+        warmup=warmup,
+        layout_engine=layout_engine,
+    )
     await nc.close()
 
 
 def entry():
     nats_servers_ = os.getenv("NATS_SERVERS")
     database_url = os.getenv("DB_URL")
+    render_threads_ = int(os.getenv("RENDER_THREADS") or 1)
+    stage_workers_ = parse_stage_workers(os.getenv("RENDER_STAGE_WORKERS"))
+    queue_size_ = int(os.getenv("RENDER_QUEUE_SIZE") or DEFAULT_QUEUE_SIZE)
+    stats_interval_ = float(os.getenv("STATS_INTERVAL") or 60)
+    shared_cache_dir_ = os.getenv("RENDER_SHARED_CACHE_DIR", "/dev/shm/schedule_bot")
+    shared_cache_size_ = int(os.getenv("RENDER_SHARED_CACHE_SIZE_MB") or 0) * 2**20
+    disk_cache_dir_ = os.getenv("RENDER_DISK_CACHE_DIR")
+    disk_cache_size_ = int(os.getenv("RENDER_DISK_CACHE_SIZE_MB") or 0) * 2**20
+    warmup_ = WarmupSettings(
+        top_k=int(os.getenv("RENDER_WARMUP_TOP_K") or 50),
+        timeout=float(os.getenv("RENDER_WARMUP_TIMEOUT") or 30),
+        memory_budget=int(os.getenv("RENDER_WARMUP_MEMORY_MB") or 256) * 2**20,
+        flush_interval=float(os.getenv("RENDER_ACCESS_FLUSH_INTERVAL") or 300),
+        ready_file=os.getenv("RENDER_READY_FILE"),
+    )
+    layout_engine_ = cast(LayoutEngine, os.getenv("RENDER_LAYOUT_ENGINE") or DEFAULT_LAYOUT_ENGINE)
     if nats_servers_ is None:
         logger.critical("Cannot run without nats url")
         exit(1)
+    if unknown_stages := stage_workers_.keys() - set(RENDER_STAGES):
+        logger.critical("Unknown render stages: %s", ", ".join(sorted(unknown_stages)))
+        exit(1)
+    if layout_engine_ not in get_args(LayoutEngine):
+        logger.critical("Unknown layout engine: %s", layout_engine_)
+        exit(1)
     if database_url is None:
         logger.warning("Loading images via name is not possible")
     locale.setlocale(locale.LC_TIME, "")  # Use value given by environment variables.
-    asyncio.run(main(nats_servers_, database_url))
+    asyncio.run(
+        main(
+            nats_servers_,
+            database_url,
+            render_threads_,
+            stage_workers_,
+            queue_size_,
+            stats_interval_,
+            shared_cache_dir_,
+            shared_cache_size_,
+            disk_cache_dir_,
+            disk_cache_size_,
+            warmup_,
+            layout_engine_,
+        )
+    )
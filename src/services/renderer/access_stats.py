@@ -0,0 +1,94 @@
+"""
+Access counters of assets and fonts, shared between renderer replicas via NATS KV.
+"""
+
+import asyncio
+import json
+import logging
+from collections import Counter
+
+from nats.js import JetStreamContext
+from nats.js.api import KeyValueConfig
+from nats.js.errors import KeyNotFoundError, KeyWrongLastSequenceError
+from nats.js.kv import KeyValue
+
+logger = logging.getLogger(__name__)
+
+STATS_BUCKET_NAME = "renderer-stats"
+ACCESS_KEY = "access"
+# Keeps the stored document small, rarely used items are not worth preloading anyway.
+MAX_STORED_ITEMS = 1000
+SEPARATOR = "|"
+
+
+class AccessStats:
+    """
+    Counts uses of assets and fonts in this process and merges them into the shared counters in NATS KV,
+    so that all renderer replicas contribute to the same statistics.
+    """
+
+    def __init__(self):
+        self.assets: Counter[str] = Counter()
+        self.fonts: Counter[str] = Counter()
+
+    def record_asset(self, name: str, mode: str) -> None:
+        self.assets[f"{name}{SEPARATOR}{mode}"] += 1
+
+    def record_font(self, font_name: str, font_size: int, layout_engine: str) -> None:
+        self.fonts[f"{font_name}{SEPARATOR}{font_size}{SEPARATOR}{layout_engine}"] += 1
+
+    @staticmethod
+    async def bucket(js: JetStreamContext) -> KeyValue:
+        return await js.create_key_value(
+            KeyValueConfig(
+                bucket=STATS_BUCKET_NAME,
+                description="Access counters used by renderer to warm up caches",
+                history=1,
+            )
+        )
+
+    @staticmethod
+    async def load(kv: KeyValue) -> tuple[dict[str, int], dict[str, int], int | None]:
+        try:
+            entry = await kv.get(ACCESS_KEY)
+        except KeyNotFoundError:
+            return {}, {}, None
+        data = json.loads(entry.value or b"{}")
+        return data.get("assets", {}), data.get("fonts", {}), entry.revision
+
+    async def flush(self, kv: KeyValue) -> None:
+        if not self.assets and not self.fonts:
+            return
+        pending_assets, pending_fonts = self.assets, self.fonts
+        self.assets, self.fonts = Counter(), Counter()
+        # Optimistic concurrency: retry if another replica has updated counters in the meantime.
+        for _ in range(5):
+            assets, fonts, revision = await self.load(kv)
+            merged_assets = Counter(assets) + pending_assets
+            merged_fonts = Counter(fonts) + pending_fonts
+            value = json.dumps(
+                {
+                    "assets": dict(merged_assets.most_common(MAX_STORED_ITEMS)),
+                    "fonts": dict(merged_fonts.most_common(MAX_STORED_ITEMS)),
+                }
+            ).encode()
+            try:
+                if revision is None:
+                    await kv.create(ACCESS_KEY, value)
+                else:
+                    await kv.update(ACCESS_KEY, value, last=revision)
+            except KeyWrongLastSequenceError:
+                continue
+            logger.debug("Flushed access stats: %d assets, %d fonts", len(pending_assets), len(pending_fonts))
+            return
+        logger.warning("Cannot flush access stats due to concurrent updates")
+        self.assets.update(pending_assets)
+        self.fonts.update(pending_fonts)
+
+    async def flush_periodically(self, kv: KeyValue, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush(kv)
+            except Exception:
+                logger.exception("Cannot flush access stats")
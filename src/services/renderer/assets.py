@@ -0,0 +1,116 @@
+import asyncio
+import io
+import logging
+from concurrent.futures import Executor
+from typing import Any, cast
+
+from nats.js.object_store import ObjectStore
+from PIL import Image
+
+from services.raw_image import decode_raw, is_raw
+
+from .access_stats import AccessStats
+from .image_cache import RawImageCache
+
+logger = logging.getLogger(__name__)
+
+
+def _decode(data: bytes, mode: str) -> Image.Image:
+    if is_raw(data):
+        image = decode_raw(data)
+        # RGB is kept as RGBX in raw format, just as in caches.
+        if image.mode == mode or (mode, image.mode) == ("RGB", "RGBX"):
+            return image
+        return image.convert(mode=mode)
+    return Image.open(io.BytesIO(data)).convert(mode=mode)
+
+
+def _ratio(hits: int, total: int) -> str:
+    return f"{hits / total:.2f}" if total else "-"
+
+
+class AssetLoader:
+    """
+    Loads images through the cache tiers: shared memory, then local disk, then the object store.
+    Memory tier is keyed by object name, disk tier by object digest, so it stays valid even if names are reused.
+    Images found in a slower tier are saved into all faster ones. Returned images may be read-only.
+    """
+
+    def __init__(
+        self,
+        store: ObjectStore,
+        shared_cache: RawImageCache | None = None,
+        disk_cache: RawImageCache | None = None,
+        executor: Executor | None = None,
+        access_stats: AccessStats | None = None,
+    ):
+        self.store = store
+        self.shared_cache = shared_cache
+        self.disk_cache = disk_cache
+        self.executor = executor
+        self.access_stats = access_stats
+        self.shm_hits = 0
+        self.disk_hits = 0
+        self.store_hits = 0
+
+    async def get_image(self, name: str, mode: str = "RGBA", record: bool = True) -> Image.Image:
+        """
+        Raises ObjectNotFoundError if there is no such object and ValueError if it is empty.
+        Loads which are not requested by users, such as warming up, should not be recorded to access stats.
+        """
+        if record and self.access_stats is not None:
+            self.access_stats.record_asset(name, mode)
+        key = f"{name}@{mode}"
+        if self.shared_cache is not None and (image := self.shared_cache.get(key)) is not None:
+            self.shm_hits += 1
+            return image
+
+        loop = asyncio.get_running_loop()
+        if self.disk_cache is not None:
+            info = await self.store.get_info(name)
+            if info.is_link():
+                # Digest of a link is the digest of no data, so the digest of linked content is used instead.
+                info = await self.store.get_info(cast(str, info.options.link.name))
+            disk_key = f"{info.digest}@{mode}"
+            image = await loop.run_in_executor(self.executor, self.disk_cache.get, disk_key)
+            if image is not None:
+                self.disk_hits += 1
+                return await self._save_shared(key, image)
+
+        result = await self.store.get(name)
+        if not result.data:
+            logger.error("No content in image %s", name)
+            raise ValueError("No content in image")
+        self.store_hits += 1
+
+        image = await loop.run_in_executor(self.executor, _decode, result.data, mode)
+        if self.disk_cache is not None:
+            # Digest is taken from the loaded object, since it might be replaced after `get_info` call.
+            disk_key = f"{result.info.digest}@{mode}"
+            image = await loop.run_in_executor(self.executor, self.disk_cache.put, disk_key, image)
+        return await self._save_shared(key, image)
+
+    def record_font(self, font_name: str, font_size: int, layout_engine: str) -> None:
+        if self.access_stats is not None:
+            self.access_stats.record_font(font_name, font_size, layout_engine)
+
+    async def _save_shared(self, key: str, image: Image.Image) -> Image.Image:
+        if self.shared_cache is None:
+            return image
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.shared_cache.put, key, image)
+
+    def stats(self) -> dict[str, Any]:
+        """
+        Hit ratio of each tier is computed over requests that reached this tier.
+        """
+        total = self.shm_hits + self.disk_hits + self.store_hits
+        result: dict[str, Any] = {}
+        if self.shared_cache is not None:
+            result["shm.hit_ratio"] = _ratio(self.shm_hits, total)
+            result["shm.used_mb"] = f"{self.shared_cache.used_bytes() / 2**20:.1f}"
+        if self.disk_cache is not None:
+            result["disk.hit_ratio"] = _ratio(self.disk_hits, total - self.shm_hits)
+            result["disk.used_mb"] = f"{self.disk_cache.used_bytes() / 2**20:.1f}"
+        result["store.loads"] = self.store_hits
+        return result
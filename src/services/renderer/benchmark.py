@@ -0,0 +1,312 @@
+"""
+Offline benchmarks of rendering on real templates. Run as `python -m services.renderer.benchmark --help`.
+NATS and database are not required: image patches are replaced with transparent placeholders.
+"""
+
+import argparse
+import asyncio
+import dataclasses
+import io
+import json
+import statistics
+import tempfile
+import time
+from datetime import date
+from functools import partial
+from pathlib import Path
+from typing import Callable, Iterator, cast, get_args
+
+from PIL import Image, ImageDraw
+
+from services.converter import RENDER_COMPRESS_LEVEL
+from services.raw_image import decode_raw, encode_raw
+from services.renderer import writable_background
+from services.renderer.assets import _decode
+from services.renderer.cost import (
+    DEFAULT_WEIGHTS,
+    UNKNOWN_ASSET_SIZE,
+    CostWeights,
+    estimate_cost,
+)
+from services.renderer.image_cache import RawImageCache
+from services.renderer.templates import (
+    HAVE_RAQM,
+    BasePatch,
+    DrawOp,
+    ImagePatch,
+    LayoutEngine,
+    PatchSet,
+    Template,
+    TextDrawOp,
+    TextPatch,
+    draw_layers,
+    fit_font_size,
+    load_font,
+    text_size,
+)
+from services.renderer.weekdays import Entry, Schedule, Time, WeekDay
+
+START_DATE = date(2024, 8, 12)
+DEFAULT_TEXT = "Прохождение новой игры"
+
+
+class PlaceholderAssets:
+    """
+    Replaces :class:`AssetLoader`, so templates may be prepared without the object store.
+    """
+
+    def __init__(self, size: tuple[int, int] = (1, 1)):
+        self.size = size
+
+    async def get_image(self, name: str, mode: str = "RGBA") -> Image.Image:
+        return Image.new(mode, self.size, (255, 255, 255, 128) if mode == "RGBA" else None)
+
+    def record_font(self, font_name: str, font_size: int, layout_engine: str) -> None:
+        pass
+
+
+def iter_patches(template: Template) -> Iterator[BasePatch]:
+    patch_sets: list[PatchSet] = [template.always]
+    for day_patch in template.patches.values():
+        patch_sets.extend([day_patch.always, day_patch.if_none, *day_patch.record_patches])
+    for patch_set in patch_sets:
+        yield from patch_set.patches
+
+
+def load_template(path: Path, font: str | None = None) -> Template:
+    template = Template.model_validate(json.loads(path.read_text()))
+    for patch in iter_patches(template):
+        if isinstance(patch, TextPatch):
+            # Engine is chosen by the benchmark, as if it was chosen for the deployment.
+            patch.layout_engine = None
+            if font is not None:
+                patch.font_name = font
+        elif isinstance(patch, ImagePatch) and patch.element_id is None:
+            # Names are resolved via the database, placeholders do not need it.
+            patch.element_id = patch.name
+    return template
+
+
+def sample_schedule(entries_per_day: int, text: str) -> Schedule:
+    return Schedule(
+        records={
+            weekday: [Entry(time=Time(hour=10 + i), description=f"{text} {i + 1}") for i in range(entries_per_day)]
+            for weekday in WeekDay
+        }
+    )
+
+
+def _text_layers(layers: list[list[DrawOp]]) -> list[list[DrawOp]]:
+    return [[op for op in layer if isinstance(op, TextDrawOp)] for layer in layers]
+
+
+def _time_draw(template: Template, layers: list[list[DrawOp]], repeats: int) -> float:
+    timings = []
+    for _ in range(repeats):
+        image = Image.new("RGB", (template.width, template.height), "gray")
+        draw = ImageDraw.ImageDraw(image, mode="RGBA")
+        start = time.perf_counter()
+        draw_layers(image, draw, layers)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+async def benchmark_layout(args: argparse.Namespace) -> None:
+    if not HAVE_RAQM:
+        print("Raqm is not available, all engines use basic layout")
+    schedule = sample_schedule(args.entries, args.text)
+    print(f"{'template':30} {'engine':6} {'ops':>5} {'draw, ms':>9} {'ratio':>6}")
+    for path in args.templates:
+        template = load_template(path, args.font)
+        baseline: float | None = None
+        for engine in get_args(LayoutEngine):
+            layers = await template.prepare(START_DATE, schedule, assets=PlaceholderAssets(), layout_engine=engine)
+            layers = _text_layers(layers)
+            elapsed = _time_draw(template, layers, args.repeats)
+            baseline = baseline or elapsed
+            n_ops = sum(map(len, layers))
+            print(f"{path.name:30} {engine:6} {n_ops:5} {elapsed:9.2f} {elapsed / baseline:6.2f}")
+
+
+async def _time_prepare(template: Template, schedule: Schedule, repeats: int) -> tuple[float, float]:
+    """
+    Returns time of the first preparation with empty caches and the median time of subsequent ones.
+    """
+    for cached in (load_font, text_size, fit_font_size):
+        cached.cache_clear()
+    timings = []
+    for _ in range(repeats + 1):
+        start = time.perf_counter()
+        await template.prepare(START_DATE, schedule, assets=PlaceholderAssets())
+        timings.append(time.perf_counter() - start)
+    return timings[0] * 1000, statistics.median(timings[1:]) * 1000
+
+
+async def benchmark_fit(args: argparse.Namespace) -> None:
+    schedule = sample_schedule(args.entries, args.text)
+    print(f"{'template':30} {'mode':6} {'cold, ms':>9} {'warm, ms':>9}")
+    for path in args.templates:
+        template = load_template(path, args.font)
+        fitted = template.model_copy(deep=True)
+        for patch in iter_patches(fitted):
+            if isinstance(patch, TextPatch):
+                patch.max_box = tuple(args.box)
+        for mode, variant in (("fixed", template), ("fitted", fitted)):
+            cold, warm = await _time_prepare(variant, schedule, args.repeats)
+            print(f"{path.name:30} {mode:6} {cold:9.2f} {warm:9.2f}")
+
+
+async def _time_render(template: Template, schedule: Schedule, repeats: int) -> float:
+    assets = PlaceholderAssets(UNKNOWN_ASSET_SIZE)
+    timings = []
+    for _ in range(repeats):
+        image = Image.new("RGB", (template.width, template.height), "gray")
+        draw = ImageDraw.ImageDraw(image, mode="RGBA")
+        start = time.perf_counter()
+        await template.apply(image, draw, START_DATE, schedule, assets=assets)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def _time_decode(size: tuple[int, int], repeats: int) -> float:
+    stream = io.BytesIO()
+    Image.effect_noise(size, 64).convert("RGBA").save(stream, format="png")
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        Image.open(io.BytesIO(stream.getvalue())).convert("RGBA")
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def _synthetic_template(n: int, patch: dict) -> Template:
+    return Template.model_validate({"always": [patch] * n})
+
+
+async def calibrate(font: str, text: str, repeats: int) -> CostWeights:
+    """
+    Measures cost of every feature in isolation on templates consisting of patches of a single kind.
+    """
+    empty = sample_schedule(0, text)
+    n = 50
+    text_patch = {"type": "text", "xy": [0, 0], "text": text, "font_size": 40, "font_name": font}
+    shape_patch = {"type": "rectangle", "xy": [0, 0], "size": [1, 1], "color": "#ffffff80"}
+    image_patch = {"type": "image", "xy": [0, 0], "element_id": "placeholder"}
+    large_shape_patch = shape_patch | {"size": list(UNKNOWN_ASSET_SIZE)}
+    stroke_patch = text_patch | {"stroke_width": 3, "stroke_color": "white"}
+
+    async def unit_cost(template: Template, feature: str, known: CostWeights) -> float:
+        elapsed = await _time_render(template, empty, repeats)
+        cost = estimate_cost(template)
+        known_part = dataclasses.replace(known, **{feature: 0}, asset=0)
+        amount = getattr(cost, {"patch": "patches"}.get(feature, feature.replace("megapixel", "area")))
+        amount = amount / 1e6 if "megapixel" in feature else amount
+        return max(elapsed - cost.estimate(known_part), 0) / amount
+
+    weights = dataclasses.replace(DEFAULT_WEIGHTS, asset=_time_decode(UNKNOWN_ASSET_SIZE, repeats))
+    weights = dataclasses.replace(
+        weights, patch=await unit_cost(_synthetic_template(n * 10, shape_patch), "patch", weights)
+    )
+    for feature, patch in (
+        ("text_megapixel", text_patch),
+        ("stroke_megapixel", stroke_patch),
+        ("asset_megapixel", image_patch),
+        ("shape_megapixel", large_shape_patch),
+    ):
+        weights = dataclasses.replace(
+            weights, **{feature: await unit_cost(_synthetic_template(n, patch), feature, weights)}
+        )
+    return weights
+
+
+def _sample_background(size: tuple[int, int]) -> Image.Image:
+    # Smooth gradient with some noise compresses to PNG about as well as a photo.
+    noise = Image.effect_noise(size, 20).convert("RGB")
+    return Image.blend(Image.linear_gradient("L").resize(size).convert("RGB"), noise, 0.1)
+
+
+def _time_load(load: Callable[[], Image.Image], repeats: int) -> tuple[float, float]:
+    """
+    Returns median time of loading and of loading with conversion to a writable background, as in rendering.
+    """
+    timings, writable_timings = [], []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        image = load()
+        timings.append(time.perf_counter() - start)
+        writable_background(image)
+        writable_timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000, statistics.median(writable_timings) * 1000
+
+
+async def benchmark_background(args: argparse.Namespace) -> None:
+    if args.backgrounds:
+        backgrounds = [(path.name, Image.open(path)) for path in args.backgrounds]
+    else:
+        backgrounds = [("synthetic", _sample_background(tuple(args.size)))]
+    print(f"{'background':20} {'format':10} {'size, MB':>9} {'load, ms':>9} {'writable, ms':>13}")
+    with tempfile.TemporaryDirectory() as directory:
+        cache = RawImageCache(directory, 2**30)
+        for name, image in backgrounds:
+            stream = io.BytesIO()
+            image.convert("RGB").save(stream, format="png", compress_level=RENDER_COMPRESS_LEVEL)
+            png = stream.getvalue()
+            raw = encode_raw(image.convert("RGB"))
+            cache.put(name, decode_raw(raw))
+            for format_name, data_size, load in (
+                ("png", len(png), partial(_decode, png, "RGB")),
+                ("raw", len(raw), partial(_decode, raw, "RGB")),
+                ("raw mmap", len(raw), partial(cache.get, name)),
+            ):
+                elapsed, writable = _time_load(cast(Callable[[], Image.Image], load), args.repeats)
+                print(f"{name:20} {format_name:10} {data_size / 2**20:9.2f} {elapsed:9.2f} {writable:13.2f}")
+
+
+async def benchmark_cost(args: argparse.Namespace) -> None:
+    font = args.font or "FreeSans.ttf"
+    weights = await calibrate(font, args.text, args.repeats)
+    print(f"Calibrated weights: {weights}")
+    # Placeholders are not loaded from the store, so per-asset loading cost is not measured here.
+    render_weights = dataclasses.replace(weights, asset=0)
+    schedule = sample_schedule(args.entries, args.text)
+    print(f"{'template':30} {'estimate, ms':>13} {'default, ms':>12} {'actual, ms':>11}")
+    for path in args.templates:
+        template = load_template(path, args.font)
+        cost = estimate_cost(template)
+        elapsed = await _time_render(template, schedule, args.repeats)
+        default = cost.estimate(dataclasses.replace(DEFAULT_WEIGHTS, asset=0))
+        print(f"{path.name:30} {cost.estimate(render_weights):13.1f} {default:12.1f} {elapsed:11.1f}")
+
+
+def entry():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--entries", type=int, default=3, help="Schedule entries per day")
+    parser.add_argument("--text", default=DEFAULT_TEXT, help="Description of schedule entries")
+    parser.add_argument("--font", help="Font used instead of fonts from templates")
+    subparsers = parser.add_subparsers(required=True)
+
+    layout = subparsers.add_parser("layout", help="Compare time of drawing text with different layout engines")
+    layout.add_argument("templates", type=Path, nargs="+")
+    layout.set_defaults(func=benchmark_layout)
+
+    fit = subparsers.add_parser("fit", help="Compare time of preparing fixed and fitted text patches")
+    fit.add_argument("templates", type=Path, nargs="+")
+    fit.add_argument("--box", type=int, nargs=2, default=(300, 40), help="Box for all fitted text patches")
+    fit.set_defaults(func=benchmark_fit)
+
+    background = subparsers.add_parser("background", help="Compare time of loading PNG and raw backgrounds")
+    background.add_argument("backgrounds", type=Path, nargs="*", help="Backgrounds, a synthetic one by default")
+    background.add_argument("--size", type=int, nargs=2, default=(1920, 1098), help="Size of the synthetic one")
+    background.set_defaults(func=benchmark_background)
+
+    cost = subparsers.add_parser("cost", help="Calibrate the cost model and compare estimates with rendering time")
+    cost.add_argument("templates", type=Path, nargs="*")
+    cost.set_defaults(func=benchmark_cost)
+
+    args = parser.parse_args()
+    asyncio.run(args.func(args))
+
+
+if __name__ == "__main__":
+    entry()
@@ -0,0 +1,121 @@
+"""
+Static estimate of rendering cost of a template, so heavy templates may be rejected before they are ever rendered.
+"""
+
+import re
+from dataclasses import dataclass, field
+from typing import Mapping
+
+from .templates import ImagePatch, LinePatch, PatchSet, ShapePatch, Template, TextPatch
+
+# Assumed length of a formatted placeholder such as `{entry.description}`.
+PLACEHOLDER_LENGTH = 16
+# Average glyph width and line height relative to font size.
+GLYPH_WIDTH = 0.6
+LINE_HEIGHT = 1.2
+# Size of assets which are not known in advance, e.g. when a template is uploaded.
+UNKNOWN_ASSET_SIZE = (400, 100)
+
+_PLACEHOLDER = re.compile(r"\{[^{}]*}")
+
+
+@dataclass(frozen=True)
+class CostWeights:
+    """
+    Milliseconds per unit of each feature. Calibrate with `python -m services.renderer.benchmark cost`.
+    Defaults are measured on a single core; text area is estimated, not exact, so its weight is high.
+    """
+
+    patch: float = 0.01
+    text_megapixel: float = 340.0
+    stroke_megapixel: float = 440.0
+    asset: float = 1.6
+    asset_megapixel: float = 7.7
+    shape_megapixel: float = 4.0
+
+
+DEFAULT_WEIGHTS = CostWeights()
+
+
+@dataclass
+class TemplateCost:
+    patches: int = 0
+    text_area: int = 0
+    stroke_area: int = 0
+    assets: set[str] = field(default_factory=set)
+    asset_area: int = 0
+    shape_area: int = 0
+
+    def estimate(self, weights: CostWeights = DEFAULT_WEIGHTS) -> float:
+        """
+        Returns estimated time of rendering in milliseconds.
+        """
+        return (
+            self.patches * weights.patch
+            + self.text_area / 1e6 * weights.text_megapixel
+            + self.stroke_area / 1e6 * weights.stroke_megapixel
+            + len(self.assets) * weights.asset
+            + self.asset_area / 1e6 * weights.asset_megapixel
+            + self.shape_area / 1e6 * weights.shape_megapixel
+        )
+
+    def __str__(self) -> str:
+        return (
+            f"patches={self.patches} text_mpx={self.text_area / 1e6:.2f} stroke_mpx={self.stroke_area / 1e6:.2f} "
+            f"assets={len(self.assets)} asset_mpx={self.asset_area / 1e6:.2f} shape_mpx={self.shape_area / 1e6:.2f} "
+            f"estimate_ms={self.estimate():.1f}"
+        )
+
+
+def _text_box(patch: TextPatch) -> tuple[int, int]:
+    lines = _PLACEHOLDER.sub("x" * PLACEHOLDER_LENGTH, patch.template).split("\n")
+    width = int(max(map(len, lines)) * GLYPH_WIDTH * patch.font_size)
+    height = int(len(lines) * LINE_HEIGHT * patch.font_size)
+    if patch.max_box is not None:
+        width, height = min(width, patch.max_box[0]), min(height, patch.max_box[1])
+    return width, height
+
+
+def _add_patch_set(cost: TemplateCost, patch_set: PatchSet, asset_sizes: Mapping[str, tuple[int, int]]) -> None:
+    # Tags are not known in advance, so all patches are assumed to be visible.
+    for patch in patch_set.patches:
+        cost.patches += 1
+        if isinstance(patch, TextPatch):
+            width, height = _text_box(patch)
+            cost.text_area += width * height
+            if patch.stroke_width:
+                cost.stroke_area += (width + 2 * patch.stroke_width) * (height + 2 * patch.stroke_width)
+        elif isinstance(patch, ImagePatch):
+            key = patch.element_id or patch.name
+            assert key is not None
+            cost.assets.add(key)
+            width, height = asset_sizes.get(key, UNKNOWN_ASSET_SIZE)
+            cost.asset_area += width * height
+        elif isinstance(patch, (ShapePatch, LinePatch)):
+            x0, y0, x1, y1 = patch.bbox()
+            cost.shape_area += (x1 - x0) * (y1 - y0)
+
+
+def estimate_cost(template: Template, asset_sizes: Mapping[str, tuple[int, int]] | None = None) -> TemplateCost:
+    """
+    Estimates the cost of the most expensive schedule for the template: every day is filled with as many entries
+    as there are record patches. Assets missing in `asset_sizes` are assumed to have :data:`UNKNOWN_ASSET_SIZE`.
+    """
+    asset_sizes = asset_sizes or {}
+    cost = TemplateCost()
+    _add_patch_set(cost, template.always, asset_sizes)
+    for day_patch in template.patches.values():
+        _add_patch_set(cost, day_patch.always, asset_sizes)
+        # Assets of both branches are counted, since each of them is loaded on some days.
+        day_cost = TemplateCost(assets=cost.assets)
+        for record_patch in day_patch.record_patches:
+            _add_patch_set(day_cost, record_patch, asset_sizes)
+        empty_day_cost = TemplateCost(assets=cost.assets)
+        _add_patch_set(empty_day_cost, day_patch.if_none, asset_sizes)
+        worst = max(day_cost, empty_day_cost, key=TemplateCost.estimate)
+        cost.patches += worst.patches
+        cost.text_area += worst.text_area
+        cost.stroke_area += worst.stroke_area
+        cost.asset_area += worst.asset_area
+        cost.shape_area += worst.shape_area
+    return cost
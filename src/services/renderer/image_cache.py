@@ -0,0 +1,123 @@
+"""
+Cache of decoded assets as files in raw format (see :mod:`services.raw_image`) which are memory-mapped on read.
+
+In a tmpfs directory, usually `/dev/shm`, this is a cache shared between renderer processes of the same host:
+all processes map the same physical pages and read pixels without copying them.
+In a directory on disk this is a persistent cache which survives restarts and is loaded without PNG decoding.
+The directory itself is the index: file name is the asset key and modification time is the time of the last use.
+
+Each process holds a shared `flock` on a file while an image mapped from it is alive,
+which works as a reference counter: eviction skips files that are locked by anybody.
+"""
+
+import fcntl
+import logging
+import mmap
+import os
+import re
+import tempfile
+import weakref
+from pathlib import Path
+
+from PIL import Image
+
+from services.raw_image import decode_raw, encode_header, raw_size, to_mappable
+
+logger = logging.getLogger(__name__)
+
+_UNSAFE_KEY_CHARS = re.compile(r"[^\w.@-]")
+_SUFFIX = ".raw"
+_EVICTION_LOCK_NAME = ".evict.lock"
+
+
+class RawImageCache:
+    def __init__(self, directory: str | Path, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{_UNSAFE_KEY_CHARS.sub('_', key)}{_SUFFIX}"
+
+    def get(self, key: str) -> Image.Image | None:
+        """
+        Returns read-only image mapped from the cache file or None if there is no such asset.
+        """
+        try:
+            fd = os.open(self._path(key), os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            buffer = mmap.mmap(fd, 0, prot=mmap.PROT_READ)
+            image = decode_raw(buffer)
+            # Marks the asset as recently used for eviction.
+            os.utime(fd)
+        except (OSError, ValueError):
+            logger.warning("Broken cached asset %s in %s", key, self.directory, exc_info=True)
+            os.close(fd)
+            return None
+
+        # The lock (and so the reference) is released as soon as the image is garbage-collected.
+        weakref.finalize(image, os.close, fd)
+        return image
+
+    def put(self, key: str, image: Image.Image) -> Image.Image:
+        """
+        Stores the image and returns its copy mapped from the cache.
+        """
+        image = to_mappable(image)
+        size = raw_size(image)
+        if size > self.max_bytes:
+            logger.debug("Asset %s is too large for the cache in %s: %d bytes", key, self.directory, size)
+            return image
+
+        self._evict(needed=size)
+        fd, tmp_name = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(encode_header(image))
+                f.write(image.tobytes("raw", image.mode))
+            os.replace(tmp_name, self._path(key))
+        except OSError:
+            logger.warning("Cannot save asset %s into %s", key, self.directory, exc_info=True)
+            Path(tmp_name).unlink(missing_ok=True)
+            return image
+
+        return self.get(key) or image
+
+    def used_bytes(self) -> int:
+        return sum(entry.stat().st_size for entry in self._entries())
+
+    def _entries(self) -> list[os.DirEntry]:
+        return [entry for entry in os.scandir(self.directory) if entry.name.endswith(_SUFFIX)]
+
+    def _evict(self, needed: int) -> None:
+        with open(self.directory / _EVICTION_LOCK_NAME, "wb") as lock_file:
+            # Only one process evicts at a time, others wait and then see already freed space.
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            entries = sorted(self._entries(), key=lambda e: e.stat().st_mtime)
+            used = sum(entry.stat().st_size for entry in entries)
+            for entry in entries:
+                if used + needed <= self.max_bytes:
+                    break
+                if self._try_remove(entry.path):
+                    used -= entry.stat().st_size
+
+    @staticmethod
+    def _try_remove(path: str) -> bool:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Somebody still uses this asset.
+            return False
+        else:
+            os.unlink(path)
+            return True
+        finally:
+            os.close(fd)
@@ -0,0 +1,68 @@
+"""
+Caches of parsed and resolved templates, so templates stored as differences from the base one
+are validated and merged only once.
+"""
+
+import hashlib
+from collections import OrderedDict
+from typing import Any, Generic, TypeVar
+
+from .templates import Template
+
+KeyT = TypeVar("KeyT")
+ValueT = TypeVar("ValueT")
+
+
+def template_hash(data: str | bytes) -> str:
+    if isinstance(data, str):
+        data = data.encode()
+    return hashlib.sha256(data).hexdigest()
+
+
+class _LRUCache(Generic[KeyT, ValueT]):
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._items: OrderedDict[KeyT, ValueT] = OrderedDict()
+
+    def get(self, key: KeyT) -> ValueT | None:
+        value = self._items.get(key)
+        if value is not None:
+            self._items.move_to_end(key)
+        return value
+
+    def put(self, key: KeyT, value: ValueT) -> None:
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+
+class TemplateResolver:
+    """
+    Templates are cached by hash of their JSON, resolved ones by hashes of both the base and the delta.
+    """
+
+    def __init__(self, max_size: int = 256):
+        self._parsed: _LRUCache[str, Template] = _LRUCache(max_size)
+        self._resolved: _LRUCache[tuple[str, str], Template] = _LRUCache(max_size)
+
+    def parse(self, data: str | dict[str, Any], data_hash: str) -> Template:
+        template = self._parsed.get(data_hash)
+        if template is None:
+            if isinstance(data, str):
+                template = Template.model_validate_json(data)
+            else:
+                template = Template.model_validate(data)
+            self._parsed.put(data_hash, template)
+        return template
+
+    def get_resolved(self, base_hash: str, delta_hash: str) -> Template | None:
+        return self._resolved.get((base_hash, delta_hash))
+
+    def resolve(self, delta: Template, delta_hash: str, base: Template, base_hash: str) -> Template:
+        key = (base_hash, delta_hash)
+        resolved = self._resolved.get(key)
+        if resolved is None:
+            resolved = delta.resolve(base, base_hash)
+            self._resolved.put(key, resolved)
+        return resolved
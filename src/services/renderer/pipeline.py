@@ -0,0 +1,104 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Generic, TypeVar
+
+logger = logging.getLogger(__name__)
+
+JobT = TypeVar("JobT")
+
+DEFAULT_QUEUE_SIZE = 2
+
+
+@dataclass
+class Stage(Generic[JobT]):
+    name: str
+    # Returns the job for the next stage, or None if processing of the job is finished.
+    handler: Callable[[JobT], Awaitable[JobT | None]]
+    workers: int = 1
+
+
+class Pipeline(Generic[JobT]):
+    """
+    Runs jobs through a sequence of stages, each having its own workers and a bounded input queue.
+    While one job is processed by a stage, the next one may be already processed by the previous stage.
+    Bounded queues provide backpressure: `submit` waits while the first stage is saturated.
+    """
+
+    def __init__(
+        self,
+        stages: list[Stage[JobT]],
+        on_error: Callable[[JobT, Exception], Awaitable[None]],
+        queue_size: int = DEFAULT_QUEUE_SIZE,
+    ):
+        if not stages:
+            raise ValueError("Pipeline requires at least one stage")
+        self.stages = stages
+        self.on_error = on_error
+        self._queues: list[asyncio.Queue[JobT]] = [asyncio.Queue(maxsize=queue_size) for _ in stages]
+        self._busy = [0 for _ in stages]
+        self._processed = [0 for _ in stages]
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self) -> None:
+        for i, stage in enumerate(self.stages):
+            for n in range(stage.workers):
+                self._tasks.append(asyncio.create_task(self._worker(i), name=f"{stage.name}-{n}"))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def submit(self, job: JobT) -> None:
+        await self._queues[0].put(job)
+
+    def occupancy(self) -> dict[str, Any]:
+        """
+        Returns queue fill and busy workers per stage. The bottleneck is the stage with a full input queue
+        and all workers busy, while the following stages are mostly idle.
+        """
+        result: dict[str, Any] = {}
+        for stage, queue, busy, processed in zip(self.stages, self._queues, self._busy, self._processed):
+            result[f"{stage.name}.queue"] = f"{queue.qsize()}/{queue.maxsize}"
+            result[f"{stage.name}.busy"] = f"{busy}/{stage.workers}"
+            result[f"{stage.name}.processed"] = processed
+        return result
+
+    async def _worker(self, index: int) -> None:
+        stage = self.stages[index]
+        queue = self._queues[index]
+        while True:
+            job = await queue.get()
+            self._busy[index] += 1
+            try:
+                result = await stage.handler(job)
+            except Exception as e:
+                result = None
+                try:
+                    await self.on_error(job, e)
+                except Exception:
+                    logger.exception("Cannot handle error at stage %s", stage.name)
+            finally:
+                self._busy[index] -= 1
+                self._processed[index] += 1
+                queue.task_done()
+
+            if result is not None and index + 1 < len(self.stages):
+                await self._queues[index + 1].put(result)
+
+
+def parse_stage_workers(value: str | None) -> dict[str, int]:
+    """
+    Parses worker counts in form `stage=count,stage=count`.
+    """
+    result: dict[str, int] = {}
+    if not value:
+        return result
+    for item in value.split(","):
+        name, _, count = item.partition("=")
+        if not count:
+            raise ValueError(f"Bad stage workers specification: {item}")
+        result[name.strip()] = int(count)
+    return result
@@ -1,41 +1,252 @@
-import io
+import logging
+import math
+import unicodedata
 from abc import ABC, abstractmethod
+from concurrent.futures import Executor
+from dataclasses import dataclass
 from datetime import date, timedelta
-from functools import cached_property, lru_cache
+from functools import lru_cache
 from typing import Annotated, Any, ClassVar, Literal
 from uuid import UUID
 
 from nats.js.errors import ObjectNotFoundError
-from nats.js.object_store import ObjectStore
-from PIL import Image, ImageColor, ImageDraw, ImageFont
-from pydantic import BaseModel, ConfigDict, Field, model_validator
+from PIL import Image, ImageColor, ImageDraw, ImageFont, features
+from pydantic import (
+    BaseModel,
+    ConfigDict,
+    Field,
+    PrivateAttr,
+    SerializerFunctionWrapHandler,
+    model_serializer,
+    model_validator,
+)
 from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from .assets import AssetLoader
 from .weekdays import Entry, Schedule, WeekDay
 
 WEEK_LENGTH = len(WeekDay)
+# Extra pixels around the region of a day, so antialiasing never touches pixels of the neighbour region.
+REGION_PADDING = 2
+
+Box = tuple[int, int, int, int]
+
+LayoutEngine = Literal["basic", "raqm", "auto"]
+LAYOUT_ENGINES: dict[str, ImageFont.Layout] = {"basic": ImageFont.Layout.BASIC, "raqm": ImageFont.Layout.RAQM}
+DEFAULT_LAYOUT_ENGINE: LayoutEngine = "auto"
+HAVE_RAQM = features.check_feature("raqm")
+# Scripts which cannot be drawn correctly without shaping (reordering, joining or mark positioning).
+_COMPLEX_SCRIPT_RANGES = (
+    (0x0590, 0x08FF),  # Hebrew, Arabic, Syriac, Thaana, NKo and others
+    (0x0900, 0x0DFF),  # Indic scripts
+    (0x0E00, 0x0FFF),  # Thai, Lao, Tibetan
+    (0x1000, 0x109F),  # Myanmar
+    (0x1780, 0x17FF),  # Khmer
+    (0xFB1D, 0xFDFF),  # Hebrew and Arabic presentation forms
+    (0xFE70, 0xFEFF),  # Arabic presentation forms
+)
+_JOINERS = frozenset("\u200c\u200d")
+# Only used for measuring text, never drawn on.
+_MEASURE_DRAW = ImageDraw.Draw(Image.new("L", (1, 1)))
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=256)
+def load_font(
+    font_name: str, font_size: int = 72, layout_engine: ImageFont.Layout | None = None
+) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(font_name, size=font_size, layout_engine=layout_engine)
+
+
+@lru_cache(maxsize=4096)
+def text_size(
+    font_name: str, font_size: int, layout_engine: ImageFont.Layout, text: str, stroke_width: int = 0
+) -> tuple[int, int]:
+    font = load_font(font_name, font_size, layout_engine)
+    x0, y0, x1, y1 = _MEASURE_DRAW.multiline_textbbox((0, 0), text, font=font, stroke_width=stroke_width)
+    return math.ceil(x1 - x0), math.ceil(y1 - y0)
+
+
+@lru_cache(maxsize=4096)
+def fit_font_size(
+    font_name: str,
+    min_font_size: int,
+    max_font_size: int,
+    layout_engine: ImageFont.Layout,
+    text: str,
+    box: tuple[int, int],
+    stroke_width: int = 0,
+) -> int:
+    """
+    Returns the largest font size for which the text fits into the box, or the minimal size if none does.
+    """
+    low, high = min_font_size, max_font_size
+    while low < high:
+        middle = (low + high + 1) // 2
+        width, height = text_size(font_name, middle, layout_engine, text, stroke_width)
+        if width <= box[0] and height <= box[1]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def needs_complex_layout(text: str) -> bool:
+    for char in text:
+        code = ord(char)
+        if code < 0x0300:
+            # Fast path for Latin text.
+            continue
+        if unicodedata.combining(char) or char in _JOINERS:
+            return True
+        if any(start <= code <= end for start, end in _COMPLEX_SCRIPT_RANGES):
+            return True
+    return False
+
+
+def resolve_layout_engine(engine: LayoutEngine, text: str) -> ImageFont.Layout:
+    """
+    Basic layout is much faster than Raqm, so in automatic mode Raqm is used only if the text requires it.
+    Without Raqm installed, basic layout is always used.
+    """
+    if not HAVE_RAQM:
+        return ImageFont.Layout.BASIC
+    if engine == "auto":
+        return ImageFont.Layout.RAQM if needs_complex_layout(text) else ImageFont.Layout.BASIC
+    return LAYOUT_ENGINES[engine]
+
+
+def _points_bbox(points: list[tuple[int, int]], width: int) -> Box:
+    xs = [x for x, _ in points]
+    ys = [y for _, y in points]
+    # Wide lines and outlines may be drawn on both sides of the points.
+    return min(xs) - width, min(ys) - width, max(xs) + width + 1, max(ys) + width + 1
+
+
+class DrawOp(ABC):
+    """
+    A patch with all formatting and asset loading already done, so only pixel work is left.
+    """
 
+    @abstractmethod
+    def bbox(self, draw: ImageDraw.ImageDraw) -> Box:
+        raise NotImplementedError
 
-@lru_cache(maxsize=64)
-def load_font(font_name: str, font_size: int = 72) -> ImageFont.FreeTypeFont:
-    return ImageFont.truetype(font_name, size=font_size)
+    @abstractmethod
+    def draw(self, image: Image.Image, draw: ImageDraw.ImageDraw, origin: tuple[int, int] = (0, 0)) -> None:
+        raise NotImplementedError
+
+
+@dataclass
+class TextDrawOp(DrawOp):
+    xy: tuple[int, int]
+    text: str
+    font: ImageFont.FreeTypeFont
+    fill: str
+    anchor: str
+    stroke_width: int
+    stroke_fill: str | None
+
+    def bbox(self, draw: ImageDraw.ImageDraw) -> Box:
+        x0, y0, x1, y1 = draw.multiline_textbbox(
+            xy=self.xy,
+            text=self.text,
+            font=self.font,
+            anchor=self.anchor,
+            stroke_width=self.stroke_width,
+        )
+        return math.floor(x0), math.floor(y0), math.ceil(x1), math.ceil(y1)
+
+    def draw(self, image: Image.Image, draw: ImageDraw.ImageDraw, origin: tuple[int, int] = (0, 0)) -> None:
+        x, y = self.xy
+        draw.multiline_text(
+            xy=(x - origin[0], y - origin[1]),
+            text=self.text,
+            fill=self.fill,
+            font=self.font,
+            anchor=self.anchor,
+            stroke_width=self.stroke_width,
+            stroke_fill=self.stroke_fill,
+        )
+
+
+@dataclass
+class ImageDrawOp(DrawOp):
+    xy: tuple[int, int]
+    patch: Image.Image
+
+    def bbox(self, draw: ImageDraw.ImageDraw) -> Box:
+        x, y = self.xy
+        w, h = self.patch.size
+        return x, y, x + w, y + h
+
+    def draw(self, image: Image.Image, draw: ImageDraw.ImageDraw, origin: tuple[int, int] = (0, 0)) -> None:
+        x, y = self.xy
+        mask = self.patch.getchannel("A")
+        image.paste(self.patch, (x - origin[0], y - origin[1]), mask=mask)
+
+
+@dataclass
+class ShapeDrawOp(DrawOp):
+    shape: Literal["rectangle", "rounded_rectangle", "line", "ellipse", "polygon"]
+    points: list[tuple[int, int]]
+    fill: str | None
+    outline: str | None = None
+    width: int = 1
+    radius: int = 0
+
+    def bbox(self, draw: ImageDraw.ImageDraw) -> Box:
+        return _points_bbox(self.points, self.width)
+
+    def draw(self, image: Image.Image, draw: ImageDraw.ImageDraw, origin: tuple[int, int] = (0, 0)) -> None:
+        points = [(x - origin[0], y - origin[1]) for x, y in self.points]
+        if self.shape == "line":
+            draw.line(points, fill=self.fill, width=self.width)
+        elif self.shape == "polygon":
+            draw.polygon(points, fill=self.fill, outline=self.outline, width=self.width)
+        elif self.shape == "rectangle":
+            draw.rectangle(points, fill=self.fill, outline=self.outline, width=self.width)
+        elif self.shape == "rounded_rectangle":
+            draw.rounded_rectangle(points, radius=self.radius, fill=self.fill, outline=self.outline, width=self.width)
+        elif self.shape == "ellipse":
+            draw.ellipse(points, fill=self.fill, outline=self.outline, width=self.width)
 
 
 class TemplateModel(BaseModel):
     model_config = ConfigDict(extra="forbid")
+    # Fields added after templates were first stored. They are not dumped while they keep their defaults,
+    # so dumps of existing templates do not change.
+    omitted_defaults: ClassVar[frozenset[str]] = frozenset()
+
+    @model_serializer(mode="wrap")
+    def _omit_defaults(self, handler: SerializerFunctionWrapHandler) -> Any:
+        data = handler(self)
+        for name in self.omitted_defaults:
+            field = self.model_fields[name]
+            if isinstance(data, dict) and getattr(self, name) == field.get_default(call_default_factory=True):
+                data.pop(field.alias or name, None)
+                data.pop(name, None)
+        return data
 
 
 class BasePatch(TemplateModel, ABC):
     type: str
 
     @abstractmethod
-    async def apply(self, image: Image.Image, draw: ImageDraw.ImageDraw, format_args: dict[str, Any], **kwargs) -> None:
+    async def prepare(self, format_args: dict[str, Any], **kwargs) -> list[DrawOp]:
         raise NotImplementedError
 
+    async def apply(self, image: Image.Image, draw: ImageDraw.ImageDraw, format_args: dict[str, Any], **kwargs) -> None:
+        for op in await self.prepare(format_args, **kwargs):
+            op.draw(image, draw)
+
 
 class BasePositionedPatch(BasePatch, ABC):
     xy: tuple[int, int]
+    # Allows templates inheriting this one to replace or remove the patch.
+    id: str | None = None
     required_tag: str | None = Field(default=None, alias="tag", deprecated=True)
     required_tags: set[str] | None = None
     forbidden_tags: set[str] | None = None
@@ -54,10 +265,13 @@ class BasePositionedPatch(BasePatch, ABC):
                 self.required_tags = set()
             self.required_tags.add(self.required_tag)
             self.required_tag = None
+            # Otherwise tags are lost when the patch is dumped without unset fields.
+            self.model_fields_set.add("required_tags")
 
 
 class TextPatch(BasePositionedPatch):
     type: Literal["text"] = "text"
+    omitted_defaults = frozenset({"min_font_size"})
 
     template: str = Field(alias="text", description="f-string template for this patch")
     fill: str = Field(alias="color", default="black")
@@ -68,15 +282,41 @@ class TextPatch(BasePositionedPatch):
     stroke_width: int = 0
     stroke_fill: str | None = Field(default=None, alias="stroke_color")
     capitalization: Literal["u", "l", "c"] | None = Field(default=None)
+    # If not specified, the engine chosen for the deployment is used.
+    layout_engine: LayoutEngine | None = None
+    # If specified, font size is decreased down to `min_font_size` until the text fits into the box.
+    max_box: tuple[int, int] | None = None
+    min_font_size: int = 8
 
-    @cached_property
-    def _font(self) -> ImageFont.FreeTypeFont:
+    def _get_font(self, layout_engine: ImageFont.Layout, font_size: int | None = None) -> ImageFont.FreeTypeFont:
         try:
-            return load_font(self.font_name, self.font_size)
+            return load_font(self.font_name, font_size or self.font_size, layout_engine)
         except OSError as e:
             raise ValueError(f"No font named {self.font_name}") from e
 
-    async def apply(self, image: Image.Image, draw: ImageDraw.ImageDraw, format_args: dict[str, Any], **kwargs) -> None:
+    def _fit_font_size(self, layout_engine: ImageFont.Layout, text: str) -> int:
+        if self.max_box is None:
+            return self.font_size
+        try:
+            return fit_font_size(
+                self.font_name,
+                self.min_font_size,
+                self.font_size,
+                layout_engine,
+                text,
+                self.max_box,
+                self.stroke_width,
+            )
+        except OSError as e:
+            raise ValueError(f"No font named {self.font_name}") from e
+
+    async def prepare(
+        self,
+        format_args: dict[str, Any],
+        assets: AssetLoader | None = None,
+        layout_engine: LayoutEngine = DEFAULT_LAYOUT_ENGINE,
+        **kwargs,
+    ) -> list[DrawOp]:
         formatted_text = self.template.format(**format_args)
         if self.capitalization == "u":
             formatted_text = formatted_text.upper()
@@ -85,21 +325,29 @@ class TextPatch(BasePositionedPatch):
         elif self.capitalization == "c":
             formatted_text = formatted_text.capitalize()
 
-        draw.multiline_text(
-            xy=self.xy,
-            text=formatted_text,
-            fill=self.fill,
-            font=self._font,
-            anchor=self.anchor,
-            stroke_width=self.stroke_width,
-            stroke_fill=self.stroke_fill,
-        )
+        engine = resolve_layout_engine(self.layout_engine or layout_engine, formatted_text)
+        font_size = self._fit_font_size(engine, formatted_text)
+        if assets is not None:
+            assets.record_font(self.font_name, font_size, engine.name.lower())
+        return [
+            TextDrawOp(
+                xy=self.xy,
+                text=formatted_text,
+                font=self._get_font(engine, font_size),
+                fill=self.fill,
+                anchor=self.anchor,
+                stroke_width=self.stroke_width,
+                stroke_fill=self.stroke_fill,
+            )
+        ]
 
     def check(self) -> None:
         _ = ImageColor.getrgb(self.fill)
         if self.stroke_fill is not None:
             _ = ImageColor.getrgb(self.stroke_fill)
-        _ = self._font
+        if self.max_box is not None and not 0 < self.min_font_size <= self.font_size:
+            raise ValueError("Minimal font size must be positive and not greater than font size")
+        _ = self._get_font(ImageFont.Layout.BASIC)
 
 
 class ImagePatch(BasePositionedPatch):
@@ -113,8 +361,8 @@ class ImagePatch(BasePositionedPatch):
         if self.name is None and self.element_id is None:
             raise ValueError("Either name or element id is required")
 
-    async def _get_patch(self, store: ObjectStore | None = None, session: AsyncSession | None = None) -> Image.Image:
-        if store is None:
+    async def _get_patch(self, assets: AssetLoader | None = None, session: AsyncSession | None = None) -> Image.Image:
+        if assets is None:
             raise ValueError("Cannot get patch without store")
 
         if self.element_id is not None:
@@ -131,41 +379,158 @@ class ImagePatch(BasePositionedPatch):
             element_id = f"0.{element_uuid}"
 
         try:
-            result = await store.get(element_id)
+            return await assets.get_image(element_id, mode="RGBA")
         except ObjectNotFoundError as e:
             raise ValueError(f"Missing element {element_id} ({self.name=})") from e
-        stream = io.BytesIO(result.data)
-        return Image.open(stream).convert(mode="RGBA")
 
-    async def apply(
+    async def prepare(
         self,
-        image: Image.Image,
-        draw: ImageDraw.ImageDraw,
         format_args: dict[str, Any],
-        store: ObjectStore | None = None,
+        assets: AssetLoader | None = None,
         session: AsyncSession | None = None,
         **kwargs,
-    ) -> None:
-        patch = await self._get_patch(store, session)
-        mask = patch.getchannel("A")
-        image.paste(patch, self.xy, mask=mask)
+    ) -> list[DrawOp]:
+        patch = await self._get_patch(assets, session)
+        return [ImageDrawOp(xy=self.xy, patch=patch)]
+
+
+class ShapePatch(BasePositionedPatch, ABC):
+    """
+    Vector shape drawn without any assets. Colors may have alpha channel, e.g. `#00000080`.
+    """
+
+    fill: str | None = Field(default=None, alias="color")
+    outline: str | None = Field(default=None, alias="outline_color")
+    outline_width: int = 1
+
+    def model_post_init(self, __context: Any) -> None:
+        super().model_post_init(__context)
+        if self.fill is None and self.outline is None:
+            raise ValueError("Either color or outline color is required")
+
+    @abstractmethod
+    def draw_op(self) -> ShapeDrawOp:
+        raise NotImplementedError
+
+    @abstractmethod
+    def bbox(self) -> Box:
+        raise NotImplementedError
+
+    async def prepare(self, format_args: dict[str, Any], **kwargs) -> list[DrawOp]:
+        return [self.draw_op()]
+
+    def check(self) -> None:
+        if self.fill is not None:
+            _ = ImageColor.getrgb(self.fill)
+        if self.outline is not None:
+            _ = ImageColor.getrgb(self.outline)
+
+
+class BoxedShapePatch(ShapePatch, ABC):
+    # Width and height of the bounding box, `xy` is its top left corner.
+    size: tuple[Annotated[int, Field(ge=0)], Annotated[int, Field(ge=0)]]
+
+    @property
+    def _corners(self) -> list[tuple[int, int]]:
+        x, y = self.xy
+        width, height = self.size
+        return [(x, y), (x + width, y + height)]
+
+    def bbox(self) -> Box:
+        return _points_bbox(self._corners, self.outline_width)
+
+
+class RectanglePatch(BoxedShapePatch):
+    type: Literal["rectangle"] = "rectangle"
+
+    def draw_op(self) -> ShapeDrawOp:
+        return ShapeDrawOp("rectangle", self._corners, self.fill, self.outline, self.outline_width)
+
+
+class RoundedRectanglePatch(BoxedShapePatch):
+    type: Literal["rounded_rectangle"] = "rounded_rectangle"
+
+    radius: int = Field(default=10, ge=0)
+
+    def draw_op(self) -> ShapeDrawOp:
+        return ShapeDrawOp(
+            "rounded_rectangle", self._corners, self.fill, self.outline, self.outline_width, radius=self.radius
+        )
+
+
+class EllipsePatch(BoxedShapePatch):
+    type: Literal["ellipse"] = "ellipse"
+
+    def draw_op(self) -> ShapeDrawOp:
+        return ShapeDrawOp("ellipse", self._corners, self.fill, self.outline, self.outline_width)
+
+
+class PolygonPatch(ShapePatch):
+    type: Literal["polygon"] = "polygon"
+
+    # Vertices relative to `xy`, so the same shape may be moved by changing `xy` only.
+    points: list[tuple[int, int]] = Field(min_length=3)
+
+    @property
+    def _absolute_points(self) -> list[tuple[int, int]]:
+        x, y = self.xy
+        return [(x + dx, y + dy) for dx, dy in self.points]
+
+    def draw_op(self) -> ShapeDrawOp:
+        return ShapeDrawOp("polygon", self._absolute_points, self.fill, self.outline, self.outline_width)
+
+    def bbox(self) -> Box:
+        return _points_bbox(self._absolute_points, self.outline_width)
+
+
+class LinePatch(BasePositionedPatch):
+    type: Literal["line"] = "line"
+
+    end: tuple[int, int]
+    fill: str = Field(default="black", alias="color")
+    width: int = Field(default=1, ge=1)
+
+    def draw_op(self) -> ShapeDrawOp:
+        return ShapeDrawOp("line", [self.xy, self.end], self.fill, width=self.width)
+
+    def bbox(self) -> Box:
+        return _points_bbox([self.xy, self.end], self.width)
+
+    async def prepare(self, format_args: dict[str, Any], **kwargs) -> list[DrawOp]:
+        return [self.draw_op()]
+
+    def check(self) -> None:
+        _ = ImageColor.getrgb(self.fill)
+
+
+AnyPatch = Annotated[
+    TextPatch | ImagePatch | RectanglePatch | RoundedRectanglePatch | EllipsePatch | PolygonPatch | LinePatch,
+    Field(discriminator="type"),
+]
 
 
 class PatchSet(BasePatch):
     type: Literal["set"] = "set"
-    patches: list[Annotated[TextPatch | ImagePatch, Field(discriminator="type")]] = Field(default_factory=list)
-
-    async def apply(
-        self,
-        image: Image.Image,
-        draw: ImageDraw.ImageDraw,
-        format_args: dict[str, Any],
-        tags: set[str] | None = None,
-        **kwargs,
-    ) -> None:
+    omitted_defaults = frozenset({"removed_ids"})
+    patches: list[AnyPatch] = Field(default_factory=list)
+    # Only used in inheriting templates: ids of patches of the base template which should not be drawn.
+    removed_ids: set[str] = Field(default_factory=set, alias="remove")
+
+    def merge(self, delta: "PatchSet") -> "PatchSet":
+        """
+        Patches of the delta replace patches with the same id, other ones are appended.
+        """
+        overrides = {patch.id: patch for patch in delta.patches if patch.id is not None}
+        patches = [overrides.pop(patch.id, patch) for patch in self.patches if patch.id not in delta.removed_ids]
+        patches.extend(patch for patch in delta.patches if patch.id is None or patch.id in overrides)
+        return PatchSet(patches=patches)
+
+    async def prepare(self, format_args: dict[str, Any], tags: set[str] | None = None, **kwargs) -> list[DrawOp]:
+        ops: list[DrawOp] = []
         for patch in self.patches:
             if patch.is_visible(tags):
-                await patch.apply(image, draw, format_args, **kwargs)
+                ops.extend(await patch.prepare(format_args, **kwargs))
+        return ops
 
     @model_validator(mode="before")
     @classmethod
@@ -184,41 +549,102 @@ class DayPatch(TemplateModel):
 
     TOTAL_TAG_TEMPLATE: ClassVar[str] = "total={}"
 
-    async def apply(
-        self, image: Image.Image, draw: ImageDraw.ImageDraw, format_args: dict[str, Any], entries: list[Entry], **kwargs
-    ) -> None:
-        await self.always.apply(image, draw, format_args, **kwargs)
+    def merge(self, delta: "DayPatch") -> "DayPatch":
+        """
+        Patch sets given in the delta are merged into the ones of this day, record patches are replaced as a whole.
+        """
+        update: dict[str, Any] = {}
+        if "always" in delta.model_fields_set:
+            update["always"] = self.always.merge(delta.always)
+        if "if_none" in delta.model_fields_set:
+            update["if_none"] = self.if_none.merge(delta.if_none)
+        if "record_patches" in delta.model_fields_set:
+            update["record_patches"] = delta.record_patches
+        return self.model_copy(update=update)
+
+    async def prepare(self, format_args: dict[str, Any], entries: list[Entry], **kwargs) -> list[DrawOp]:
+        ops = await self.always.prepare(format_args, **kwargs)
         n_total = len(entries)
         for entry, record_patch in zip(entries, self.record_patches):
             format_args["entry"] = entry
             tags = entry.tags | {self.TOTAL_TAG_TEMPLATE.format(n_total)}
-            await record_patch.apply(image, draw, format_args, tags=tags, **kwargs)
+            ops.extend(await record_patch.prepare(format_args, tags=tags, **kwargs))
         if not entries:
-            await self.if_none.apply(image, draw, format_args, **kwargs)
+            ops.extend(await self.if_none.prepare(format_args, **kwargs))
+        return ops
 
 
 class Template(TemplateModel):
+    # If set, the template only contains differences from the base template, see `resolve`.
+    base: Literal["global"] | None = None
     always: PatchSet = Field(default_factory=PatchSet)
     patches: dict[WeekDay, DayPatch] = Field(default_factory=dict)
 
     width: int = 1920
     height: int = 1098
 
-    async def apply(
+    _delta: "Template | None" = PrivateAttr(default=None)
+    _base_hash: str | None = PrivateAttr(default=None)
+
+    @property
+    def delta(self) -> "Template | None":
+        """
+        The inheriting template this one is resolved from.
+        """
+        return self._delta
+
+    @property
+    def base_hash(self) -> str | None:
+        return self._base_hash
+
+    def resolve(self, base: "Template", base_hash: str | None = None) -> "Template":
+        """
+        Applies this template over the base one: fields given in this template replace fields of the base one,
+        except for patch sets and days, which are merged.
+        """
+        if self.base is None:
+            return self
+        if base.base is not None:
+            raise ValueError("Base template cannot inherit another template")
+        update: dict[str, Any] = {name: getattr(self, name) for name in self.model_fields_set - {"always", "patches"}}
+        update["base"] = None
+        if "always" in self.model_fields_set:
+            update["always"] = base.always.merge(self.always)
+        if "patches" in self.model_fields_set:
+            days = dict(base.patches)
+            for weekday, day_patch in self.patches.items():
+                days[weekday] = days[weekday].merge(day_patch) if weekday in days else day_patch
+            update["patches"] = days
+        resolved = base.model_copy(update=update)
+        resolved._delta = self
+        resolved._base_hash = base_hash
+        return resolved
+
+    def dump(self) -> dict[str, Any]:
+        # Unset fields of inheriting templates are skipped, otherwise defaults would override the base template.
+        return self.model_dump(by_alias=True, exclude_none=True, exclude_unset=self.base is not None, mode="json")
+
+    def dump_json(self) -> str:
+        return self.model_dump_json(by_alias=True, exclude_none=True, exclude_unset=self.base is not None)
+
+    async def prepare(
         self,
-        image: Image.Image,
-        draw: ImageDraw.ImageDraw,
         start_date: date,
         schedule: Schedule,
-        store: ObjectStore | None = None,
+        assets: AssetLoader | None = None,
         session: AsyncSession | None = None,
-    ):
+        layout_engine: LayoutEngine = DEFAULT_LAYOUT_ENGINE,
+    ) -> list[list[DrawOp]]:
+        """
+        Returns drawing operations grouped in layers: the first one is for global patches, then one per day.
+        """
         format_args: dict[str, Any] = {
             "start": start_date,
             "end": start_date + timedelta(days=WEEK_LENGTH - 1),
             **{f"day{i + 1}": start_date + timedelta(days=i) for i in range(WEEK_LENGTH)},
         }
-        await self.always.apply(image, draw, format_args, store=store, session=session)
+        kwargs: dict[str, Any] = {"assets": assets, "session": session, "layout_engine": layout_engine}
+        layers = [await self.always.prepare(format_args, **kwargs)]
 
         for i, weekday in enumerate(WeekDay):
             day_patch = self.patches.get(weekday)
@@ -226,4 +652,77 @@ class Template(TemplateModel):
                 continue
             records: list[Entry] = schedule.records.get(weekday) or []
             format_args["date"] = start_date + timedelta(days=i)
-            await day_patch.apply(image, draw, format_args, records, store=store, session=session)
+            layers.append(await day_patch.prepare(format_args, records, **kwargs))
+        return layers
+
+    async def apply(
+        self,
+        image: Image.Image,
+        draw: ImageDraw.ImageDraw,
+        start_date: date,
+        schedule: Schedule,
+        assets: AssetLoader | None = None,
+        session: AsyncSession | None = None,
+        executor: Executor | None = None,
+        layout_engine: LayoutEngine = DEFAULT_LAYOUT_ENGINE,
+    ):
+        layers = await self.prepare(start_date, schedule, assets=assets, session=session, layout_engine=layout_engine)
+        draw_layers(image, draw, layers, executor=executor)
+
+
+def draw_layers(
+    image: Image.Image, draw: ImageDraw.ImageDraw, layers: list[list[DrawOp]], executor: Executor | None = None
+) -> None:
+    """
+    Draws prepared layers in order.
+    The first layer is always drawn directly since global patches may cover the whole image.
+    If executor is given and the other layers occupy disjoint regions,
+    each of them is drawn in a separate thread on its own sub-canvas and then pasted back.
+    """
+    base, *regional = layers
+    for op in base:
+        op.draw(image, draw)
+
+    regional = [ops for ops in regional if ops]
+    regions = _layer_regions(draw, regional, image.size) if executor is not None and len(regional) > 1 else None
+    if regions is None:
+        for ops in regional:
+            for op in ops:
+                op.draw(image, draw)
+        return
+
+    assert executor is not None
+    futures = [
+        executor.submit(_draw_region, image.crop(region), ops, (region[0], region[1]))
+        for region, ops in zip(regions, regional)
+    ]
+    for region, future in zip(regions, futures):
+        image.paste(future.result(), (region[0], region[1]))
+
+
+def _draw_region(canvas: Image.Image, ops: list[DrawOp], origin: tuple[int, int]) -> Image.Image:
+    draw = ImageDraw.ImageDraw(canvas, mode="RGBA")
+    for op in ops:
+        op.draw(canvas, draw, origin)
+    return canvas
+
+
+def _layer_regions(draw: ImageDraw.ImageDraw, layers: list[list[DrawOp]], size: tuple[int, int]) -> list[Box] | None:
+    """
+    Returns the region for each layer, or None if some of them overlap and layers must be drawn serially.
+    """
+    width, height = size
+    regions: list[Box] = []
+    for ops in layers:
+        boxes = [op.bbox(draw) for op in ops]
+        x0 = max(min(b[0] for b in boxes) - REGION_PADDING, 0)
+        y0 = max(min(b[1] for b in boxes) - REGION_PADDING, 0)
+        x1 = min(max(b[2] for b in boxes) + REGION_PADDING, width)
+        y1 = min(max(b[3] for b in boxes) + REGION_PADDING, height)
+        region = (x0, y0, max(x1, x0), max(y1, y0))
+        for other in regions:
+            if region[0] < other[2] and other[0] < region[2] and region[1] < other[3] and other[1] < region[3]:
+                logger.debug("Regions %s and %s overlap, drawing serially", region, other)
+                return None
+        regions.append(region)
+    return regions
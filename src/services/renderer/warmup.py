@@ -0,0 +1,98 @@
+"""
+Warming up of caches with the most used assets and fonts before the renderer starts accepting messages.
+"""
+
+import asyncio
+import logging
+import time
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+
+from nats.js.kv import KeyValue
+
+from .access_stats import SEPARATOR, AccessStats
+from .assets import AssetLoader
+from .templates import LAYOUT_ENGINES, load_font
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class WarmupSettings:
+    top_k: int = 50
+    timeout: float = 30.0
+    memory_budget: int = 256 * 2**20
+    flush_interval: float = 300.0
+    ready_file: str | None = None
+
+
+def _split(key: str) -> tuple[str, str]:
+    name, _, rest = key.rpartition(SEPARATOR)
+    return name, rest
+
+
+async def warm_up(kv: KeyValue, assets: AssetLoader, settings: WarmupSettings) -> None:
+    """
+    Preloads the most used fonts and assets until time or memory budget is exhausted.
+    """
+    asset_counts, font_counts, _ = await AccessStats.load(kv)
+    start = time.monotonic()
+
+    n_fonts = 0
+    n_assets = 0
+    used_memory = 0
+    try:
+        async with asyncio.timeout(settings.timeout):
+            for key, _count in Counter(font_counts).most_common(settings.top_k):
+                font_key, layout_engine = _split(key)
+                font_name, font_size = _split(font_key)
+                try:
+                    load_font(font_name, int(font_size), LAYOUT_ENGINES[layout_engine])
+                except (OSError, ValueError, KeyError):
+                    logger.info("Skip warming up missing font %s", key)
+                    continue
+                finally:
+                    # Fonts are loaded synchronously, so the timeout may only expire between them.
+                    await asyncio.sleep(0)
+                n_fonts += 1
+
+            if assets.shared_cache is None and assets.disk_cache is None:
+                logger.info("No asset cache is configured, skip warming up assets")
+            else:
+                for key, _count in Counter(asset_counts).most_common(settings.top_k):
+                    name, mode = _split(key)
+                    try:
+                        # Warm-up loads are not recorded, otherwise each restart would promote the same assets.
+                        image = await assets.get_image(name, mode=mode, record=False)
+                    except Exception:
+                        logger.info("Skip warming up asset %s", key, exc_info=True)
+                        continue
+                    finally:
+                        # Images found in the shared memory cache are returned without suspending.
+                        await asyncio.sleep(0)
+                    n_assets += 1
+                    used_memory += image.width * image.height * len(image.getbands())
+                    if used_memory >= settings.memory_budget:
+                        logger.info("Memory budget for warming up is exhausted")
+                        break
+    except TimeoutError:
+        logger.info("Time budget for warming up is exhausted")
+
+    logger.info(
+        "Warmed up %d fonts and %d assets (%.1f MB) in %.1f s",
+        n_fonts,
+        n_assets,
+        used_memory / 2**20,
+        time.monotonic() - start,
+    )
+
+
+def mark_ready(settings: WarmupSettings, ready: bool) -> None:
+    if settings.ready_file is None:
+        return
+    path = Path(settings.ready_file)
+    if ready:
+        path.touch()
+    else:
+        path.unlink(missing_ok=True)
@@ -2,18 +2,38 @@ import asyncio
 import logging
 import os
 from asyncio import Event
+from collections import deque
 from functools import partial
+from typing import Any, Awaitable, Callable, Sequence
 
 import nats
 from aiogram import Bot
 from aiogram.client.default import DefaultBotProperties
-from aiogram.exceptions import TelegramRetryAfter
-from aiogram.types import BufferedInputFile
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramEntityTooLarge,
+    TelegramForbiddenError,
+    TelegramMigrateToChat,
+    TelegramNotFound,
+    TelegramRetryAfter,
+)
+from aiogram.types import BufferedInputFile, InputMediaDocument
 from nats.aio.msg import Msg
 from nats.js import JetStreamContext
 from nats.js.api import ObjectStoreConfig, StorageType
+from nats.js.errors import ObjectNotFoundError
 from nats.js.object_store import ObjectStore
 
+from services.sender.cleanup import DEFAULT_DELETE_GRACE, RenderedCleanup
+from services.sender.rate_limit import (
+    DEFAULT_CHAT_RATE,
+    DEFAULT_GLOBAL_RATE,
+    DEFAULT_GROUP_RATE,
+    RateLimiter,
+)
+from services.stats import start_stats_task
+
 RESULT_BUCKET_NAME = "rendered"
 
 INPUT_RAW_SUBJECT_NAME = "schedules.ready"
@@ -24,15 +44,191 @@ IMAGE_FORMAT = "png"
 USER_ID_HEADER = "Sch-User-Id"
 CHAT_ID_HEADER = "Sch-Chat-Id"
 
+DEFAULT_CONCURRENCY = 16
+# Held messages are marked as in progress this often, well within the default acknowledgement timeout of 30 s,
+# since a burst to a group chat may wait for minutes.
+IN_PROGRESS_INTERVAL = 10.0
+# Errors after which sending the same message again is pointless, e.g. the bot is blocked or the file is too large.
+PERMANENT_ERRORS = (
+    TelegramBadRequest,
+    TelegramEntityTooLarge,
+    TelegramForbiddenError,
+    TelegramMigrateToChat,
+    TelegramNotFound,
+)
+# Renders completed for the same chat within this time are sent as one media group.
+DEFAULT_GROUP_WINDOW = 0.5
+# Largest media group allowed by Telegram.
+MEDIA_GROUP_LIMIT = 10
+
 logger = logging.getLogger(__name__)
 
 
-async def send_raw(msg: Msg, bot: Bot, filename="Schedule.png") -> None:
+class SendPool:
+    """
+    Sends up to `limit` messages at once. Messages to the same chat are handled one by one in order of arrival.
+    While messages wait for their chat, for a free slot or for the rate limit, they are periodically marked
+    as in progress, so NATS does not redeliver them.
+    """
+
+    def __init__(self, limit: int = DEFAULT_CONCURRENCY, in_progress_interval: float = IN_PROGRESS_INTERVAL):
+        self.limit = limit
+        self.in_progress_interval = in_progress_interval
+        self._slots = asyncio.Semaphore(limit)
+        self._chats: dict[int, deque[tuple[Callable[[], Awaitable[None]], Sequence[Msg]]]] = {}
+        self._running: dict[int, Sequence[Msg]] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self._touch_task: asyncio.Task | None = None
+        self._held = 0
+        self._sending = 0
+
+    async def submit(self, chat_id: int, job: Callable[[], Awaitable[None]], messages: Sequence[Msg] = ()) -> None:
+        """
+        Queues the job without waiting, so a busy chat does not stop the subscription callback and every delivered
+        message is marked as in progress. Their number is limited by `max_ack_pending` of the NATS consumer.
+        `messages` are the ones acknowledged by the job.
+        """
+        self._held += 1
+        if self._touch_task is None or self._touch_task.done():
+            self._touch_task = asyncio.create_task(self._touch_periodically())
+        if (queue := self._chats.get(chat_id)) is not None:
+            queue.append((job, messages))
+            return
+        self._chats[chat_id] = deque([(job, messages)])
+        task = asyncio.create_task(self._run_chat(chat_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_chat(self, chat_id: int) -> None:
+        queue = self._chats[chat_id]
+        while queue:
+            job, self._running[chat_id] = queue.popleft()
+            try:
+                async with self._slots:
+                    self._sending += 1
+                    try:
+                        await job()
+                    finally:
+                        self._sending -= 1
+            except Exception:
+                # Message is not acknowledged and will be redelivered.
+                logger.exception("Failed to send message to chat %d", chat_id)
+            finally:
+                del self._running[chat_id]
+                self._held -= 1
+        del self._chats[chat_id]
+
+    async def _touch_periodically(self) -> None:
+        while self._held:
+            await asyncio.sleep(self.in_progress_interval)
+            held = [msg for messages in self._running.values() for msg in messages]
+            held.extend(msg for queue in self._chats.values() for _, messages in queue for msg in messages)
+            for msg in held:
+                try:
+                    await msg.in_progress()
+                except Exception:
+                    # Message may be acknowledged in the meantime.
+                    logger.debug("Cannot mark message as in progress", exc_info=True)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "pool.sending": f"{self._sending}/{self.limit}",
+            "pool.messages": self._held,
+            "pool.chats": len(self._chats),
+        }
+
+    async def drain(self) -> None:
+        while self._tasks:
+            await asyncio.gather(*self._tasks)
+        if self._touch_task is not None:
+            self._touch_task.cancel()
+
+
+def _chat_id(msg: Msg) -> int:
     if msg.headers is None:
         logger.error("Got message without headers")
         raise ValueError("Headers are required for message processing")
+    return int(msg.headers[CHAT_ID_HEADER])
+
+
+class ChatBatcher:
+    """
+    Collects messages for each chat during `window` seconds after the first one, but no more than `max_size`,
+    and submits them to the pool as one job. Non-positive window disables collecting.
+    """
+
+    def __init__(
+        self,
+        pool: SendPool,
+        handler: Callable[[list[Msg]], Awaitable[None]],
+        window: float = DEFAULT_GROUP_WINDOW,
+        max_size: int = MEDIA_GROUP_LIMIT,
+    ):
+        self.pool = pool
+        self.handler = handler
+        self.window = window
+        self.max_size = max_size
+        self._batches: dict[int, list[Msg]] = {}
+        self._timers: dict[int, asyncio.TimerHandle] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self.flushed = 0
+        self.flushed_messages = 0
 
-    chat_id = int(msg.headers[CHAT_ID_HEADER])
+    async def add(self, chat_id: int, msg: Msg) -> None:
+        batch = self._batches.setdefault(chat_id, [])
+        batch.append(msg)
+        if len(batch) >= self.max_size or self.window <= 0:
+            await self.flush(chat_id)
+        elif len(batch) == 1:
+            self._timers[chat_id] = asyncio.get_running_loop().call_later(self.window, self._flush_later, chat_id)
+
+    def _flush_later(self, chat_id: int) -> None:
+        task = asyncio.create_task(self.flush(chat_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self, chat_id: int) -> None:
+        """
+        Submits collected messages of the chat. Other messages to the chat are submitted after flushing,
+        so they are not sent before earlier renders.
+        """
+        if (timer := self._timers.pop(chat_id, None)) is not None:
+            timer.cancel()
+        if batch := self._batches.pop(chat_id, None):
+            self.flushed += 1
+            self.flushed_messages += len(batch)
+            await self.pool.submit(chat_id, partial(self.handler, batch), batch)
+
+    async def flush_all(self) -> None:
+        for chat_id in list(self._batches):
+            await self.flush(chat_id)
+        while self._tasks:
+            await asyncio.gather(*self._tasks)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "batch.buffered": sum(map(len, self._batches.values())),
+            "batch.flushed": self.flushed,
+            "batch.messages": self.flushed_messages,
+        }
+
+
+async def dispatch(
+    msg: Msg, handler: Callable[[Msg], Awaitable[None]], pool: SendPool, batcher: ChatBatcher | None = None
+) -> None:
+    chat_id = _chat_id(msg)
+    if batcher is not None:
+        await batcher.flush(chat_id)
+    await pool.submit(chat_id, partial(handler, msg), [msg])
+
+
+async def dispatch_batched(msg: Msg, batcher: ChatBatcher) -> None:
+    await batcher.add(_chat_id(msg), msg)
+
+
+async def send_raw(msg: Msg, bot: Bot, limiter: RateLimiter, filename="Schedule.png") -> None:
+    chat_id = _chat_id(msg)
+    await limiter.acquire(chat_id)
     try:
         await bot.send_document(
             chat_id=chat_id,
@@ -40,34 +236,87 @@ async def send_raw(msg: Msg, bot: Bot, filename="Schedule.png") -> None:
         )
         await msg.ack()
     except TelegramRetryAfter as e:
+        logger.warning("Flood limit exceeded for chat %d, retry after %d seconds", chat_id, e.retry_after)
+        limiter.pause(chat_id, e.retry_after)
         await msg.nak(e.retry_after)
 
 
-async def send_from_store(msg: Msg, bot: Bot, store: ObjectStore, filename="Schedule.png") -> None:
-    if msg.headers is None:
-        logger.error("Got message without headers")
-        raise ValueError("Headers are required for message processing")
-
-    chat_id = int(msg.headers[CHAT_ID_HEADER])
-    rendered_name = msg.data.decode()
-    result = await store.get(rendered_name)
-
+async def _deliver(
+    chat_id: int,
+    found: list[tuple[Msg, str, ObjectStore.ObjectResult]],
+    bot: Bot,
+    limiter: RateLimiter,
+    cleanup: RenderedCleanup,
+    filename: str,
+) -> None:
+    await limiter.acquire(chat_id)
     try:
-        await bot.send_document(
-            chat_id=chat_id,
-            document=BufferedInputFile(file=result.data, filename=filename),
-        )
-        await msg.ack()
+        if len(found) == 1:
+            await bot.send_document(
+                chat_id=chat_id,
+                document=BufferedInputFile(file=found[0][2].data, filename=filename),
+            )
+        else:
+            await bot.send_media_group(
+                chat_id=chat_id,
+                media=[
+                    InputMediaDocument(media=BufferedInputFile(file=result.data, filename=filename))
+                    for _, _, result in found
+                ],
+            )
     except TelegramRetryAfter as e:
-        await msg.nak(e.retry_after)
+        logger.warning("Flood limit exceeded for chat %d, retry after %d seconds", chat_id, e.retry_after)
+        limiter.pause(chat_id, e.retry_after)
+        for msg, _, _ in found:
+            await msg.nak(e.retry_after)
+        return
+    except PERMANENT_ERRORS as e:
+        if len(found) > 1:
+            # A single bad item fails the whole group, so items are sent separately to deliver the rest.
+            logger.warning("Cannot send media group to chat %d, sending items separately: %s", chat_id, e)
+            for item in found:
+                await _deliver(chat_id, [item], bot, limiter, cleanup, filename)
+            return
+        msg, rendered_name, result = found[0]
+        logger.error("Cannot send schedule %s to chat %d: %s", rendered_name, chat_id, e)
+        # Redelivery would fail the same way.
+        await msg.term()
+        cleanup.schedule(rendered_name, result.info.size)
+        return
+    # Other errors, such as network ones, are transient: messages are not acknowledged and will be redelivered.
+    for msg, rendered_name, result in found:
+        await msg.ack()
+        cleanup.schedule(rendered_name, result.info.size)
 
 
-async def response_error(msg: Msg, bot: Bot) -> None:
-    if msg.headers is None:
-        logger.error("Got message without headers")
-        raise ValueError("Headers are required for message processing")
+async def send_from_store(
+    messages: list[Msg],
+    bot: Bot,
+    store: ObjectStore,
+    limiter: RateLimiter,
+    cleanup: RenderedCleanup,
+    filename="Schedule.png",
+) -> None:
+    """
+    Sends schedules rendered for the same chat. Several ones are sent as a media group, which takes a single slot
+    of the rate limit, and all messages are acknowledged once the group is delivered.
+    """
+    chat_id = _chat_id(messages[0])
+    found: list[tuple[Msg, str, ObjectStore.ObjectResult]] = []
+    for msg in messages:
+        rendered_name = msg.data.decode()
+        try:
+            found.append((msg, rendered_name, await store.get(rendered_name)))
+        except ObjectNotFoundError:
+            logger.warning("Schedule %s was already delivered or has expired", rendered_name)
+            await msg.ack()
+    if found:
+        await _deliver(chat_id, found, bot, limiter, cleanup, filename)
 
-    chat_id = int(msg.headers[CHAT_ID_HEADER])
+
+async def response_error(msg: Msg, bot: Bot, limiter: RateLimiter) -> None:
+    chat_id = _chat_id(msg)
+    await limiter.acquire(chat_id)
     try:
         await bot.send_message(
             chat_id=chat_id,
@@ -75,10 +324,24 @@ async def response_error(msg: Msg, bot: Bot) -> None:
         )
         await msg.ack()
     except TelegramRetryAfter as e:
+        logger.warning("Flood limit exceeded for chat %d, retry after %d seconds", chat_id, e.retry_after)
+        limiter.pause(chat_id, e.retry_after)
         await msg.nak(e.retry_after)
 
 
-async def sender_loop(js: JetStreamContext, bot: Bot, shutdown_event: asyncio.Event | None = None):
+async def sender_loop(
+    js: JetStreamContext,
+    bot: Bot,
+    shutdown_event: asyncio.Event | None = None,
+    limiter: RateLimiter | None = None,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    delete_grace: float = DEFAULT_DELETE_GRACE,
+    group_window: float = DEFAULT_GROUP_WINDOW,
+    stats_interval: float = 60.0,
+):
+    if limiter is None:
+        limiter = RateLimiter()
+    pool = SendPool(concurrency)
     await js.create_object_store(
         "rendered",
         config=ObjectStoreConfig(
@@ -88,15 +351,33 @@ async def sender_loop(js: JetStreamContext, bot: Bot, shutdown_event: asyncio.Ev
         ),
     )
     store = await js.object_store(RESULT_BUCKET_NAME)
-    await js.subscribe(INPUT_RAW_SUBJECT_NAME, cb=partial(send_raw, bot=bot), durable="sender", manual_ack=True)
+    cleanup = RenderedCleanup(store, delete_grace)
+    batcher = ChatBatcher(
+        pool, partial(send_from_store, bot=bot, store=store, limiter=limiter, cleanup=cleanup), group_window
+    )
+    await js.subscribe(
+        INPUT_RAW_SUBJECT_NAME,
+        cb=partial(dispatch, handler=partial(send_raw, bot=bot, limiter=limiter), pool=pool, batcher=batcher),
+        durable="sender",
+        manual_ack=True,
+    )
     await js.subscribe(
         INPUT_STORE_SUBJECT_NAME,
-        cb=partial(send_from_store, bot=bot, store=store),
+        cb=partial(dispatch_batched, batcher=batcher),
         durable="sender_store",
         manual_ack=True,
     )
-    await js.subscribe(INPUT_SUBJECT_ERROR, cb=partial(response_error, bot=bot), durable="sender_err", manual_ack=True)
+    await js.subscribe(
+        INPUT_SUBJECT_ERROR,
+        cb=partial(dispatch, handler=partial(response_error, bot=bot, limiter=limiter), pool=pool, batcher=batcher),
+        durable="sender_err",
+        manual_ack=True,
+    )
     logger.info("Connected to NATS")
+    stats_task = start_stats_task(
+        "sender", lambda: pool.stats() | batcher.stats() | limiter.stats() | cleanup.stats(), stats_interval
+    )
+    measure_task = asyncio.create_task(cleanup.measure_periodically(stats_interval)) if stats_interval > 0 else None
 
     if shutdown_event is None:
         shutdown_event = Event()
@@ -107,23 +388,71 @@ async def sender_loop(js: JetStreamContext, bot: Bot, shutdown_event: asyncio.Ev
     except asyncio.CancelledError:
         logger.debug("Main task was cancelled")
     logger.warning("Exiting main task")
+    if stats_task is not None:
+        stats_task.cancel()
+    if measure_task is not None:
+        measure_task.cancel()
+    await batcher.flush_all()
+    await pool.drain()
+    cleanup.cancel()
 
 
-async def main(token: str, servers: str = "nats://localhost:4222"):
+async def main(
+    token: str,
+    servers: str = "nats://localhost:4222",
+    global_rate: float = DEFAULT_GLOBAL_RATE,
+    chat_rate: float = DEFAULT_CHAT_RATE,
+    group_rate: float = DEFAULT_GROUP_RATE,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    delete_grace: float = DEFAULT_DELETE_GRACE,
+    group_window: float = DEFAULT_GROUP_WINDOW,
+    stats_interval: float = 60.0,
+):
     nc = await nats.connect(servers=servers)
     js = nc.jetstream()
-    bot = Bot(token, default=DefaultBotProperties(parse_mode="HTML"))
-    await sender_loop(js, bot)
+    # Connections to the Bot API are kept alive and reused, one per concurrently sent message.
+    session = AiohttpSession(limit=concurrency)
+    bot = Bot(token, session=session, default=DefaultBotProperties(parse_mode="HTML"))
+    limiter = RateLimiter(global_rate, chat_rate, group_rate)
+    await sender_loop(
+        js,
+        bot,
+        limiter=limiter,
+        concurrency=concurrency,
+        delete_grace=delete_grace,
+        group_window=group_window,
+        stats_interval=stats_interval,
+    )
+    await session.close()
     await nc.close()
 
 
 def entry():
     bot_token = os.getenv("TOKEN")
     nats_servers_ = os.getenv("NATS_SERVERS")
+    global_rate_ = float(os.getenv("SENDER_RATE_LIMIT") or DEFAULT_GLOBAL_RATE)
+    chat_rate_ = float(os.getenv("SENDER_CHAT_RATE_LIMIT") or DEFAULT_CHAT_RATE)
+    group_rate_ = float(os.getenv("SENDER_GROUP_RATE_LIMIT") or DEFAULT_GROUP_RATE)
+    concurrency_ = int(os.getenv("SENDER_CONCURRENCY") or DEFAULT_CONCURRENCY)
+    delete_grace_ = float(os.getenv("SENDER_DELETE_GRACE") or DEFAULT_DELETE_GRACE)
+    group_window_ = float(os.getenv("SENDER_GROUP_WINDOW") or DEFAULT_GROUP_WINDOW)
+    stats_interval_ = float(os.getenv("STATS_INTERVAL") or 60)
     if bot_token is None:
         logger.critical("Cannot run without bot token")
         exit(1)
     if nats_servers_ is None:
         logger.critical("Cannot run without nats url")
         exit(1)
-    asyncio.run(main(bot_token, nats_servers_))
+    asyncio.run(
+        main(
+            bot_token,
+            nats_servers_,
+            global_rate_,
+            chat_rate_,
+            group_rate_,
+            concurrency_,
+            delete_grace_,
+            group_window_,
+            stats_interval_,
+        )
+    )
@@ -0,0 +1,123 @@
+"""
+Load test of sending. Run as `python -m services.sender.benchmark --help`.
+NATS and Telegram are not required: messages are generated in memory and sent to a local stand-in for the Bot API,
+which answers after a fixed delay.
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from collections import defaultdict
+from functools import partial
+from typing import Any, cast
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import web
+from nats.aio.msg import Msg
+
+from services.sender import CHAT_ID_HEADER, SendPool, dispatch, send_raw
+from services.sender.rate_limit import RateLimiter
+
+FAKE_TOKEN = "42:benchmark"
+INDEX_BYTES = 4
+
+
+class FakeMsg:
+    def __init__(self, chat_id: int, data: bytes):
+        self.headers = {CHAT_ID_HEADER: str(chat_id)}
+        self.data = data
+        self.subject = "schedules.ready"
+        self.acked = False
+
+    async def ack(self) -> None:
+        self.acked = True
+
+    async def nak(self, delay: float | None = None) -> None:
+        pass
+
+    async def in_progress(self) -> None:
+        pass
+
+
+class FakeBotApi:
+    """
+    Records the order of documents per chat and the connections used to send them.
+    """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.received: dict[int, list[int]] = defaultdict(list)
+        self.connections: set[Any] = set()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.connections.add(request.transport and request.transport.get_extra_info("peername"))
+        form = await request.post()
+        chat_id = int(str(form["chat_id"]))
+        # Files are attached as separate fields, which are referred to by `attach://<field name>`.
+        document = form[str(form["document"]).removeprefix("attach://")]
+        assert isinstance(document, web.FileField)
+        index = int.from_bytes(document.file.read(INDEX_BYTES))
+        await asyncio.sleep(self.latency)
+        self.received[chat_id].append(index)
+        result = {"message_id": index, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}}
+        return web.json_response({"ok": True, "result": result})
+
+
+def _order_violations(received: dict[int, list[int]]) -> int:
+    return sum(index < previous for indices in received.values() for previous, index in zip(indices, indices[1:]))
+
+
+async def benchmark_throughput(args: argparse.Namespace) -> None:
+    payload = os.urandom(args.size * 1024)
+    print(
+        f"{args.messages} documents of {args.size} KB to {args.chats} chats, API latency {args.latency * 1000:.0f} ms"
+    )
+    print(f"{'concurrency':>11} {'messages/s':>10} {'connections':>11} {'order violations':>16}")
+    for concurrency in args.concurrency:
+        api = FakeBotApi(args.latency)
+        app = web.Application(client_max_size=2 * len(payload))
+        app.router.add_post("/bot{token}/{method}", api.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = runner.addresses[0][:2]
+
+        session = AiohttpSession(api=TelegramAPIServer.from_base(f"http://{host}:{port}"), limit=concurrency)
+        bot = Bot(FAKE_TOKEN, session=session)
+        pool = SendPool(concurrency)
+        # Limits of Telegram are disabled, so only sending itself is measured.
+        handler = partial(send_raw, bot=bot, limiter=RateLimiter(0, 0, 0))
+        messages = [FakeMsg(i % args.chats + 1, i.to_bytes(INDEX_BYTES) + payload) for i in range(args.messages)]
+
+        start = time.perf_counter()
+        for msg in messages:
+            # As push subscription callbacks, messages are dispatched one by one.
+            await dispatch(cast(Msg, msg), handler=handler, pool=pool)
+        await pool.drain()
+        elapsed = time.perf_counter() - start
+        assert all(msg.acked for msg in messages)
+        print(
+            f"{concurrency:11} {len(messages) / elapsed:10.1f} {len(api.connections):11} "
+            f"{_order_violations(api.received):16}"
+        )
+        await session.close()
+        await runner.cleanup()
+
+
+def entry():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--chats", type=int, default=50, help="Number of chats messages are sent to")
+    parser.add_argument("--size", type=int, default=1024, help="Size of documents, in KB")
+    parser.add_argument("--latency", type=float, default=0.1, help="Response time of the Bot API, in seconds")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=(1, 4, 16, 64))
+    args = parser.parse_args()
+    asyncio.run(benchmark_throughput(args))
+
+
+if __name__ == "__main__":
+    entry()
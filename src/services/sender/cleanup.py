@@ -0,0 +1,75 @@
+"""
+Rendered schedules are kept in memory of the NATS server, so they are deleted once delivered
+instead of waiting for the TTL of the bucket.
+"""
+
+import asyncio
+import logging
+from typing import Any
+
+from nats.js.errors import ObjectNotFoundError
+from nats.js.object_store import ObjectStore
+
+# Longer than the default acknowledgement timeout, so a message redelivered because its acknowledgement was lost
+# still finds the object.
+DEFAULT_DELETE_GRACE = 60.0
+
+logger = logging.getLogger(__name__)
+
+
+class RenderedCleanup:
+    """
+    Deletes delivered objects after `grace` seconds. Objects which are never delivered expire by TTL of the bucket,
+    as well as ones pending deletion when the sender stops.
+    """
+
+    def __init__(self, store: ObjectStore, grace: float = DEFAULT_DELETE_GRACE):
+        self.store = store
+        self.grace = grace
+        self._tasks: set[asyncio.Task] = set()
+        self.deleted = 0
+        self.deleted_bytes = 0
+        self.store_bytes: int | None = None
+
+    def schedule(self, name: str, size: int) -> None:
+        task = asyncio.create_task(self._delete(name, size))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _delete(self, name: str, size: int) -> None:
+        await asyncio.sleep(self.grace)
+        try:
+            await self.store.delete(name)
+        except ObjectNotFoundError:
+            return
+        except Exception:
+            logger.exception("Cannot delete %s, it will expire by TTL", name)
+            return
+        self.deleted += 1
+        self.deleted_bytes += size
+
+    async def measure_periodically(self, interval: float) -> None:
+        """
+        Updates the size of the bucket every `interval` seconds until cancelled.
+        """
+        while True:
+            try:
+                self.store_bytes = (await self.store.status()).size
+            except Exception:
+                logger.exception("Cannot get status of the store")
+            await asyncio.sleep(interval)
+
+    def cancel(self) -> None:
+        if self._tasks:
+            logger.info("Leaving %d delivered objects to expire by TTL", len(self._tasks))
+        for task in self._tasks:
+            task.cancel()
+
+    def stats(self) -> dict[str, Any]:
+        store_mb = "?" if self.store_bytes is None else f"{self.store_bytes / 2**20:.1f}"
+        return {
+            "rendered.used_mb": store_mb,
+            "rendered.pending_deletes": len(self._tasks),
+            "rendered.deleted": self.deleted,
+            "rendered.deleted_mb": f"{self.deleted_bytes / 2**20:.1f}",
+        }
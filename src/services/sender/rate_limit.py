@@ -0,0 +1,128 @@
+"""
+Telegram limits bots to about 30 messages per second overall, one message per second in a private chat
+and 20 messages per minute in a group. Sends are delayed here instead of being rejected with `TelegramRetryAfter`.
+"""
+
+import asyncio
+import time
+from typing import Any
+
+DEFAULT_GLOBAL_RATE = 30.0
+DEFAULT_CHAT_RATE = 1.0
+DEFAULT_GROUP_RATE = 20 / 60
+# Buckets of chats which are not throttled are dropped above this number, since a new bucket behaves the same.
+MAX_CHAT_BUCKETS = 10_000
+
+
+class TokenBucket:
+    """
+    Allows `rate` acquisitions per second on average and up to `capacity` of them at once.
+    Waiting coroutines are served in order of arrival.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self) -> float:
+        """
+        Returns time spent waiting, either for a token or for other waiting coroutines.
+        """
+        start = time.monotonic()
+        queued = self._lock.locked()
+        async with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+                queued = True
+            self._tokens -= 1
+        return time.monotonic() - start if queued else 0.0
+
+    def pause(self, seconds: float) -> None:
+        """
+        Makes the next acquisition wait for at least `seconds`.
+        """
+        self._refill()
+        self._tokens = min(self._tokens, 0.0) - seconds * self.rate
+
+    def idle(self) -> bool:
+        self._refill()
+        return not self._lock.locked() and self._tokens >= self.capacity
+
+
+class RateLimiter:
+    """
+    Combines the global bucket with a bucket per chat. Chats with negative ids are groups and channels.
+    Non-positive rate disables the corresponding limit.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = DEFAULT_GLOBAL_RATE,
+        chat_rate: float = DEFAULT_CHAT_RATE,
+        group_rate: float = DEFAULT_GROUP_RATE,
+    ):
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self._global = TokenBucket(global_rate, capacity=max(1.0, global_rate)) if global_rate > 0 else None
+        self._chats: dict[int, TokenBucket] = {}
+        self.waiting = 0
+        self.acquired = 0
+        self.chat_throttled = 0
+        self.chat_throttled_seconds = 0.0
+        self.global_throttled = 0
+        self.global_throttled_seconds = 0.0
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket | None:
+        rate = self.group_rate if chat_id < 0 else self.chat_rate
+        if rate <= 0:
+            return None
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= MAX_CHAT_BUCKETS:
+                self._chats = {key: value for key, value in self._chats.items() if not value.idle()}
+            bucket = self._chats[chat_id] = TokenBucket(rate)
+        return bucket
+
+    async def acquire(self, chat_id: int) -> None:
+        """
+        Waits until a message may be sent to the chat. The chat limit is awaited first,
+        so messages to a busy chat do not hold the global limit for others.
+        """
+        self.waiting += 1
+        try:
+            if (bucket := self._chat_bucket(chat_id)) is not None and (waited := await bucket.acquire()) > 0:
+                self.chat_throttled += 1
+                self.chat_throttled_seconds += waited
+            if self._global is not None and (waited := await self._global.acquire()) > 0:
+                self.global_throttled += 1
+                self.global_throttled_seconds += waited
+        finally:
+            self.waiting -= 1
+        self.acquired += 1
+
+    def pause(self, chat_id: int, seconds: float) -> None:
+        """
+        Applies a delay requested by Telegram to the chat.
+        """
+        if (bucket := self._chat_bucket(chat_id)) is not None:
+            bucket.pause(seconds)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "sends": self.acquired,
+            "waiting": self.waiting,
+            "chat.throttled": self.chat_throttled,
+            "chat.throttled_s": f"{self.chat_throttled_seconds:.1f}",
+            "global.throttled": self.global_throttled,
+            "global.throttled_s": f"{self.global_throttled_seconds:.1f}",
+        }
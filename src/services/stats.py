@@ -0,0 +1,36 @@
+"""
+Services have no dedicated metrics backend, so runtime statistics are periodically written to the log.
+"""
+
+import asyncio
+import logging
+from typing import Any, Callable, Mapping
+
+logger = logging.getLogger(__name__)
+
+
+async def log_stats_periodically(
+    service_name: str, snapshot: Callable[[], Mapping[str, Any]], interval: float = 60.0
+) -> None:
+    """
+    Logs values returned by `snapshot` every `interval` seconds until cancelled.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            values = snapshot()
+        except Exception:
+            logger.exception("Cannot collect stats for %s", service_name)
+            continue
+        logger.info("%s stats: %s", service_name, " ".join(f"{key}={value}" for key, value in values.items()))
+
+
+def start_stats_task(
+    service_name: str, snapshot: Callable[[], Mapping[str, Any]], interval: float = 60.0
+) -> asyncio.Task | None:
+    """
+    Starts periodic logging of stats; non-positive interval disables it.
+    """
+    if interval <= 0:
+        return None
+    return asyncio.create_task(log_stats_periodically(service_name, snapshot, interval))
@@ -1,5 +1,6 @@
 import argparse
 import asyncio
+import io
 import logging
 import os
 from pathlib import Path
@@ -8,10 +9,14 @@ from uuid import UUID
 import nats
 from nats.js.errors import ObjectNotFoundError
 from nats.js.object_store import ObjectStore
-from sqlalchemy import text
+from PIL import Image
+from sqlalchemy import text, update
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 
 from bot_registry.database_models import ImageElementModel
+from core.entities import ImageStatus
+from services.converter import convert_derivatives
+from services.converter.content import link_content, store_content
 
 BUCKET_NAME = "assets"
 
@@ -46,8 +51,24 @@ async def ensure_loaded(file_path: Path, store: ObjectStore, session: AsyncSessi
         has_content = True
 
     if not has_content:
-        await store.put(f"0.{element_uuid}", file_path.read_bytes())
-        logging.info("Image %s saved to object store", file_path.name)
+        # Size is kept as is, content is stored just as the converter does, so identical files are stored once.
+        derivatives = convert_derivatives(file_path.read_bytes(), "ignore", (0, 0))
+        digest = await store_content(store, derivatives)
+        await link_content(store, BUCKET_NAME, f"0.{element_uuid}", digest, list(derivatives))
+        width, height = Image.open(io.BytesIO(derivatives[""])).size
+        await session.execute(
+            update(ImageElementModel)
+            .where(ImageElementModel.element_id == element_uuid)
+            .values(
+                status=ImageStatus.READY,
+                content_hash=digest,
+                width=width,
+                height=height,
+                content_bytes=len(derivatives[""]),
+            )
+        )
+        await session.commit()
+        logging.info("Image %s saved to object store as %s", file_path.name, digest)
 
     if has_content and has_element:
         logging.info("Image %s already uploaded", file_path.name)
@@ -0,0 +1,59 @@
+import asyncio
+import time
+
+import pytest
+
+from services.sender.rate_limit import RateLimiter
+
+
+async def _acquire_all(limiter: RateLimiter, chat_ids: list[int]) -> float:
+    start = time.monotonic()
+    for chat_id in chat_ids:
+        await limiter.acquire(chat_id)
+    return time.monotonic() - start
+
+
+def test_disabled_limits_do_not_wait():
+    limiter = RateLimiter(0, 0, 0)
+    assert asyncio.run(_acquire_all(limiter, [1] * 50)) < 0.05
+    assert limiter.acquired == 50
+    assert limiter.chat_throttled == limiter.global_throttled == 0
+
+
+def test_chat_rate():
+    limiter = RateLimiter(0, chat_rate=20, group_rate=0)
+    elapsed = asyncio.run(_acquire_all(limiter, [1, 1, 1]))
+    # The first message is sent at once, the next ones wait for 1/20 s each.
+    assert elapsed == pytest.approx(0.1, abs=0.05)
+    assert limiter.chat_throttled == 2
+
+
+def test_chats_are_limited_separately():
+    limiter = RateLimiter(0, chat_rate=1, group_rate=1)
+    assert asyncio.run(_acquire_all(limiter, [1, 2, -1, -2])) < 0.05
+    assert limiter.chat_throttled == 0
+
+
+def test_group_rate_applies_to_negative_ids():
+    limiter = RateLimiter(0, chat_rate=0, group_rate=20)
+    assert asyncio.run(_acquire_all(limiter, [1, 1, 1])) < 0.05
+    assert asyncio.run(_acquire_all(limiter, [-1, -1])) == pytest.approx(0.05, abs=0.04)
+
+
+def test_global_rate():
+    limiter = RateLimiter(global_rate=20, chat_rate=0, group_rate=0)
+    # The global bucket allows a burst of `global_rate` messages.
+    assert asyncio.run(_acquire_all(limiter, list(range(20)))) < 0.05
+    assert asyncio.run(_acquire_all(limiter, [100, 101])) == pytest.approx(0.1, abs=0.05)
+    assert limiter.global_throttled == 2
+
+
+def test_pause_delays_next_message():
+    limiter = RateLimiter(0, chat_rate=100, group_rate=0)
+
+    async def paused() -> float:
+        await limiter.acquire(1)
+        limiter.pause(1, 0.1)
+        return await _acquire_all(limiter, [1])
+
+    assert asyncio.run(paused()) == pytest.approx(0.1, abs=0.05)
@@ -0,0 +1,55 @@
+import io
+
+import pytest
+from PIL import Image
+
+from services.raw_image import (
+    HEADER_SIZE,
+    decode_raw,
+    encode_raw,
+    is_raw,
+    raw_size,
+    write_raw,
+)
+
+
+def _image(mode: str) -> Image.Image:
+    return Image.effect_noise((67, 150), 40).convert(mode)
+
+
+@pytest.mark.parametrize("mode", ["L", "RGB", "RGBA"])
+def test_round_trip(mode: str):
+    image = _image(mode)
+    encoded = encode_raw(image)
+    assert is_raw(encoded)
+    assert len(encoded) == raw_size(image.convert("RGBX") if mode == "RGB" else image)
+    decoded = decode_raw(encoded)
+    assert decoded.size == image.size
+    assert decoded.convert(mode).tobytes() == image.tobytes()
+
+
+def test_write_raw_matches_encode_raw():
+    image = _image("RGB")
+    stream = io.BytesIO()
+    write_raw(image, stream)
+    assert stream.getvalue() == encode_raw(image)
+
+
+def test_decoded_image_shares_buffer():
+    buffer = bytearray(encode_raw(_image("L")))
+    decoded = decode_raw(buffer)
+    buffer[HEADER_SIZE] = 255 - buffer[HEADER_SIZE]
+    assert decoded.getpixel((0, 0)) == buffer[HEADER_SIZE]
+
+
+def test_rejects_truncated_buffer():
+    with pytest.raises(ValueError):
+        decode_raw(encode_raw(_image("RGBA"))[:-1])
+
+
+def test_rejects_other_formats():
+    stream = io.BytesIO()
+    _image("RGB").save(stream, format="png")
+    assert not is_raw(stream.getvalue())
+    with pytest.raises(ValueError):
+        decode_raw(stream.getvalue())
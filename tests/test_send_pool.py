@@ -0,0 +1,109 @@
+import asyncio
+import random
+from functools import partial
+from typing import cast
+
+from nats.aio.msg import Msg
+
+from services.sender import SendPool
+
+
+class FakeMsg:
+    def __init__(self) -> None:
+        self.touched = 0
+
+    async def in_progress(self) -> None:
+        self.touched += 1
+
+
+def test_messages_to_chat_are_sent_in_order():
+    sent: dict[int, list[int]] = {}
+
+    async def job(chat_id: int, index: int) -> None:
+        await asyncio.sleep(random.uniform(0, 0.01))
+        sent.setdefault(chat_id, []).append(index)
+
+    async def run() -> None:
+        pool = SendPool(4)
+        for index in range(40):
+            await pool.submit(index % 3, partial(job, index % 3, index))
+        await pool.drain()
+
+    asyncio.run(run())
+    assert sent == {chat_id: list(range(chat_id, 40, 3)) for chat_id in range(3)}
+
+
+def test_limit_applies_to_running_sends():
+    running = 0
+    max_running = 0
+
+    async def job() -> None:
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    async def run() -> None:
+        pool = SendPool(2)
+        for chat_id in range(10):
+            await pool.submit(chat_id, job)
+        await pool.drain()
+
+    asyncio.run(run())
+    assert max_running == 2
+
+
+def test_busy_chat_does_not_block_others():
+    async def run() -> tuple[bool, int]:
+        release = asyncio.Event()
+        other_sent = asyncio.Event()
+        pool = SendPool(2)
+        for _ in range(5):
+            await pool.submit(1, release.wait)
+        await pool.submit(2, partial(asyncio.sleep, 0))
+        await pool.submit(3, partial(asyncio.sleep, 0))
+        await pool.submit(4, other_sent.wait)
+        other_sent.set()
+        await asyncio.sleep(0.01)
+        # Only the busy chat is left, and its queued messages are still held by the pool.
+        result = list(pool._chats) == [1], pool.stats()["pool.messages"]
+        release.set()
+        await pool.drain()
+        return result
+
+    assert asyncio.run(run()) == (True, 5)
+
+
+def test_failed_job_does_not_stop_chat():
+    sent: list[int] = []
+
+    async def job(index: int) -> None:
+        if index == 0:
+            raise RuntimeError("failed")
+        sent.append(index)
+
+    async def run() -> None:
+        pool = SendPool(1)
+        for index in range(3):
+            await pool.submit(1, partial(job, index))
+        await pool.drain()
+
+    asyncio.run(run())
+    assert sent == [1, 2]
+
+
+def test_held_messages_are_marked_in_progress():
+    messages = [FakeMsg() for _ in range(4)]
+
+    async def run() -> None:
+        pool = SendPool(1, in_progress_interval=0.02)
+        for msg in messages:
+            await pool.submit(1, partial(asyncio.sleep, 0.05), [cast(Msg, msg)])
+        await pool.drain()
+
+    asyncio.run(run())
+    # Each message is sent after the previous ones, so it is held longer and marked more often.
+    touched = [msg.touched for msg in messages]
+    assert all(count > 0 for count in touched)
+    assert touched == sorted(touched)
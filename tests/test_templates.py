@@ -0,0 +1,85 @@
+import pytest
+
+from services.renderer.templates import PatchSet, Template
+from services.renderer.weekdays import WeekDay
+
+
+def _texts(patch_set: PatchSet) -> list[str]:
+    return [patch.template for patch in patch_set.patches]
+
+
+def _patch_set(*patches: dict) -> PatchSet:
+    return PatchSet.model_validate([{"type": "text", "xy": [0, 0], **patch} for patch in patches])
+
+
+def test_merge_replaces_patches_with_same_id():
+    base = _patch_set({"id": "title", "text": "base"}, {"text": "footer"})
+    merged = base.merge(_patch_set({"id": "title", "text": "delta"}))
+    assert _texts(merged) == ["delta", "footer"]
+
+
+def test_merge_appends_new_patches():
+    base = _patch_set({"id": "title", "text": "title"})
+    merged = base.merge(_patch_set({"text": "anonymous"}, {"id": "new", "text": "new"}))
+    assert _texts(merged) == ["title", "anonymous", "new"]
+
+
+def test_merge_removes_patches():
+    base = _patch_set({"id": "title", "text": "title"}, {"id": "logo", "text": "logo"})
+    delta = PatchSet.model_validate({"patches": [], "remove": ["logo"]})
+    assert _texts(base.merge(delta)) == ["title"]
+
+
+def test_resolve_without_base_returns_template():
+    template = Template.model_validate({"always": [{"type": "text", "xy": [0, 0], "text": "x"}]})
+    assert template.resolve(Template()) is template
+
+
+def test_resolve_merges_patch_sets_and_days():
+    base = Template.model_validate(
+        {
+            "always": [{"type": "text", "xy": [0, 0], "id": "title", "text": "base"}],
+            "patches": {"1": {"always": [{"type": "text", "xy": [0, 0], "text": "monday"}]}},
+            "width": 1000,
+        }
+    )
+    delta = Template.model_validate(
+        {
+            "base": "global",
+            "always": [{"type": "text", "xy": [0, 0], "id": "title", "text": "delta"}],
+            "patches": {"2": {"always": [{"type": "text", "xy": [0, 0], "text": "tuesday"}]}},
+        }
+    )
+    resolved = delta.resolve(base, base_hash="hash")
+    assert resolved.base is None
+    assert resolved.width == 1000
+    assert _texts(resolved.always) == ["delta"]
+    assert _texts(resolved.patches[WeekDay.MONDAY].always) == ["monday"]
+    assert _texts(resolved.patches[WeekDay.TUESDAY].always) == ["tuesday"]
+    assert resolved.delta is delta
+    assert resolved.base_hash == "hash"
+
+
+def test_resolve_replaces_fields_given_in_delta():
+    base = Template(width=1000, height=500)
+    resolved = Template.model_validate({"base": "global", "height": 700}).resolve(base)
+    assert (resolved.width, resolved.height) == (1000, 700)
+
+
+def test_resolve_rejects_inheriting_base():
+    delta = Template.model_validate({"base": "global"})
+    with pytest.raises(ValueError):
+        delta.resolve(Template.model_validate({"base": "global"}))
+
+
+def test_dump_omits_new_defaults():
+    template = Template.model_validate({"always": [{"type": "text", "xy": [0, 0], "text": "x"}]})
+    dump = template.dump()
+    assert "remove" not in dump["always"]
+    assert "min_font_size" not in dump["always"]["patches"][0]
+    assert Template.model_validate(dump) == template
+
+
+def test_dump_of_inheriting_template_keeps_only_set_fields():
+    data = {"base": "global", "always": {"patches": [], "remove": ["logo"]}}
+    assert Template.model_validate(data).dump() == data